@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Compare encode and decode throughput of the ``json`` and ``bson`` wire
+formats for a typical explain message. Decoding includes building the query
+skeleton, as the sinks do for every message.
+
+"""
+import sys
+import timeit
+
+from argparse import ArgumentParser
+from datetime import datetime
+
+from bson import ObjectId
+
+from mongodrums.codec import get_codec, decode
+from mongodrums.util import skeleton
+
+
+def make_msg():
+    return {'type': 'explain',
+            'function': 'find',
+            'database': 'app',
+            'collection': 'orders',
+            'query': {'customer_id': ObjectId(),
+                      'status': {'$in': ['new', 'pending', 'shipped']},
+                      'created': {'$gte': datetime(2014, 1, 1)},
+                      '$or': [{'store': 12}, {'online': True}]},
+            'source': '/srv/app/orders/views.py:142',
+            'explain': {'cursor': 'BtreeCursor customer_id_1_created_1',
+                        'isMultiKey': False,
+                        'n': 12,
+                        'nscannedObjects': 40,
+                        'nscanned': 40,
+                        'scanAndOrder': False,
+                        'indexOnly': False,
+                        'millis': 3,
+                        'indexBounds': {'customer_id': [[ObjectId()] * 2],
+                                        'created': [[datetime(2014, 1, 1),
+                                                     datetime.max]]},
+                        'server': 'db1:27017'}}
+
+
+def bench(func, number):
+    return min(timeit.Timer(func).repeat(3, number)) / number
+
+
+def main():
+    parser = ArgumentParser('benchmark wire formats')
+    parser.add_argument('-n', '--number', type=int, default=5000,
+                        help='messages per measurement [default: %(default)s]')
+    args = parser.parse_args()
+
+    msg = make_msg()
+    print '%6s %8s %15s %15s' % ('format', 'bytes', 'encode (msg/s)',
+                                 'decode (msg/s)')
+    for name in ('json', 'bson'):
+        codec = get_codec(name)
+        data = codec.frame([codec.encode(msg)])
+
+        def encode():
+            codec.frame([codec.encode(msg)])
+
+        def decode_():
+            skeleton(decode(data)[0]['query'])
+
+        print '%6s %8d %15d %15d' % (name, len(data),
+                                     1 / bench(encode, args.number),
+                                     1 / bench(decode_, args.number))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
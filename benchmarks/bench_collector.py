@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Measure how many messages per second a collector takes in from a pusher on
+the same host, over loopback UDP and over a unix domain socket, handling
+datagrams one at a time or draining them in batches.
+
+Pre-encoded messages are sent as fast as possible and the collector hands
+every message to a sink that only counts them, so datagrams the collector
+can't keep up with are dropped and show up as loss.
+
+"""
+import os
+import socket
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+from mongodrums.codec import JSONCodec
+from mongodrums.collector import CollectorRunner
+from mongodrums.config import update
+from mongodrums.sink import Sink
+from mongodrums.util import parse_address
+
+
+class _CountingSink(Sink):
+    def __init__(self):
+        self.count = 0
+        self.last = None
+
+    def send(self, data, address):
+        self.count += 1
+        self.last = time.time()
+
+
+def bench(addr, port, batch, number, payload):
+    update({'collector': {'addr': addr, 'port': port, 'session': None,
+                          'recv_batch': {'enabled': batch}}})
+    sink = _CountingSink()
+    runner = CollectorRunner([sink])
+    runner.start()
+    time.sleep(.5)
+    family, address = parse_address(addr, port)
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.setblocking(0)
+    try:
+        start = time.time()
+        for _ in xrange(number):
+            try:
+                sock.sendto(payload, address)
+            except socket.error:
+                pass
+        # wait for the collector to go quiet
+        count = -1
+        while sink.count != count:
+            count = sink.count
+            time.sleep(.5)
+    finally:
+        sock.close()
+        runner.stop()
+        runner.join()
+    elapsed = (sink.last or start) - start
+    return sink.count, elapsed
+
+
+def main():
+    parser = ArgumentParser('benchmark collector throughput')
+    parser.add_argument('-n', '--number', type=int, default=50000,
+                        help='messages to send [default: %(default)s]')
+    parser.add_argument('-p', '--port', type=int, default=63333,
+                        help='UDP port to use [default: %(default)s]')
+    args = parser.parse_args()
+
+    msg = {'type': 'occurrence',
+           'function': 'find',
+           'database': 'app',
+           'collection': 'orders',
+           'query': {'customer_id': 1, 'status': {'$in': ['new']}},
+           'source': '/srv/app/orders/views.py:142',
+           'explain': {'cursor': 'BtreeCursor customer_id_1',
+                       'indexOnly': False}}
+    payload = JSONCodec.frame([JSONCodec.encode(msg)])
+    path = os.path.join(tempfile.mkdtemp(), 'collector.sock')
+    print '%10s %7s %10s %10s %12s' % ('transport', 'batch', 'received',
+                                       'loss', 'msg/s')
+    for name, addr in [('udp', '127.0.0.1'), ('unix', 'unix://' + path)]:
+        for batch in (False, True):
+            received, elapsed = bench(addr, args.port, batch, args.number,
+                                      payload)
+            print '%10s %7s %10d %9.1f%% %12d' % (
+                name, 'yes' if batch else 'no', received,
+                100.0 * (args.number - received) / args.number,
+                received / elapsed if elapsed else 0)
+    os.rmdir(os.path.dirname(path))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Measure the overhead instrumentation adds to ``Cursor.next()`` for cursors
+that were not sampled, relative to uninstrumented pymongo.
+
+Requires a running mongod, documents are fetched in a single large batch so
+the measurement is dominated by ``next()`` rather than the network.
+
+"""
+import sys
+import time
+
+from argparse import ArgumentParser
+
+import pymongo
+
+from mongodrums.config import update
+from mongodrums.instrument import instrument
+from mongodrums.util import get_default_database
+
+
+def drain(col, batch_size):
+    start = time.time()
+    count = 0
+    for _ in col.find().batch_size(batch_size):
+        count += 1
+    return time.time() - start, count
+
+
+def bench(col, batch_size, repeat):
+    # warm up the batch so the first query doesn't skew the timings
+    drain(col, batch_size)
+    return min([drain(col, batch_size) for _ in xrange(repeat)])
+
+
+def main():
+    parser = ArgumentParser('benchmark Cursor.next overhead')
+    parser.add_argument('-u', '--uri',
+                        default='mongodb://127.0.0.1:27017/mongodrums_bench',
+                        help='database to benchmark against '
+                             '[default: %(default)s]')
+    parser.add_argument('-n', '--num-docs', type=int, default=50000,
+                        help='documents to iterate [default: %(default)s]')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='runs per measurement, the fastest is kept '
+                             '[default: %(default)s]')
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(args.uri)
+    col = get_default_database(client, args.uri).bench_cursor_next
+    col.drop()
+    col.insert([{'i': i} for i in xrange(args.num_docs)])
+
+    try:
+        plain, count = bench(col, args.num_docs, args.repeat)
+        update({'instrument': {'sample_frequency': 0}})
+        with instrument():
+            instrumented, _ = bench(col, args.num_docs, args.repeat)
+    finally:
+        col.drop()
+
+    print 'documents:           %d' % (count)
+    print 'pymongo:             %.3f us/next' % (plain / count * 1e6)
+    print 'instrumented:        %.3f us/next' % (instrumented / count * 1e6)
+    print 'overhead:            %.3f us/next (%.1f%%)' % \
+          ((instrumented - plain) / count * 1e6,
+           (instrumented - plain) / plain * 100)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
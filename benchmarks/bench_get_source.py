@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Compare the per call cost of ``mongodrums.util.get_source`` against the
+previous ``inspect.stack()`` based implementation at a few stack depths.
+
+"""
+import inspect
+import sys
+import timeit
+
+from argparse import ArgumentParser
+
+from mongodrums.util import get_pkg, get_source
+
+
+FILTER_PACKAGES = ['pymongo', 'mongoengine', 'mongodrums']
+
+
+def legacy_get_source(filter_packages=None, up=2):
+    stack = inspect.stack()
+    frame = stack[up]
+    if filter_packages is not None:
+        frame = \
+            filter(lambda f: get_pkg(f[0].f_globals) \
+                             not in filter_packages,
+                   stack[up:])[0]
+    try:
+        return '%s:%d' % (frame[1], frame[2])
+    finally:
+        del frame
+        del stack
+
+
+# stand-ins for library frames (pymongo, mongodrums' wrappers...) sitting
+# between the application's call site and get_source, they are compiled into
+# a namespace that belongs to a filtered package
+_library = {'__name__': 'mongodrums.bench', '__package__': 'mongodrums',
+            'FILTER_PACKAGES': FILTER_PACKAGES}
+exec compile("""
+def _wrapper(func):
+    return func(FILTER_PACKAGES)
+
+
+def _call_at_depth(depth, func):
+    if depth <= 0:
+        return _wrapper(func)
+    return _call_at_depth(depth - 1, func)
+""", '<library>', 'exec') in _library
+_call_at_depth = _library['_call_at_depth']
+
+
+def bench(func, depth, number):
+    timer = timeit.Timer(lambda: _call_at_depth(depth, func))
+    return min(timer.repeat(3, number)) / number
+
+
+def main():
+    parser = ArgumentParser('benchmark get_source')
+    parser.add_argument('-n', '--number', type=int, default=2000,
+                        help='calls per measurement [default: %(default)s]')
+    parser.add_argument('-d', '--depths', type=int, nargs='+',
+                        default=[5, 20, 50],
+                        help='numbers of filtered frames between the call '
+                             'site and get_source [default: %(default)s]')
+    args = parser.parse_args()
+
+    sources = [_call_at_depth(3, f) for f in (get_source, legacy_get_source)]
+    assert(sources[0] == sources[1])
+
+    print '%8s %15s %15s %9s' % ('depth', 'inspect (us)', 'frames (us)',
+                                 'speedup')
+    for depth in args.depths:
+        legacy = bench(legacy_get_source, depth, args.number) * 1e6
+        current = bench(get_source, depth, args.number) * 1e6
+        print '%8d %15.2f %15.2f %8.1fx' % (depth, legacy, current,
+                                            legacy / current)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Compare working out the shape of a query with and without memoizing it, for
+JSON text and for documents. Documents are measured both with the values of
+every query differing, as they do for sampled operations, and all the same,
+the best case for a memo. ``bson key`` memoizes documents keyed by their BSON
+encoding. Memos are cleared before every run.
+
+"""
+import sys
+import timeit
+
+from argparse import ArgumentParser
+from datetime import datetime
+
+from bson import BSON, ObjectId
+from bson.json_util import dumps
+
+from mongodrums.util.cache import LRUCache
+from mongodrums.util.shape import CACHE_SIZE, _cache, get_shape, make_shape
+
+
+def make_query(n):
+    return {'customer_id': ObjectId(),
+            'status': {'$in': ['new', 'pending', 'shipped']},
+            'created': {'$gte': datetime(2014, 1, 1)},
+            '$or': [{'store': n}, {'online': True}]}
+
+
+_bson_cache = LRUCache(CACHE_SIZE)
+
+
+def get_bson_keyed(query):
+    key = BSON.encode(query)
+    shape = _bson_cache.get(key)
+    if shape is None:
+        shape = make_shape(query)
+        _bson_cache.put(key, shape)
+    return shape
+
+
+def bench(func, queries, clear=lambda: None):
+    def run():
+        for query in queries:
+            func(query)
+    return min(timeit.Timer(run, clear).repeat(3, 1)) / len(queries)
+
+
+def main():
+    parser = ArgumentParser('benchmark query shape memoization')
+    parser.add_argument('-n', '--number', type=int, default=10000,
+                        help='queries per measurement [default: %(default)s]')
+    args = parser.parse_args()
+
+    distinct = [make_query(n) for n in xrange(args.number)]
+    same = [distinct[0]] * args.number
+    text = [dumps(distinct[0])] * args.number
+    print '%10s %15s %15s %15s' % ('memo', 'text (q/s)', 'distinct (q/s)',
+                                   'same (q/s)')
+    print '%10s %15d %15d %15d' % ('none',
+                                   1 / bench(make_shape, text),
+                                   1 / bench(make_shape, distinct),
+                                   1 / bench(make_shape, same))
+    print '%10s %15s %15d %15d' % ('bson key', '-',
+                                   1 / bench(get_bson_keyed, distinct,
+                                             _bson_cache.clear),
+                                   1 / bench(get_bson_keyed, same,
+                                             _bson_cache.clear))
+    print '%10s %15d %15d %15d' % ('get_shape',
+                                   1 / bench(get_shape, text, _cache.clear),
+                                   1 / bench(get_shape, distinct),
+                                   1 / bench(get_shape, same))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+"""
+Wire formats for messages sent from the pusher to the collector
+
+Two formats are supported, picked with ``pusher.format``:
+
+``json``
+    each message is a JSON document, several messages batched in one
+    datagram are a JSON array, the query spec is sent as a JSON string so
+    collectors that predate the binary format keep working
+
+``bson``
+    a two byte header (``MAGIC`` and ``VERSION``) followed by one or more
+    BSON documents, the query spec travels as an embedded document
+
+The collector accepts both, :func:`decode` tells them apart by their first
+byte.
+
+Either can be wrapped in a zlib compressed frame, and a frame too large for
+one datagram is split into fragment frames carrying a message id, sequence
+number and fragment count, the collector puts them back together with a
+:class:`Reassembler`.
+
+Over a stream transport every frame is prefixed with its length as a four
+byte, big endian unsigned integer (``LENGTH_PREFIX``) and never fragmented.
+
+"""
+import struct
+import time
+import zlib
+
+from collections import OrderedDict
+
+from bson import BSON, decode_all
+from bson.errors import BSONError
+from bson.json_util import dumps, loads
+
+
+MAGIC = '\xdb'
+ZLIB_MAGIC = '\xdc'
+FRAGMENT_MAGIC = '\xdd'
+VERSION = 1
+_HEADER = struct.Struct('!cB')
+# magic, version, message id, sequence number, fragment count
+_FRAGMENT_HEADER = struct.Struct('!cBIHH')
+LENGTH_PREFIX = struct.Struct('!I')
+# upper bound on a decompressed frame
+_MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+
+
+class JSONCodec(object):
+    name = 'json'
+    # bytes added to a batch by its framing and by each message in it
+    frame_overhead = 2
+    message_overhead = 1
+
+    @staticmethod
+    def encode(msg):
+        query = msg.get('query')
+        if query is not None and not isinstance(query, basestring):
+            msg = dict(msg, query=dumps(query, sort_keys=True))
+        return dumps(msg)
+
+    @staticmethod
+    def frame(payloads):
+        if len(payloads) == 1:
+            return payloads[0]
+        return '[%s]' % (','.join(payloads))
+
+
+class BSONCodec(object):
+    name = 'bson'
+    frame_overhead = _HEADER.size
+    message_overhead = 0
+
+    @staticmethod
+    def encode(msg):
+        return BSON.encode(msg)
+
+    @staticmethod
+    def frame(payloads):
+        return _HEADER.pack(MAGIC, VERSION) + ''.join(payloads)
+
+
+_codecs = dict([(c.name, c) for c in (JSONCodec, BSONCodec)])
+
+
+def get_codec(name):
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError('unknown wire format %r' % (name))
+
+
+def _check_header(data):
+    if len(data) < _HEADER.size:
+        raise ValueError('truncated frame')
+    version = _HEADER.unpack_from(data)[1]
+    if version != VERSION:
+        raise ValueError('unsupported frame version %d' % (version))
+
+
+def compress(data, level=6):
+    return _HEADER.pack(ZLIB_MAGIC, VERSION) + zlib.compress(data, level)
+
+
+def fragment(data, msg_id, size):
+    """ Split ``data`` into fragment frames of at most ``size`` bytes
+
+    """
+    chunk_size = size - _FRAGMENT_HEADER.size
+    if chunk_size <= 0:
+        raise ValueError('fragment size %d is too small' % (size))
+    total = (len(data) + chunk_size - 1) // chunk_size
+    if total > 0xffff:
+        raise ValueError('%d bytes need too many fragments' % (len(data)))
+    return [_FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, VERSION, msg_id, seq,
+                                  total) +
+            data[seq * chunk_size:(seq + 1) * chunk_size]
+            for seq in xrange(total)]
+
+
+def is_fragment(data):
+    return data[:1] == FRAGMENT_MAGIC
+
+
+def parse_fragment(data):
+    """ Split a fragment frame into ``(msg_id, seq, total, chunk)``
+
+    """
+    if len(data) < _FRAGMENT_HEADER.size:
+        raise ValueError('truncated fragment')
+    _check_header(data)
+    msg_id, seq, total = _FRAGMENT_HEADER.unpack_from(data)[2:]
+    if seq >= total:
+        raise ValueError('fragment %d of %d' % (seq, total))
+    return msg_id, seq, total, data[_FRAGMENT_HEADER.size:]
+
+
+class Reassembler(object):
+    """ Put fragmented messages back together
+
+    At most ``max_pending`` incomplete messages holding ``max_bytes`` in all
+    are kept, the oldest is dropped to make room, and a message still
+    incomplete ``timeout`` seconds after its first fragment arrived is
+    dropped. ``stats`` counts what was reassembled and what was dropped.
+
+    """
+    def __init__(self, max_pending, max_bytes, timeout, timer=time.time):
+        self._timer = timer
+        # (address, msg_id) -> [first seen, fragment count, {seq: chunk}]
+        self._pending = OrderedDict()
+        self._bytes = 0
+        self.configure(max_pending, max_bytes, timeout)
+        self.stats = {'reassembled': 0,
+                      'expired': 0,
+                      'evicted': 0,
+                      'dropped_fragments': 0,
+                      'invalid_fragments': 0}
+
+    def configure(self, max_pending, max_bytes, timeout):
+        self._max_pending = max_pending
+        self._max_bytes = max_bytes
+        self._timeout = timeout
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _drop(self, key, reason):
+        chunks = self._pending.pop(key)[2]
+        self._bytes -= sum(len(c) for c in chunks.itervalues())
+        self.stats[reason] += 1
+        self.stats['dropped_fragments'] += len(chunks)
+        return chunks
+
+    def expire(self, now=None):
+        if now is None:
+            now = self._timer()
+        for key, entry in self._pending.items():
+            if entry[0] + self._timeout > now:
+                break
+            self._drop(key, 'expired')
+
+    def add(self, data, address=None):
+        """ Add a fragment frame
+
+        :returns:   the reassembled data once the last fragment of a message
+                    arrives, None otherwise
+
+        """
+        try:
+            msg_id, seq, total, chunk = parse_fragment(data)
+        except ValueError:
+            self.stats['invalid_fragments'] += 1
+            return None
+        now = self._timer()
+        self.expire(now)
+        key = (address, msg_id)
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = [now, total, {}]
+        elif entry[1] != total or seq in entry[2]:
+            self.stats['invalid_fragments'] += 1
+            return None
+        chunks = entry[2]
+        chunks[seq] = chunk
+        self._bytes += len(chunk)
+        if len(chunks) == total:
+            del self._pending[key]
+            self._bytes -= sum(len(c) for c in chunks.itervalues())
+            self.stats['reassembled'] += 1
+            return ''.join([chunks[i] for i in xrange(total)])
+        while self._pending and (len(self._pending) > self._max_pending or
+                                 self._bytes > self._max_bytes):
+            self._drop(next(iter(self._pending)), 'evicted')
+        return None
+
+
+def decode(data):
+    """ Decode a datagram into a list of messages
+
+    :raises ValueError:     if ``data`` is in neither format, or is a
+                            fragment
+
+    """
+    if data[:1] == ZLIB_MAGIC:
+        _check_header(data)
+        decompressor = zlib.decompressobj()
+        try:
+            data = decompressor.decompress(data[_HEADER.size:],
+                                           _MAX_DECOMPRESSED_SIZE)
+        except zlib.error, e:
+            raise ValueError(str(e))
+        if decompressor.unconsumed_tail:
+            raise ValueError('decompressed frame is too large')
+        if data[:1] == ZLIB_MAGIC:
+            raise ValueError('nested compressed frame')
+    if data[:1] == FRAGMENT_MAGIC:
+        raise ValueError('fragments need to be reassembled first')
+    if data[:1] == MAGIC:
+        _check_header(data)
+        try:
+            return decode_all(data[_HEADER.size:])
+        except BSONError, e:
+            raise ValueError(str(e))
+    start = data.lstrip()[:1]
+    if start == '{':
+        return [loads(data)]
+    elif start == '[':
+        return loads(data)
+    raise ValueError('unknown message format')
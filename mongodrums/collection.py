@@ -72,3 +72,8 @@ class IndexProfileCollection(MongoDrumsCollection):
 class QueryProfileCollection(MongoDrumsCollection):
     _default_class = QueryProfileDocument
 
+    def __init__(self, collection):
+        super(QueryProfileCollection, self).__init__(collection)
+        self.collection.ensure_index([('session', pymongo.ASCENDING),
+                                      ('fingerprint', pymongo.ASCENDING)])
+
@@ -2,35 +2,197 @@
 TODO: add dtls support
 
 """
+import json
 import logging
+import multiprocessing
+import os
+import resource
+import signal
+import socket
+import sys
 import threading
+import time
 
 from datetime import datetime
 
 import pymongo
 import gevent
+import gevent.queue
+import gevent.socket
 
-from bson.json_util import loads
-from gevent.server import DatagramServer
+from gevent.pywsgi import WSGIServer
+from gevent.server import DatagramServer, StreamServer
+from gevent.socket import EWOULDBLOCK
 
+from .codec import LENGTH_PREFIX, Reassembler, decode, is_fragment
 from .config import get_config
 from .collection import SessionCollection
-from .util import get_default_database
+from .util import get_default_database, parse_address
+from .util.histogram import Histogram
+
+
+# SO_REUSEPORT is missing from python 2's socket module
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       15 if sys.platform.startswith('linux') else None)
+
+
+def get_memory_usage():
+    """ Get the resident and peak resident set size of this process in
+    bytes, the current size is None where ``/proc`` isn't available
+
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, os x bytes
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+    rss = None
+    try:
+        with open('/proc/self/statm') as statm:
+            rss = int(statm.read().split()[1]) * \
+                  os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return {'rss': rss, 'max_rss': max_rss}
+
+
+def start_session(session):
+    """ Record the start of collector session ``session``
+
+    :returns:   the session collection to pass :func:`end_session`, None if
+                ``session`` is None
+
+    """
+    if session is None:
+        return None
+    mongo_uri = get_config().collector.mongo_uri
+    client = pymongo.MongoClient(mongo_uri)
+    db = get_default_database(client, mongo_uri)
+    session_col = SessionCollection(
+                        db[SessionCollection.get_collection_name()])
+    try:
+        session_col.insert({'name': session,
+                            'start_time': datetime.utcnow()})
+    except pymongo.errors.DuplicateKeyError:
+        logging.warning('session %s already exists, end time will be '
+                        'updated' % (session))
+    return session_col
+
+
+def end_session(session_col, session):
+    if session_col is not None:
+        session_col.update({'name': session},
+                           {'$set': {'end_time': datetime.utcnow()}})
 
 
 class CollectorRunner(threading.Thread):
-    def __init__(self, sinks=None):
+    """ Run a collector in its own thread
+
+    :param sinks:           the sinks to hand messages to
+    :param manage_session:  record the session start and end times, workers
+                            run by a :class:`CollectorSupervisor` leave that
+                            to the supervisor
+    :param reuse_port:      bind with ``SO_REUSEPORT`` so other processes can
+                            serve the same port
+    :param stats_port:      serve ``stats`` on this port rather than
+                            ``collector.stats.port``
+
+    With ``collector.stats.enabled`` the runner's ``stats`` are served as JSON
+    over HTTP on ``collector.stats.addr``, and a non-zero
+    ``collector.stats.log_interval`` logs them every that many seconds.
+
+    """
+    def __init__(self, sinks=None, manage_session=True, reuse_port=False,
+                 stats_port=None):
         threading.Thread.__init__(self)
         self.daemon = False
 
         self._server = None
         self._stop = threading.Event()
         self._sinks = [] if sinks is None else sinks
+        self._manage_session = manage_session
+        self._reuse_port = reuse_port
+        self._stats_port = stats_port
+        self._started = None
+        self._rates = {}
 
     @property
     def server(self):
         return self._server
 
+    @property
+    def stats(self):
+        if self._server is None:
+            return {}
+        stats = self._server.stats
+        stats.update({'pid': os.getpid(),
+                      'uptime': time.time() - self._started,
+                      'memory': get_memory_usage(),
+                      'rates': self._rates})
+        return stats
+
+    def _update_rates(self, last, now):
+        """ Work out frames, bytes and messages per second since ``last``,
+        a ``(time, stats)`` pair, and return the pair for ``now``
+
+        """
+        stats = self._server.stats
+        if last is not None:
+            elapsed = now - last[0]
+            if elapsed > 0:
+                self._rates = dict([(k, (stats[k] - last[1][k]) / elapsed)
+                                    for k in ('frames', 'bytes', 'messages')])
+        return (now, stats)
+
+    def _report_stats(self, interval, log_interval):
+        last = None
+        last_log = time.time()
+        while True:
+            gevent.sleep(interval)
+            now = time.time()
+            last = self._update_rates(last, now)
+            if log_interval > 0 and now - last_log >= log_interval:
+                last_log = now
+                logging.info('collector stats: %s' %
+                             (json.dumps(self.stats, sort_keys=True)))
+
+    def _serve_stats(self, environ, start_response):
+        body = json.dumps(self.stats, sort_keys=True)
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    def _start_stats(self):
+        """ Start the greenlets keeping rates and logging stats and the
+        stats endpoint
+
+        :returns:   what to pass :meth:`_stop_stats`
+
+        """
+        config = get_config().collector.stats
+        log_interval = config.log_interval
+        interval = min(log_interval, config.rate_interval) \
+                   if log_interval > 0 else config.rate_interval
+        reporter = gevent.spawn(self._report_stats, interval, log_interval)
+        endpoint = None
+        if config.enabled:
+            port = config.port if self._stats_port is None \
+                               else self._stats_port
+            endpoint = WSGIServer((config.addr, port), self._serve_stats,
+                                  log=None)
+            try:
+                endpoint.start()
+            except socket.error:
+                logging.exception('unable to serve stats on %s:%d' %
+                                  (config.addr, port))
+                endpoint = None
+        return reporter, endpoint
+
+    def _stop_stats(self, stats):
+        reporter, endpoint = stats
+        reporter.kill()
+        if endpoint is not None:
+            endpoint.stop()
+
     def _check_stopped(self):
         while not self._stop.is_set():
             gevent.sleep(.1)
@@ -38,64 +200,518 @@ class CollectorRunner(threading.Thread):
             self._server.stop()
 
     def run(self):
-        config = get_config()
-        self._server = Collector((config.collector.addr,
-                                  config.collector.port))
+        self._started = time.time()
+        self._server = get_collector(reuse_port=self._reuse_port)
         for sink in self._sinks:
             self._server.add_sink(sink)
         stop_check = gevent.spawn(self._check_stopped)
+        stats = self._start_stats()
         session_col = None
-        if self._server.session is not None:
-            mongo_uri = get_config().collector.mongo_uri
-            client = pymongo.MongoClient(mongo_uri)
-            db = get_default_database(client, mongo_uri)
-            session_col = SessionCollection(
-                                db[SessionCollection.get_collection_name()])
-            try:
-                session_col.insert({'name': self._server.session,
-                                    'start_time': datetime.utcnow()})
-            except pymongo.errors.DuplicateKeyError:
-                logging.warning('session %s already exists, end time will be '
-                                'updated' % (self._server.session))
+        if self._manage_session:
+            session_col = start_session(self._server.session)
         try:
             self._server.serve_forever()
         finally:
             stop_check.join()
-            if session_col is not None:
-                session_col.update({'name': self._server.session},
-                                   {'$set': {'end_time': datetime.utcnow()}})
+            self._stop_stats(stats)
+            self._server.close_sinks()
+            if self._server.family == socket.AF_UNIX:
+                os.unlink(self._server.address)
+            end_session(session_col, self._server.session)
 
 
     def stop(self):
         self._stop.set()
 
 
-class Collector(DatagramServer):
-    def __init__(self, listener, spawn='default'):
-        DatagramServer.__init__(self, listener, self.handle, spawn)
+def _run_worker(sinks, stats_port):
+    runner = CollectorRunner(sinks, manage_session=False, reuse_port=True,
+                             stats_port=stats_port)
+    signal.signal(signal.SIGTERM, lambda signum, frame: runner.stop())
+    # the supervisor decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    runner.start()
+    while runner.is_alive():
+        runner.join(.5)
+
+
+class CollectorSupervisor(threading.Thread):
+    """ Run the collector in ``workers`` processes all bound to the same
+    port with ``SO_REUSEPORT`` so the kernel spreads messages across them
+
+    A worker that dies is restarted after ``restart_delay`` seconds, doubled
+    for every restart up to ``max_restart_delay`` while it keeps dying
+    within ``max_restart_delay`` of being started, so a worker that can't
+    come up doesn't fork in a loop. Stopping the supervisor stops every
+    worker with ``SIGTERM`` (``SIGKILL`` after ``stop_timeout`` seconds). The
+    session start and end times are recorded once, by the supervisor. Sinks
+    are copied into each worker when it's forked so they shouldn't have
+    connected to anything yet. Worker ``n`` serves its stats on
+    ``collector.stats.port + n``.
+
+    """
+    stop_timeout = 10
+    restart_delay = 1
+    max_restart_delay = 60
+
+    def __init__(self, sinks=None, workers=None):
+        threading.Thread.__init__(self)
+        self.daemon = False
+
+        self._stop = threading.Event()
+        self._sinks = [] if sinks is None else sinks
+        self._num_workers = \
+            get_config().collector.workers if workers is None else workers
+        self._workers = []
+        self._started = [None] * self._num_workers
+        self._delays = [None] * self._num_workers
+        self._restart_at = [None] * self._num_workers
+        self.restarts = 0
+
+    @property
+    def workers(self):
+        return list(self._workers)
+
+    def _spawn(self, index):
+        stats_port = get_config().collector.stats.port + index
+        worker = multiprocessing.Process(target=_run_worker,
+                                         args=(self._sinks, stats_port),
+                                         name='mongodrums-collector')
+        worker.daemon = True
+        worker.start()
+        self._started[index] = time.time()
+        return worker
+
+    def _get_restart_delay(self, index, now):
+        delay = self._delays[index]
+        if delay is None or \
+           now - self._started[index] >= self.max_restart_delay:
+            delay = self.restart_delay
+        else:
+            delay = min(delay * 2, self.max_restart_delay)
+        self._delays[index] = delay
+        return delay
+
+    def run(self):
+        session = get_config().collector.session
+        session_col = start_session(session)
+        try:
+            self._workers = [self._spawn(i)
+                             for i in xrange(self._num_workers)]
+            while not self._stop.wait(.5):
+                now = time.time()
+                for i, worker in enumerate(self._workers):
+                    if worker.is_alive():
+                        continue
+                    if self._restart_at[i] is None:
+                        delay = self._get_restart_delay(i, now)
+                        logging.warning('collector worker %d exited with %s, '
+                                        'restarting in %gs' %
+                                        (worker.pid, worker.exitcode, delay))
+                        self._restart_at[i] = now + delay
+                    if now >= self._restart_at[i]:
+                        self._restart_at[i] = None
+                        self._workers[i] = self._spawn(i)
+                        self.restarts += 1
+        finally:
+            for worker in self._workers:
+                if worker.is_alive():
+                    worker.terminate()
+            deadline = time.time() + self.__class__.stop_timeout
+            for worker in self._workers:
+                worker.join(max(deadline - time.time(), 0))
+                if worker.is_alive():
+                    logging.warning('killing collector worker %d' %
+                                    (worker.pid))
+                    os.kill(worker.pid, signal.SIGKILL)
+                    worker.join()
+            end_session(session_col, session)
+
+    def stop(self):
+        self._stop.set()
+
+
+def get_runner(sinks=None, workers=None):
+    """ Get a :class:`CollectorRunner`, or a :class:`CollectorSupervisor`
+    when more than one worker is asked for
+
+    """
+    if workers is None:
+        workers = get_config().collector.workers
+    if workers > 1:
+        return CollectorSupervisor(sinks, workers)
+    return CollectorRunner(sinks)
+
+
+def get_listener(addr, port=None, transport='datagram', reuse_port=False):
+    """ Get what to pass a collector as its listener, ``addr`` is either a
+    host or ``unix:///path``, a stale socket file at ``path`` is replaced
+
+    """
+    family, address = parse_address(addr, port)
+    sock_type = socket.SOCK_STREAM if transport == 'stream' \
+                                   else socket.SOCK_DGRAM
+    if family == socket.AF_UNIX:
+        if reuse_port:
+            raise ValueError('unix sockets can\'t be shared between workers')
+        if os.path.exists(address):
+            os.unlink(address)
+    elif reuse_port:
+        if SO_REUSEPORT is None:
+            raise ValueError('SO_REUSEPORT is not supported here')
+    else:
+        return address
+    sock = gevent.socket.socket(family, sock_type)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(address)
+    if sock_type == socket.SOCK_STREAM:
+        sock.listen(StreamServer.backlog)
+    return sock
+
+
+def get_collector(config=None, reuse_port=False):
+    """ Create the collector for ``collector.transport``
+
+    """
+    if config is None:
+        config = get_config()
+    transport = config.collector.transport
+    try:
+        cls = _collectors[transport]
+    except KeyError:
+        raise ValueError('unknown transport %r' % (transport))
+    return cls(get_listener(config.collector.addr, config.collector.port,
+                            transport, reuse_port))
+
+
+class SinkQueue(object):
+    """ Hand messages to ``sink`` from a bounded queue served by worker
+    greenlets, so a slow sink holds up neither receiving nor the other sinks
+
+    Once ``size`` batches of messages are queued ``overflow`` decides what
+    happens to the next one, ``drop_oldest`` and ``drop_newest`` drop
+    messages and count them, ``block`` makes the receiving greenlet wait.
+    ``stats`` reports the queue depth, what was processed and dropped and
+    the latency from queueing to being handled by the sink.
+
+    """
+    _overflow_policies = ('drop_oldest', 'drop_newest', 'block')
+
+    def __init__(self, sink, config):
+        if config['overflow'] not in self.__class__._overflow_policies:
+            raise ValueError('unknown overflow policy %r' %
+                             (config['overflow']))
+        self._sink = sink
+        self._queue = gevent.queue.Queue(config['size'])
+        self._overflow = config['overflow']
+        self._num_workers = config['workers']
+        self._drain_timeout = config['drain_timeout']
+        self._workers = []
+        self._busy = 0
+        self._processed = 0
+        self._dropped = 0
+        self._errors = 0
+        self._latency = Histogram()
+
+    @property
+    def sink(self):
+        return self._sink
+
+    @property
+    def stats(self):
+        return {'depth': self._queue.qsize(),
+                'processed': self._processed,
+                'dropped': self._dropped,
+                'errors': self._errors,
+                'latency': {'p50': self._latency.percentile(50),
+                            'p99': self._latency.percentile(99),
+                            'max': self._latency.max}}
+
+    def _put(self, msgs):
+        if not self._workers:
+            self._workers = [gevent.spawn(self._run)
+                             for _ in xrange(self._num_workers)]
+        item = (time.time(), msgs)
+        if self._overflow == 'block':
+            self._queue.put(item)
+            return
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except gevent.queue.Full:
+                if self._overflow == 'drop_newest':
+                    self._dropped += len(msgs)
+                    return
+            try:
+                self._dropped += len(self._queue.get_nowait()[1])
+            except gevent.queue.Empty:
+                pass
+
+    def handle(self, data, address):
+        self._put([(data, address)])
+
+    def handle_batch(self, batch):
+        self._put(batch)
+
+    def _run(self):
+        while True:
+            queued, msgs = self._queue.get()
+            self._busy += 1
+            try:
+                self._sink.handle_batch(msgs)
+            except Exception:
+                self._errors += 1
+                logging.exception('sink %s failed to handle a batch of %d '
+                                  'messages' %
+                                  (self._sink.__class__.__name__, len(msgs)))
+            finally:
+                self._busy -= 1
+            self._processed += len(msgs)
+            self._latency.add((time.time() - queued) * 1000, len(msgs))
+
+    def close(self):
+        """ Give the workers up to ``drain_timeout`` seconds to empty the
+        queue, then close the sink
+
+        """
+        deadline = time.time() + self._drain_timeout
+        while self._workers and (self._queue.qsize() > 0 or self._busy) and \
+              time.time() < deadline:
+            gevent.sleep(.05)
+        if self._queue.qsize() > 0:
+            logging.warning('dropping %d queued batches for sink %s' %
+                            (self._queue.qsize(),
+                             self._sink.__class__.__name__))
+        gevent.killall(self._workers)
+        self._workers = []
+        self._sink.close()
+
+
+class BaseCollector(object):
+    """ Decode frames and hand the messages they hold to the sinks, shared by
+    the datagram and stream collectors
+
+    """
+    def __init__(self):
+        config = get_config().collector
         self._sinks = []
-        self._session = get_config().collector.session
+        self._session = config.session
+        self._recv_size = config.recv_size
+        self._reassembler = Reassembler(config.reassembly.max_pending,
+                                        config.reassembly.max_bytes,
+                                        config.reassembly.timeout)
+        self._counters = {'frames': 0,
+                          'bytes': 0,
+                          'messages': 0,
+                          'undecodable': 0,
+                          'sink_errors': 0}
+        self._dispatch_latency = Histogram()
 
     @property
     def session(self):
         return self._session
 
+    @property
+    def stats(self):
+        """ Counters of frames, bytes and messages received, frames that
+        couldn't be decoded and sink failures, the latency in ms of decoding
+        and dispatching a frame (or batch), reassembly counters and the stats
+        of each sink and its queue
+
+        """
+        stats = dict(self._reassembler.stats, pending=len(self._reassembler))
+        stats.update(self._counters)
+        stats['dispatch_latency'] = {
+            'p50': self._dispatch_latency.percentile(50),
+            'p99': self._dispatch_latency.percentile(99),
+            'max': self._dispatch_latency.max
+        }
+        stats['sinks'] = {}
+        for sink in self._sinks:
+            sink_stats = {}
+            if isinstance(sink, SinkQueue):
+                sink_stats.update(sink.stats)
+                sink = sink.sink
+            sink_stats.update(sink.stats)
+            stats['sinks'][sink.__class__.__name__] = sink_stats
+        return stats
+
     def add_sink(self, sink):
+        """ Add a sink, behind a :class:`SinkQueue` when
+        ``collector.sink_queue`` is enabled, with settings overridden per
+        sink class name in ``collector.sink_queue.overrides``
+
+        """
+        config = get_config().collector.sink_queue
+        if config.enabled:
+            settings = dict(config)
+            settings.pop('overrides', None)
+            settings.update(config.overrides.get(sink.__class__.__name__, {}))
+            sink = SinkQueue(sink, settings)
         self._sinks.append(sink)
 
-    def handle(self, data, address):
-        logging.debug('processing data from %s:\n%s' % (str(address), data))
+    def close_sinks(self):
+        for sink in self._sinks:
+            try:
+                sink.close()
+            except Exception:
+                logging.exception('error closing sink %s' %
+                                  (sink.__class__.__name__))
+
+    def _decode(self, data, address=None):
+        """ Decode a frame into a list of messages, anything that can't be
+        decoded is passed through as is
+
+        """
         if isinstance(data, basestring):
+            self._counters['frames'] += 1
+            self._counters['bytes'] += len(data)
+            if is_fragment(data):
+                data = self._reassembler.add(data, address)
+                if data is None:
+                    return []
             try:
-                if data.strip()[0] == '{':
-                    data = loads(data)
-                    data.update({'session': self._session})
-            except (ValueError, IndexError):
-                pass
+                msgs = decode(data)
+            except ValueError:
+                self._counters['undecodable'] += 1
+                return [data]
+            self._counters['messages'] += len(msgs)
+            for msg in msgs:
+                if isinstance(msg, dict):
+                    msg.update({'session': self._session})
+            return msgs
+        return [data]
+
+    def dispatch(self, data, address):
+        logging.debug('processing data from %s:\n%s' % (str(address), data))
+        start = time.time()
+        for msg in self._decode(data, address):
+            for sink in self._sinks:
+                try:
+                    sink.handle(msg, address)
+                except Exception:
+                    self._counters['sink_errors'] += 1
+                    logging.exception('sink %s failed to handle data <%s>' %
+                                      (sink.__class__.__name__, str(msg)))
+        self._dispatch_latency.add((time.time() - start) * 1000)
+
+    def dispatch_batch(self, batch):
+        """ Decode a list of ``(data, address)`` pairs and hand all the
+        messages they hold to each sink at once
+
+        """
+        start = time.time()
+        msgs = []
+        for data, address in batch:
+            msgs.extend([(msg, address)
+                         for msg in self._decode(data, address)])
+        if not msgs:
+            return
         for sink in self._sinks:
             try:
-                sink.handle(data, address)
+                sink.handle_batch(msgs)
             except Exception:
-                logging.exception('sink %s failed to handle data <%s>' %
-                                  (sink.__class__.__name__, str(data)))
+                self._counters['sink_errors'] += 1
+                logging.exception('sink %s failed to handle a batch of %d '
+                                  'messages' %
+                                  (sink.__class__.__name__, len(msgs)))
+        self._dispatch_latency.add((time.time() - start) * 1000)
+
+
+class Collector(BaseCollector, DatagramServer):
+    """ Collect datagrams, when ``collector.recv_batch`` is enabled the
+    socket is drained up to ``size`` datagrams at a time and each batch is
+    handled by a single greenlet and handed to the sinks in one go
+
+    """
+    def __init__(self, listener, spawn='default'):
+        batch_config = get_config().collector.recv_batch
+        self._batch_size = batch_config.size if batch_config.enabled else 0
+        handle = self.handle_batch if self._batch_size else self.handle
+        DatagramServer.__init__(self, listener, handle, spawn)
+        BaseCollector.__init__(self)
+
+    def do_read(self):
+        # the stock implementation reads at most 8192 bytes, truncating
+        # anything larger
+        if not self._batch_size:
+            try:
+                return self._socket.recvfrom(self._recv_size)
+            except socket.error, e:
+                if e.args[0] == EWOULDBLOCK:
+                    return
+                raise
+        batch = []
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._socket.recvfrom(self._recv_size))
+            except socket.error, e:
+                if e.args[0] == EWOULDBLOCK:
+                    break
+                if not batch:
+                    raise
+                logging.debug('error draining datagrams', exc_info=True)
+                break
+        if not batch:
+            return
+        return (batch,)
+
+    def handle(self, data, address):
+        self.dispatch(data, address)
+
+    def handle_batch(self, batch):
+        self.dispatch_batch(batch)
+
+
+class StreamCollector(BaseCollector, StreamServer):
+    """ Collect length prefixed frames from pushers using the stream
+    transport, a connection sending a frame over ``max_frame_size`` is closed
+
+    """
+    def __init__(self, listener, spawn='default'):
+        StreamServer.__init__(self, listener, self.handle, spawn=spawn)
+        BaseCollector.__init__(self)
+        self._max_frame_size = get_config().collector.max_frame_size
+        self._connections = set()
+
+    def close(self):
+        StreamServer.close(self)
+        # let pushers know right away rather than have them write into
+        # connections no one reads anymore
+        for sock in list(self._connections):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    def handle(self, sock, address):
+        self._connections.add(sock)
+        reader = sock.makefile('rb', self._recv_size)
+        try:
+            while True:
+                prefix = reader.read(LENGTH_PREFIX.size)
+                if len(prefix) < LENGTH_PREFIX.size:
+                    break
+                length, = LENGTH_PREFIX.unpack(prefix)
+                if length > self._max_frame_size:
+                    logging.warning('closing connection from %s, %d byte '
+                                    'frame is too large' % (address, length))
+                    break
+                frame = reader.read(length)
+                if len(frame) < length:
+                    break
+                self.dispatch(frame, address)
+        except socket.error:
+            logging.debug('error reading from %s' % (address,),
+                          exc_info=True)
+        finally:
+            self._connections.discard(sock)
+            reader.close()
+            sock.close()
+
 
+_collectors = {'datagram': Collector, 'stream': StreamCollector}
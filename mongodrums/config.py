@@ -5,24 +5,121 @@ CONFIG_NAMESPACE = '__mongodrums__'
 ConfigManager().load(
     {
         'instrument': {
+            'modes': ['explain'],
             'sample_frequency': 0.1,
-            'filter_packages': ['pymongo', 'mongoengine', 'mongodrums']
+            'filter_packages': ['pymongo', 'mongoengine', 'mongodrums'],
+            'explain_executor': {
+                'workers': 1,
+                'queue_size': 1000,
+                'drop_policy': 'newest'
+            },
+            'explain_cache': {
+                'size': 1000,
+                'ttl': 300,
+                'stats_interval': 0
+            },
+            'sampler': {
+                'type': 'random',
+                'max_shapes': 10000,
+                'window': 60,
+                'first_n': 10,
+                'decay': 0.5,
+                'min_frequency': 0.001,
+                'rate': 1.0,
+                'burst': 10,
+                'overrides': {}
+            },
+            'timing': {
+                'sample_frequency': 1.0
+            }
         },
         'collector': {
             'addr': '127.0.0.1',
             'port': 63333,
             'session': None,
-            'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_profile'
+            'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_profile',
+            'transport': 'datagram',
+            'workers': 1,
+            'recv_size': 65535,
+            'recv_batch': {
+                'enabled': False,
+                'size': 64
+            },
+            'sink_queue': {
+                'enabled': False,
+                'size': 10000,
+                'workers': 1,
+                'overflow': 'drop_oldest',
+                'drain_timeout': 10,
+                'overrides': {}
+            },
+            'stats': {
+                'enabled': False,
+                'addr': '127.0.0.1',
+                'port': 63334,
+                'log_interval': 60,
+                'rate_interval': 10
+            },
+            'max_frame_size': 16 * 1024 * 1024,
+            'reassembly': {
+                'max_pending': 1000,
+                'max_bytes': 16 * 1024 * 1024,
+                'timeout': 5
+            }
         },
         'pusher': {
             'addr': '127.0.0.1',
-            'port': 63333
+            'port': 63333,
+            'format': 'json',
+            'transport': 'datagram',
+            'stream': {
+                'buffer_size': 1024 * 1024,
+                'timeout': 5,
+                'reconnect_min': .1,
+                'reconnect_max': 30
+            },
+            'compression': {
+                'enabled': False,
+                'threshold': 1024,
+                'level': 6
+            },
+            'fragment_size': 8192,
+            'spool': {
+                'enabled': False,
+                'path': None,
+                'size': 16 * 1024 * 1024,
+                'rate': 1000,
+                'retry_interval': 1
+            },
+            'aggregate': {
+                'enabled': False,
+                'interval': 10,
+                'max_keys': 10000,
+                'max_entries_per_message': 20
+            },
+            'batch': {
+                'enabled': False,
+                'max_size': 1400,
+                'interval': 0.05
+            }
         },
         'index_profile_sink': {
-            'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_profile'
+            'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_profile',
+            'aggregate': {
+                'enabled': False,
+                'interval': 5,
+                'max_keys': 10000
+            }
         },
         'query_profile_sink': {
             'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_profile'
+        },
+        'sink_storage': {
+            'write_behind': {
+                'enabled': False,
+                'max_ops': 1000,
+                'interval': 1
+            }
         }
     }, False, CONFIG_NAMESPACE)
 
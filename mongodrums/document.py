@@ -78,9 +78,10 @@ class SessionDocument(Document):
 class QueryDocument(EmbeddedDocument):
     def __init__(self):
         self._query = None
+        self._fingerprint = None
         self._covered = None
         self._count = None
-        self._durations = None
+        self._latency = None
 
     def _canonicalize_query(self, query):
         pass
@@ -93,6 +94,18 @@ class QueryDocument(EmbeddedDocument):
     def query(self, query):
         self._query = self._canonicalize_query(query)
 
+    @property
+    def fingerprint(self):
+        """ The 64 bit fingerprint of the query's shape, see
+        :mod:`mongodrums.util.shape`
+
+        """
+        return self._fingerprint
+
+    @fingerprint.setter
+    def fingerprint(self, fingerprint):
+        self._fingerprint = fingerprint
+
     @property
     def covered(self):
         return self._covered
@@ -110,12 +123,22 @@ class QueryDocument(EmbeddedDocument):
         self._count = count
 
     @property
-    def durations(self):
-        return self._durations
+    def latency(self):
+        """ A :class:`~mongodrums.util.histogram.Histogram` of the query's
+        latencies in ms
+
+        """
+        return self._latency
 
-    @durations.setter
-    def durations(self, durations):
-        self._durations = durations
+    @latency.setter
+    def latency(self, latency):
+        self._latency = latency
+
+    def to_document(self):
+        doc = self._to_document()
+        if self._latency is not None:
+            doc['latency'] = self._latency.to_document()
+        return doc
 
 
 class IndexProfileDocument(Document):
@@ -174,6 +197,8 @@ class QueryProfileDocument(Document):
         self._source = None
         self._function = None
         self._explain = None
+        self._fingerprint = None
+        self._count = None
 
     @property
     def session(self):
@@ -223,3 +248,18 @@ class QueryProfileDocument(Document):
     def explain(self, explain):
         self._explain = explain
 
+    @property
+    def fingerprint(self):
+        return self._fingerprint
+
+    @fingerprint.setter
+    def fingerprint(self, fingerprint):
+        self._fingerprint = fingerprint
+
+    @property
+    def count(self):
+        return self._count
+
+    @count.setter
+    def count(self, count):
+        self._count = count
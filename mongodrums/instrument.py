@@ -1,6 +1,8 @@
+import copy
 import logging
 import random
 import socket
+import time
 import Queue
 import threading
 import traceback
@@ -9,20 +11,449 @@ from abc import ABCMeta, abstractmethod
 from contextlib import contextmanager
 from functools import partial, update_wrapper
 from types import MethodType
-from weakref import WeakSet
 
 import pymongo
 
-from bson.json_util import dumps
+from bson.errors import InvalidDocument
 from bunch import Bunch
 from pymongo.cursor import Cursor
 from pymongo.errors import OperationFailure
 
 from .config import (
-    configure, get_config, register_update_callback, unregister_update_callback
+    configure, get_config, register_update_callback, unregister_update_callback,
+    update
 )
 from .pusher import push
 from .util import get_source
+from .util.cache import LRUCache
+from .util.shape import get_shape
+
+
+class ExplainExecutor(object):
+    """ Run explains for sampled operations off of the application thread
+
+    Wrappers capture whatever is needed to run an explain (a cloned cursor,
+    the query spec, the call source) and submit it here, the explain itself
+    and the push to the collector happen on a pool of daemon worker threads
+    (greenlets if the process is monkey patched by gevent).
+
+    The queue is bounded by ``instrument.explain_executor.queue_size``, when
+    it is full either the submitted explain (``drop_policy`` ``'newest'``) or
+    the oldest queued explain (``'oldest'``) is dropped and counted. Changes
+    to ``workers`` and ``queue_size`` take effect the next time the executor
+    is started.
+
+    """
+    DROP_NEWEST = 'newest'
+    DROP_OLDEST = 'oldest'
+
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(cls, '_instance'):
+            cls._instance = \
+                super(ExplainExecutor, cls).__new__(cls, *args, **kwargs)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._lock = threading.RLock()
+            self._queue = None
+            self._workers = []
+            self._submitted = 0
+            self._dropped = 0
+            self._completed = 0
+            self._failed = 0
+            self._configure(get_config())
+            register_update_callback(self._configure)
+            self._initialized = True
+
+    def _configure(self, config):
+        self._config = config.instrument.explain_executor
+        self._drop_policy = self._config.drop_policy
+
+    @property
+    def running(self):
+        return self._queue is not None
+
+    @property
+    def stats(self):
+        """ Counters for the executor, these are not synchronized so they are
+        approximate under concurrent use
+
+        """
+        return {'submitted': self._submitted,
+                'dropped': self._dropped,
+                'completed': self._completed,
+                'failed': self._failed,
+                'queued': self._queue.qsize() if self._queue is not None
+                                              else 0}
+
+    def start(self):
+        with self._lock:
+            if self._queue is None:
+                self._submitted = self._dropped = 0
+                self._completed = self._failed = 0
+                self._queue = Queue.Queue(self._config.queue_size)
+                for i in xrange(self._config.workers):
+                    worker = threading.Thread(
+                                target=self._work,
+                                args=(self._queue,),
+                                name='mongodrums-explain-%d' % (i))
+                    worker.daemon = True
+                    worker.start()
+                    self._workers.append(worker)
+
+    def stop(self, timeout=None):
+        with self._lock:
+            queue, self._queue = self._queue, None
+            workers, self._workers = self._workers, []
+        if queue is None:
+            return
+        for _ in workers:
+            queue.put(None)
+        for worker in workers:
+            worker.join(timeout)
+
+    def join(self):
+        """ Block until every explain queued so far has been run
+
+        """
+        queue = self._queue
+        if queue is not None:
+            queue.join()
+
+    def submit(self, func, *args):
+        """ Queue ``func(*args)`` to be run on a worker
+
+        :param func:    the callable to run, it is expected to do its own
+                        pushing
+        :returns:       False if the call (or an older one) had to be dropped
+
+        """
+        queue = self._queue
+        if queue is None:
+            self.start()
+            queue = self._queue
+        self._submitted += 1
+        try:
+            queue.put_nowait((func, args))
+            return True
+        except Queue.Full:
+            pass
+        self._dropped += 1
+        if self._drop_policy == self.__class__.DROP_OLDEST:
+            try:
+                queue.get_nowait()
+                queue.task_done()
+                queue.put_nowait((func, args))
+            except (Queue.Empty, Queue.Full):
+                pass
+        return False
+
+    def _work(self, queue):
+        while True:
+            job = queue.get()
+            try:
+                if job is None:
+                    return
+                func, args = job
+                func(*args)
+                self._completed += 1
+            except Exception:
+                self._failed += 1
+                logging.exception('explain worker failed to run %r' % (func))
+            finally:
+                queue.task_done()
+
+
+def submit_explain(func, *args):
+    return ExplainExecutor().submit(func, *args)
+
+
+class ExplainCache(object):
+    """ Remember the plan chosen for a query shape
+
+    Entries are keyed by ``(database, collection, skeleton)``, the shape's
+    normalized skeleton (see :mod:`mongodrums.util.shape`), and hold a
+    summary of the explain (the cursor and whether the query was covered).
+    While an entry is fresh, sampled operations with the same shape push a
+    lightweight ``occurrence`` message carrying the cached plan instead of
+    running another explain. Size and TTL are set by
+    ``instrument.explain_cache``, a size of 0 disables caching, and a
+    non-zero ``stats_interval`` logs hit/miss counts every that many seconds.
+
+    """
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(cls, '_instance'):
+            cls._instance = \
+                super(ExplainCache, cls).__new__(cls, *args, **kwargs)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._cache = None
+            self._stats_interval = 0
+            self._last_stats = time.time()
+            self._configure(get_config())
+            register_update_callback(self._configure)
+            self._initialized = True
+
+    def _configure(self, config):
+        cache_config = config.instrument.explain_cache
+        if self._cache is None:
+            self._cache = LRUCache(cache_config.size, cache_config.ttl)
+        else:
+            self._cache.resize(cache_config.size, cache_config.ttl)
+        self._stats_interval = cache_config.stats_interval
+
+    @property
+    def enabled(self):
+        return self._cache.size > 0
+
+    @property
+    def stats(self):
+        return {'hits': self._cache.hits,
+                'misses': self._cache.misses,
+                'entries': len(self._cache)}
+
+    @staticmethod
+    def key(database, collection, shape):
+        if shape is None:
+            return None
+        return (database, collection, shape.skeleton)
+
+    @staticmethod
+    def summarize(explain):
+        if 'error' in explain:
+            return None
+        return {'cursor': explain.get('cursor'),
+                'indexOnly': explain.get('indexOnly')}
+
+    def clear(self):
+        self._cache.clear()
+
+    def get(self, key):
+        if key is None or not self.enabled:
+            return None
+        plan = self._cache.get(key)
+        if self._stats_interval > 0:
+            now = time.time()
+            if now - self._last_stats >= self._stats_interval:
+                self._last_stats = now
+                logging.info('explain cache stats: %r' % (self.stats))
+        return plan
+
+    def put(self, key, explain):
+        if key is None or not self.enabled:
+            return
+        plan = self.__class__.summarize(explain)
+        if plan is not None:
+            self._cache.put(key, plan)
+
+
+class Sampler(object):
+    """ Decide whether an operation should be sampled
+
+    Settings come from ``instrument.sampler`` with ``instrument.sample_frequency``
+    as the base rate, ``instrument.sampler.overrides`` maps a namespace
+    (``'<database>.<collection>'``) to settings that replace the defaults for
+    that collection.
+
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, config):
+        self._lock = threading.Lock()
+        self.configure(config)
+
+    def configure(self, config):
+        self._config = config.instrument
+        self._overrides = config.instrument.sampler.get('overrides') or {}
+        self._settings = {}
+
+    def _get_settings(self, namespace):
+        try:
+            return self._settings[namespace]
+        except KeyError:
+            settings = dict(self._config.sampler)
+            settings.pop('overrides', None)
+            settings['sample_frequency'] = self._config.sample_frequency
+            settings.update(self._overrides.get(namespace, {}))
+            self._settings[namespace] = settings
+            return settings
+
+    @abstractmethod
+    def sample(self, collection, spec):
+        """ Return True if an operation should be sampled
+
+        :param collection:  the :class:`~pymongo.collection.Collection` the
+                            operation is run against
+        :param spec:        the query spec of the operation
+
+        """
+        pass
+
+    def sample_shape(self, collection, spec):
+        """ Like :meth:`sample`, along with the :class:`Shape` of ``spec``
+        if the sampler worked it out, None otherwise, so the caller needn't
+        again
+
+        """
+        return self.sample(collection, spec), None
+
+    def effective_rates(self):
+        """ The rate operations are being sampled at, keyed by namespace
+
+        """
+        return dict([(ns, s['sample_frequency'])
+                     for ns, s in self._settings.items()])
+
+
+class RandomSampler(Sampler):
+    """ Sample each operation with probability ``sample_frequency``
+
+    """
+    def sample(self, collection, spec):
+        settings = self._get_settings(collection.full_name)
+        return random.random() < settings['sample_frequency']
+
+
+class _ShapeSampler(Sampler):
+    """ Base for samplers keeping state per ``(namespace, skeleton)``
+
+    At most ``max_shapes`` shapes are tracked (least recently seen shapes are
+    forgotten first) and per shape counts are reset every ``window`` seconds.
+
+    """
+    def configure(self, config):
+        super(_ShapeSampler, self).configure(config)
+        max_shapes = config.instrument.sampler.max_shapes
+        if getattr(self, '_shapes', None) is None:
+            self._shapes = LRUCache(max_shapes)
+        else:
+            self._shapes.resize(max_shapes)
+
+    @abstractmethod
+    def _sample_shape(self, state, settings, now):
+        pass
+
+    def sample(self, collection, spec):
+        return self.sample_shape(collection, spec)[0]
+
+    def sample_shape(self, collection, spec):
+        namespace = collection.full_name
+        try:
+            shape = get_shape(spec)
+        except InvalidDocument:
+            shape = None
+        key = (namespace, shape.skeleton if shape is not None else None)
+        settings = self._get_settings(namespace)
+        now = time.time()
+        with self._lock:
+            state = self._shapes.get(key)
+            if state is None:
+                state = {'window_start': now, 'seen': 0, 'sampled': 0,
+                         'rate': None, 'tokens': settings['burst'],
+                         'updated': now}
+                self._shapes.put(key, state)
+            elif now - state['window_start'] >= settings['window']:
+                if state['seen'] > 0:
+                    state['rate'] = state['sampled'] / float(state['seen'])
+                state.update({'window_start': now, 'seen': 0, 'sampled': 0})
+            sampled = self._sample_shape(state, settings, now)
+            state['seen'] += 1
+            if sampled:
+                state['sampled'] += 1
+        return sampled, shape
+
+    def effective_rates(self):
+        """ The rate each shape is being sampled at, keyed by
+        ``(namespace, skeleton)``. This is the rate over the current window or
+        the previous one if nothing has been seen yet in this window
+
+        """
+        rates = {}
+        for key, state in self._shapes.items():
+            if state['seen'] > 0:
+                rates[key] = state['sampled'] / float(state['seen'])
+            else:
+                rates[key] = state['rate']
+        return rates
+
+
+class TokenBucketSampler(_ShapeSampler):
+    """ Sample up to ``rate`` operations per second per shape, allowing
+    bursts of up to ``burst`` operations
+
+    """
+    def _sample_shape(self, state, settings, now):
+        state['tokens'] = min(settings['burst'],
+                              state['tokens'] +
+                              (now - state['updated']) * settings['rate'])
+        state['updated'] = now
+        if state['tokens'] >= 1:
+            state['tokens'] -= 1
+            return True
+        return False
+
+
+class FirstNSampler(_ShapeSampler):
+    """ Sample the first ``first_n`` operations per shape in each window,
+    after that sample at ``sample_frequency`` decayed by ``decay`` for every
+    further ``first_n`` operations seen, but never below ``min_frequency``
+
+    """
+    def _sample_shape(self, state, settings, now):
+        first_n = settings['first_n']
+        if state['seen'] < first_n:
+            return True
+        steps = (state['seen'] - first_n) / max(first_n, 1) + 1
+        frequency = max(settings['min_frequency'],
+                        settings['sample_frequency'] *
+                        settings['decay'] ** steps)
+        return random.random() < frequency
+
+
+_samplers = {'random': RandomSampler,
+             'token_bucket': TokenBucketSampler,
+             'first_n': FirstNSampler}
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def register_sampler(name, sampler_cls):
+    """ Make a :class:`Sampler` subclass selectable through
+    ``instrument.sampler.type``
+
+    """
+    _samplers[name] = sampler_cls
+
+
+def get_sampler(config=None):
+    """ Get the process wide sampler, (re)configured from ``config``
+
+    """
+    global _sampler
+    config = get_config() if config is None else config
+    sampler_cls = _samplers[config.instrument.sampler.type]
+    with _sampler_lock:
+        if type(_sampler) is not sampler_cls:
+            _sampler = sampler_cls(config)
+        else:
+            _sampler.configure(config)
+        return _sampler
+
+
+def sample_rates():
+    return get_sampler().effective_rates()
+
+
+# tracks the instrumented collection operation running on this thread (or
+# greenlet), pymongo implements several operations on top of find, and
+# explains running on an executor worker so their own commands aren't
+# instrumented
+_local = threading.local()
 
 
 class Wrapper(object):
@@ -38,11 +469,19 @@ class Wrapper(object):
     def _configure(self, config):
         self._frequency = config.instrument.sample_frequency
         self._filter_packages = config.instrument.filter_packages
+        self._sampler = get_sampler(config)
+        self._explain_enabled = 'explain' in config.instrument.modes
+        self._timing_enabled = 'timing' in config.instrument.modes
+        self._timing_frequency = config.instrument.timing.sample_frequency
+
+    def _sample_timing(self):
+        return self._timing_enabled and \
+               random.random() < self._timing_frequency
 
     def __get__(self, owner, owner_type):
         if owner is None:
             return self
-        return partial(self, owner)
+        return MethodType(self, owner, owner_type)
 
     @staticmethod
     def _explain(curs):
@@ -57,6 +496,82 @@ class Wrapper(object):
                               (''.join(traceback.format_stack())))
         return explain
 
+    @classmethod
+    def _push_explain(cls, curs, msg, cache_key=None):
+        _local.function = msg['function']
+        try:
+            msg['explain'] = cls._explain(curs)
+        finally:
+            _local.function = None
+        ExplainCache().put(cache_key, msg['explain'])
+        push(msg)
+
+    @staticmethod
+    def _add_shape(msg, spec, shape=None):
+        """ Ship the shape of ``spec`` with ``msg`` so neither the pusher's
+        aggregator nor the collector has to work it out again, ``shape`` is
+        the one the sampler already worked out if any
+
+        :returns:   the shape, None if ``spec`` has none
+
+        """
+        if shape is None:
+            try:
+                shape = get_shape(spec)
+            except InvalidDocument:
+                return None
+        msg.update({'shape': shape.skeleton,
+                    'fingerprint': shape.fingerprint})
+        return shape
+
+    @classmethod
+    def _sample(cls, func, database, collection, spec, source, curs_factory,
+                shape=None):
+        """ Report a sampled operation, either as an ``occurrence`` of a
+        shape whose plan is cached or by queueing an explain of what
+        ``curs_factory`` makes of a copy of ``spec``
+
+        """
+        msg = {'type': 'explain',
+               'function': func,
+               'database': database,
+               'collection': collection,
+               'query': spec,
+               'source': source}
+        shape = cls._add_shape(msg, spec, shape)
+        explain_cache = ExplainCache()
+        cache_key = explain_cache.key(database, collection, shape)
+        plan = explain_cache.get(cache_key)
+        if plan is not None:
+            msg.update({'type': 'occurrence', 'explain': plan})
+            push(msg)
+        else:
+            # the explain runs later on a worker, by when the application
+            # may have reused or changed its query
+            msg['query'] = spec = copy.deepcopy(spec)
+            submit_explain(cls._push_explain, curs_factory(spec), msg,
+                           cache_key)
+
+    @classmethod
+    def _push_timing(cls, func, database, collection, spec, source,
+                     shape=None, **timings):
+        """ Push a ``timing`` message, ``timings`` holds ``total_ms`` and
+        whichever of ``first_batch_ms``, ``docs`` and ``getmores`` apply
+
+        """
+        msg = {'type': 'timing',
+               'function': func,
+               'database': database,
+               'collection': collection,
+               'query': spec,
+               'source': source}
+        msg.update(timings)
+        try:
+            cls._add_shape(msg, spec, shape)
+            push(msg)
+        except Exception:
+            logging.exception('exception pushing timing data for %s' % (func))
+
     @abstractmethod
     def __call__(self, *args, **kwargs):
         pass
@@ -82,8 +597,18 @@ class Wrapper(object):
 
 
 class _CursorMethodWrapper(Wrapper):
-    _ids = WeakSet()
-    _ids_lock = threading.RLock()
+    """ Wrap a cursor method that sends a query to the server
+
+    Sampled cursors carry their sample state in ``_mongodrums``, which
+    defaults to ``None`` on the class. Rather than installing the wrapper
+    object itself, :meth:`wrap` installs a plain function (see
+    :meth:`_make_method`) so an unsampled cursor costs a single attribute
+    check: no partial, no lock and no tracking set.
+
+    The state is a dict holding the query ``spec``, ``explain`` if an explain
+    still has to be reported and ``timing`` if the cursor is being timed.
+
+    """
     _method_name = None
 
     def __new__(cls, *args, **kwargs):
@@ -91,56 +616,173 @@ class _CursorMethodWrapper(Wrapper):
             raise RuntimeError('_method_name must be declared')
         return super(_CursorMethodWrapper, cls).__new__(cls, *args, **kwargs)
 
-    @classmethod
-    def track_cursor(cls, cursor):
-        with cls._ids_lock:
-            cls._ids.add(cursor)
+    def __init__(self, func):
+        super(_CursorMethodWrapper, self).__init__(func)
+        self.method = self._make_method()
+        self.method._mongodrums_wrapper = self
+
+    def _make_method(self):
+        func = self._func
+        call_sampled = self._call_sampled
+
+        def method(self_, *args, **kwargs):
+            if self_._mongodrums is not None:
+                return call_sampled(self_, *args, **kwargs)
+            return func(self_, *args, **kwargs)
+
+        return update_wrapper(method, func)
+
+    def _call_sampled(self, self_, *args, **kwargs):
+        state = self_.__dict__.get('_mongodrums')
+        if state is None:
+            return self._func(self_, *args, **kwargs)
+        # dict.pop is atomic, so exactly one terminator call claims the
+        # explain without taking a lock
+        if state.pop('explain', False):
+            self._report(self_, state)
+        timing = state.get('timing')
+        if timing is None:
+            self_.__dict__.pop('_mongodrums', None)
+            return self._func(self_, *args, **kwargs)
+        return self._timed_call(self_, state, *args, **kwargs)
+
+    def _report(self, self_, state):
+        # clone deep copies the cursor's spec
+        try:
+            self.__class__._sample(state['function'],
+                                   self_.collection.database.name,
+                                   self_.collection.name,
+                                   state['spec'],
+                                   get_source(self._filter_packages, up=4),
+                                   lambda spec: self_.clone(),
+                                   state.get('shape'))
+        except Exception:
+            logging.exception('exception sampling find')
+
+    def _timed_call(self, self_, state, *args, **kwargs):
+        start = time.time()
+        try:
+            return self._func(self_, *args, **kwargs)
+        finally:
+            elapsed = (time.time() - start) * 1000
+            state['timing'].update({'first_batch_ms': elapsed,
+                                    'total_ms': elapsed})
+            self._finish_timing(self_, state)
+
+    def _finish_timing(self, self_, state):
+        self_.__dict__.pop('_mongodrums', None)
+        timing = state['timing']
+        self.__class__._push_timing('find',
+                                    self_.collection.database.name,
+                                    self_.collection.name,
+                                    state['spec'],
+                                    timing['source'],
+                                    shape=state.get('shape'),
+                                    terminator=self.__class__._method_name,
+                                    first_batch_ms=timing['first_batch_ms'],
+                                    total_ms=timing['total_ms'],
+                                    docs=timing['docs'],
+                                    getmores=timing['getmores'])
 
     def __call__(self, self_, *args, **kwargs):
-        with self.__class__._ids_lock:
-            tracking = self_ in self.__class__._ids
-        if tracking:
-            with self.__class__._ids_lock:
-                assert(self_ in self.__class__._ids)
-                self.__class__._ids.discard(self_)
-            explain = self.__class__._explain(self_)
-            try:
-                push({'type': 'explain',
-                      'function': 'find',
-                      'database': self_.collection.database.name,
-                      'collection': self_.collection.name,
-                      'query': dumps(self_._mongodrums['spec'],
-                                     sort_keys=True),
-                      'explain': explain,
-                      'source': get_source(self._filter_packages)})
-            except Exception:
-                logging.exception('exception pushing explain data for find')
-            finally:
-                del self_.__dict__['_mongodrums']
-        return self._func(self_, *args, **kwargs)
+        return self.method(self_, *args, **kwargs)
+
+    @classmethod
+    def _get_installed(cls):
+        meth = pymongo.cursor.Cursor.__dict__[cls._method_name]
+        wrapper = getattr(meth, '_mongodrums_wrapper', None)
+        return meth, wrapper if isinstance(wrapper, cls) else None
 
     @classmethod
     def wrap(cls):
         with cls._lock:
-            meth = getattr(pymongo.cursor.Cursor, cls._method_name)
-            if not isinstance(meth, cls):
-                meth = cls(meth)
-                setattr(pymongo.cursor.Cursor, cls._method_name, meth)
-                register_update_callback(meth._configure)
-        return meth
+            meth, wrapper = cls._get_installed()
+            if wrapper is None:
+                wrapper = cls(meth)
+                # unsampled cursors fall through to this class level default
+                pymongo.cursor.Cursor._mongodrums = None
+                setattr(pymongo.cursor.Cursor, cls._method_name,
+                        wrapper.method)
+                register_update_callback(wrapper._configure)
+        return wrapper
 
     @classmethod
     def unwrap(cls):
         with cls._lock:
-            meth = getattr(pymongo.cursor.Cursor, cls._method_name)
-            if isinstance(meth, cls):
-                unregister_update_callback(meth._configure)
-                setattr(pymongo.cursor.Cursor, cls._method_name, meth._func)
+            meth, wrapper = cls._get_installed()
+            if wrapper is not None:
+                unregister_update_callback(wrapper._configure)
+                setattr(pymongo.cursor.Cursor, cls._method_name,
+                        wrapper._func)
 
 
 class _CursorNextWrapper(_CursorMethodWrapper):
     _method_name = 'next'
 
+    def _make_method(self):
+        func = self._func
+        call_sampled = self._call_sampled
+
+        # next is called once per document, keep it free of *args/**kwargs
+        def next(self_):
+            if self_._mongodrums is not None:
+                return call_sampled(self_)
+            return func(self_)
+
+        return update_wrapper(next, func)
+
+    def _timed_call(self, self_, state):
+        timing = state['timing']
+        # the count of documents received only moves when the call went to
+        # the server, for the first call that's the query itself and a
+        # getmore after that
+        retrieved = self_.retrieved
+        start = time.time()
+        try:
+            doc = self._func(self_)
+        except StopIteration:
+            if timing['start'] is not None:
+                timing['total_ms'] = (time.time() - timing['start']) * 1000
+            else:
+                timing['first_batch_ms'] = timing['total_ms'] = \
+                    (time.time() - start) * 1000
+            self._finish_timing(self_, state)
+            raise
+        now = time.time()
+        if timing['start'] is None:
+            timing['start'] = start
+            timing['first_batch_ms'] = (now - start) * 1000
+        elif self_.retrieved != retrieved:
+            timing['getmores'] += 1
+        timing['docs'] += 1
+        if not self_.alive:
+            timing['total_ms'] = (now - timing['start']) * 1000
+            self._finish_timing(self_, state)
+        return doc
+
+
+class _CursorCloseWrapper(_CursorMethodWrapper):
+    """ Push the timing of a cursor closed before it was exhausted, covering
+    what it fetched up to then
+
+    A cursor that is dropped without being closed or exhausted isn't
+    reported: pymongo kills those from ``__del__``, where pushing isn't safe.
+
+    """
+    _method_name = 'close'
+
+    def _call_sampled(self, self_, *args, **kwargs):
+        # a cursor closed before its first call never ran its query, so
+        # there's nothing to explain
+        state = self_.__dict__.pop('_mongodrums', None)
+        try:
+            return self._func(self_, *args, **kwargs)
+        finally:
+            timing = state.get('timing') if state is not None else None
+            if timing is not None and timing['start'] is not None:
+                timing['total_ms'] = (time.time() - timing['start']) * 1000
+                self._finish_timing(self_, state)
+
 
 class _CursorCountWrapper(_CursorMethodWrapper):
     _method_name = 'count'
@@ -150,8 +792,8 @@ class _CursorDistinctWrapper(_CursorMethodWrapper):
     _method_name = 'distinct'
 
 
-_cursor_terminators = [_CursorNextWrapper, _CursorCountWrapper,
-                       _CursorDistinctWrapper]
+_cursor_terminators = [_CursorNextWrapper, _CursorCloseWrapper,
+                       _CursorCountWrapper, _CursorDistinctWrapper]
 
 
 class FindWrapper(Wrapper):
@@ -161,10 +803,31 @@ class FindWrapper(Wrapper):
 
     def __call__(self, self_, *args, **kwargs):
         curs = self._func(self_, *args, **kwargs)
-        if random.random() < self._frequency:
+        # database commands are sent as queries on $cmd, they aren't queries
+        # of the application's
+        if self_.name.startswith('$cmd'):
+            return curs
+        spec = args[0] if len(args) > 0 else {}
+        # when called from another instrumented operation (find_one, count...)
+        # the explain is attributed to it and it does its own timing
+        outer = getattr(_local, 'function', None)
+        state = None
+        if self._explain_enabled:
+            sampled, shape = self._sampler.sample_shape(self_, spec)
+            if sampled:
+                state = {'spec': spec, 'explain': True, 'shape': shape,
+                         'function': outer or 'find'}
+        if outer is None and self._sample_timing():
+            state = state or {'spec': spec, 'function': 'find'}
+            state['timing'] = {'source': get_source(self._filter_packages),
+                               'start': None,
+                               'first_batch_ms': None,
+                               'total_ms': None,
+                               'docs': 0,
+                               'getmores': 0}
+        if state is not None:
             assert(self._cursor_wrappers is not None)
-            curs._mongodrums = {'spec': args[0] if len(args) > 0 else {}}
-            _CursorMethodWrapper.track_cursor(curs)
+            curs._mongodrums = state
         return curs
 
     @classmethod
@@ -193,20 +856,30 @@ class FindWrapper(Wrapper):
 
 class UpdateWrapper(Wrapper):
     def __call__(self, self_, *args, **kwargs):
-        if random.random() < self._frequency:
-            curs = self_.find(args[0])
-            explain = self.__class__._explain(curs)
-            try:
-                push({'type': 'explain',
-                      'function': 'update',
-                      'database': self_.database.name,
-                      'collection': self_.name,
-                      'query': dumps(args[0], sort_keys=True),
-                      'explain': explain,
-                      'source': get_source(self._filter_packages)})
-            except Exception:
-                logging.exception('exception pushing explain data for update')
-        return self._func(self_, *args, **kwargs)
+        shape = None
+        if self._explain_enabled:
+            sampled, shape = self._sampler.sample_shape(self_, args[0])
+            if sampled:
+                try:
+                    self.__class__._sample('update',
+                                           self_.database.name,
+                                           self_.name,
+                                           args[0],
+                                           get_source(self._filter_packages),
+                                           partial(Cursor, self_),
+                                           shape)
+                except Exception:
+                    logging.exception('exception sampling update')
+        if not self._sample_timing():
+            return self._func(self_, *args, **kwargs)
+        source = get_source(self._filter_packages)
+        start = time.time()
+        ret = self._func(self_, *args, **kwargs)
+        self.__class__._push_timing(
+            'update', self_.database.name, self_.name, args[0], source,
+            shape, total_ms=(time.time() - start) * 1000,
+            docs=ret.get('n') if isinstance(ret, dict) else None)
+        return ret
 
     @classmethod
     def wrap(cls):
@@ -228,21 +901,282 @@ class UpdateWrapper(Wrapper):
                     pymongo.collection.Collection.update._func
 
 
-def start(config=None):
+class _AggregateExplain(object):
+    """ Quacks like a cursor so an aggregation can be explained through
+    :meth:`Wrapper._explain`, the result is reshaped like a query explain
+    (``cursor``, ``indexOnly``, ``millis``) from the plan of the leading
+    ``$cursor`` stage
+
+    """
+    def __init__(self, func, collection, pipeline, kwargs):
+        self._func = func
+        self._collection = collection
+        self._pipeline = pipeline
+        self._kwargs = dict([(k, v) for k, v in kwargs.iteritems()
+                             if k != 'cursor'])
+
+    def explain(self):
+        start = time.time()
+        ret = self._func(self._collection, self._pipeline, explain=True,
+                         **self._kwargs)
+        millis = int((time.time() - start) * 1000)
+        stages = ret.get('stages', [])
+        plan = {}
+        for stage in stages:
+            if '$cursor' in stage:
+                plan = stage['$cursor'].get('plan', {})
+                break
+        return {'cursor': plan.get('cursor', 'BasicCursor'),
+                'indexOnly': plan.get('indexOnly', False),
+                'millis': millis,
+                'stages': stages}
+
+
+class _CollectionMethodWrapper(Wrapper):
+    """ Wrap a :class:`~pymongo.collection.Collection` method
+
+    Every wrapped call gets its shape from :meth:`_get_spec` and, in timing
+    mode, its latency pushed as a ``timing`` message. Methods that can be
+    explained derive from :class:`_ExplainableMethodWrapper` instead.
+
+    While the wrapped method runs, find calls it makes internally are
+    attributed to it and not timed separately. Calls on ``$cmd``, through
+    which pymongo sends database commands, aren't instrumented, as with
+    :class:`FindWrapper`.
+
+    """
+    _method_name = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._method_name is None:
+            raise RuntimeError('_method_name must be declared')
+        return super(_CollectionMethodWrapper, cls).__new__(cls, *args,
+                                                            **kwargs)
+
+    @staticmethod
+    def _get_spec(args, kwargs):
+        spec = args[0] if len(args) > 0 else kwargs.get('spec_or_id')
+        if spec is None:
+            return {}
+        if not isinstance(spec, dict):
+            return {'_id': spec}
+        return spec
+
+    def _sample_explain(self, collection, spec, kwargs):
+        """ :returns:   the shape of ``spec`` if it was worked out
+
+        """
+        return None
+
+    @staticmethod
+    def _count_docs(ret, args, kwargs):
+        return ret.get('n') if isinstance(ret, dict) else None
+
+    def __call__(self, self_, *args, **kwargs):
+        if getattr(_local, 'function', None) is not None or \
+           self_.name.startswith('$cmd'):
+            return self._func(self_, *args, **kwargs)
+        name = self.__class__._method_name
+        spec = self._get_spec(args, kwargs)
+        shape = self._sample_explain(self_, spec, kwargs)
+        timed = self._sample_timing()
+        if timed:
+            source = get_source(self._filter_packages)
+        _local.function = name
+        start = time.time()
+        try:
+            ret = self._func(self_, *args, **kwargs)
+        finally:
+            _local.function = None
+        if timed:
+            self.__class__._push_timing(
+                name, self_.database.name, self_.name, spec, source, shape,
+                total_ms=(time.time() - start) * 1000,
+                docs=self._count_docs(ret, args, kwargs))
+        return ret
+
+    @classmethod
+    def wrap(cls):
+        with cls._lock:
+            meth = pymongo.collection.Collection.__dict__[cls._method_name]
+            if not isinstance(meth, cls):
+                meth = cls(meth)
+                setattr(pymongo.collection.Collection, cls._method_name, meth)
+                register_update_callback(meth._configure)
+        return meth
+
+    @classmethod
+    def unwrap(cls):
+        with cls._lock:
+            meth = pymongo.collection.Collection.__dict__[cls._method_name]
+            if isinstance(meth, cls):
+                unregister_update_callback(meth._configure)
+                setattr(pymongo.collection.Collection, cls._method_name,
+                        meth._func)
+
+
+class _ExplainableMethodWrapper(_CollectionMethodWrapper):
+    """ Wrap a :class:`~pymongo.collection.Collection` method that can be
+    explained, sampled calls feed the same ``explain`` pipeline as
+    :class:`FindWrapper`
+
+    """
+    @abstractmethod
+    def _get_explainable(self, collection, spec, kwargs):
+        """ :returns:   something with an ``explain()`` method for the call
+
+        """
+        pass
+
+    def _sample_explain(self, collection, spec, kwargs):
+        if not self._explain_enabled:
+            return None
+        name = self.__class__._method_name
+        sampled, shape = self._sampler.sample_shape(collection, spec)
+        if sampled:
+            try:
+                self.__class__._sample(name,
+                                       collection.database.name,
+                                       collection.name,
+                                       spec,
+                                       get_source(self._filter_packages,
+                                                  up=3),
+                                       lambda spec: self._get_explainable(
+                                           collection, spec, kwargs),
+                                       shape)
+            except Exception:
+                logging.exception('exception sampling %s' % (name))
+        return shape
+
+
+class FindOneWrapper(_CollectionMethodWrapper):
+    _method_name = 'find_one'
+
+    @staticmethod
+    def _count_docs(ret, args, kwargs):
+        return int(ret is not None)
+
+
+class FindAndModifyWrapper(_CollectionMethodWrapper):
+    _method_name = 'find_and_modify'
+
+    @staticmethod
+    def _get_spec(args, kwargs):
+        return args[0] if len(args) > 0 else kwargs.get('query', {})
+
+    @staticmethod
+    def _count_docs(ret, args, kwargs):
+        return int(ret is not None)
+
+
+class RemoveWrapper(_ExplainableMethodWrapper):
+    _method_name = 'remove'
+
+    def _get_explainable(self, collection, spec, kwargs):
+        return Cursor(collection, spec)
+
+
+class InsertWrapper(_CollectionMethodWrapper):
+    _method_name = 'insert'
+
+    @staticmethod
+    def _get_spec(args, kwargs):
+        docs = args[0] if len(args) > 0 else kwargs.get('doc_or_docs', {})
+        if isinstance(docs, dict):
+            return docs
+        return docs[0] if len(docs) > 0 else {}
+
+    @staticmethod
+    def _count_docs(ret, args, kwargs):
+        return len(ret) if isinstance(ret, list) else 1
+
+
+class AggregateWrapper(_ExplainableMethodWrapper):
+    _method_name = 'aggregate'
+
+    @staticmethod
+    def _get_spec(args, kwargs):
+        return args[0] if len(args) > 0 else kwargs.get('pipeline', [])
+
+    def _get_explainable(self, collection, spec, kwargs):
+        return _AggregateExplain(self._func, collection, spec, kwargs)
+
+    @staticmethod
+    def _count_docs(ret, args, kwargs):
+        if isinstance(ret, dict) and isinstance(ret.get('result'), list):
+            return len(ret['result'])
+        return None
+
+
+class CountWrapper(_CollectionMethodWrapper):
+    _method_name = 'count'
+
+    @staticmethod
+    def _get_spec(args, kwargs):
+        return {}
+
+    @staticmethod
+    def _count_docs(ret, args, kwargs):
+        return ret
+
+
+class DistinctWrapper(_CollectionMethodWrapper):
+    _method_name = 'distinct'
+
+    @staticmethod
+    def _get_spec(args, kwargs):
+        return {}
+
+    @staticmethod
+    def _count_docs(ret, args, kwargs):
+        return len(ret) if isinstance(ret, list) else None
+
+
+_collection_wrappers = [FindOneWrapper, FindAndModifyWrapper, RemoveWrapper,
+                        InsertWrapper, AggregateWrapper, CountWrapper,
+                        DistinctWrapper]
+
+# the modes in effect before start overrode them, put back by stop
+_previous_modes = None
+
+
+def start(config=None, modes=None):
+    """ Start instrumenting pymongo
+
+    :param config:  configuration to load before instrumenting
+    :param modes:   what to collect, any of ``'explain'`` (query plans) and
+                    ``'timing'`` (latency only, no explain), defaults to
+                    ``instrument.modes``, which is restored by :func:`stop`
+
+    """
+    global _previous_modes
     if config is not None:
         configure(config)
+    if modes is not None:
+        if _previous_modes is None:
+            _previous_modes = list(get_config().instrument.modes)
+        update({'instrument': {'modes': list(modes)}})
     FindWrapper.wrap()
     UpdateWrapper.wrap()
+    for wrapper in _collection_wrappers:
+        wrapper.wrap()
 
 
 def stop():
+    global _previous_modes
+    for wrapper in reversed(_collection_wrappers):
+        wrapper.unwrap()
     UpdateWrapper.unwrap()
     FindWrapper.unwrap()
+    ExplainExecutor().stop()
+    if _previous_modes is not None:
+        update({'instrument': {'modes': _previous_modes}})
+        _previous_modes = None
 
 
 @contextmanager
-def instrument(config=None):
-    start(config)
+def instrument(config=None, modes=None):
+    start(config, modes)
     try:
         yield
     finally:
@@ -250,4 +1184,7 @@ def instrument(config=None):
 
 def instrumented():
     return any([isinstance(pymongo.collection.Collection.update, Wrapper),
-                isinstance(pymongo.collection.Collection.find, Wrapper)])
+                isinstance(pymongo.collection.Collection.find, Wrapper)] +
+               [isinstance(getattr(pymongo.collection.Collection,
+                                   wrapper._method_name), Wrapper)
+                for wrapper in _collection_wrappers])
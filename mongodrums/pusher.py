@@ -3,11 +3,366 @@ TODO: add dtls support
 
 """
 
+import atexit
+import itertools
+import logging
+import random
+import select
 import socket
+import threading
+import time
 
-from bson.json_util import dumps
+from collections import deque
 
+from .codec import LENGTH_PREFIX, JSONCodec, compress, fragment, get_codec
 from .config import get_config, register_update_callback
+from .spool import (
+    Spool, SpoolDrainer, SpoolLocked, get_spool_directory, open_spool
+)
+from .util import parse_address
+from .util.histogram import Histogram
+from .util.shape import get_message_shape
+
+
+class Aggregator(object):
+    """ Pre-aggregate sampled operations in the application process
+
+    Operations are counted per ``(database, collection, shape fingerprint,
+    index, source)`` along with a latency histogram (explain ``millis`` or timing
+    ``total_ms``) and flushed as ``aggregate`` messages every ``interval``
+    seconds, or as soon as ``max_keys`` keys are held. The first explain of
+    each shape/plan pair in a flush window is still sent as is, flagged
+    ``aggregated`` so sinks know it is already accounted for.
+
+    """
+    _types = ('explain', 'occurrence', 'timing')
+
+    def __init__(self, send, config):
+        self._send = send
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._seen_plans = set()
+        self._window_start = time.time()
+        self._flush_event = threading.Event()
+        self._stop = threading.Event()
+        self.configure(config)
+        self._thread = threading.Thread(target=self._run,
+                                        name='mongodrums-aggregator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def configure(self, config):
+        self._interval = config.interval
+        self._max_keys = config.max_keys
+        self._max_entries = config.max_entries_per_message
+
+    def add(self, msg):
+        """ Account for ``msg``
+
+        :returns:   True if ``msg`` has been aggregated and need not be sent
+
+        """
+        msg_type = msg.get('type')
+        if msg_type not in self.__class__._types:
+            return False
+        try:
+            shape = get_message_shape(msg)
+        except Exception:
+            return False
+        explain = msg.get('explain') or {}
+        index = explain.get('cursor')
+        if msg_type == 'timing':
+            latency = msg.get('total_ms')
+        elif msg_type == 'explain':
+            latency = explain.get('millis')
+        else:
+            latency = None
+        key = (msg['database'], msg['collection'], shape.fingerprint, index,
+               msg.get('source'))
+        plan = key[:4]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {'query': shape.skeleton,
+                                              'function': msg.get('function'),
+                                              'count': 0,
+                                              'covered': None,
+                                              'latency': Histogram()}
+            entry['count'] += 1
+            if 'indexOnly' in explain:
+                entry['covered'] = explain['indexOnly']
+            if latency is not None:
+                entry['latency'].add(latency)
+            first = msg_type == 'explain' and plan not in self._seen_plans
+            if first:
+                self._seen_plans.add(plan)
+            full = len(self._entries) >= self._max_keys
+        if full:
+            self._flush_event.set()
+        if first:
+            msg['aggregated'] = True
+            return False
+        return True
+
+    def flush(self):
+        with self._lock:
+            entries, self._entries = self._entries, {}
+            self._seen_plans = set()
+            window_start, self._window_start = self._window_start, time.time()
+        if not entries:
+            return
+        docs = []
+        for key, entry in entries.iteritems():
+            database, collection, fingerprint, index, source = key
+            docs.append({'database': database,
+                         'collection': collection,
+                         'function': entry['function'],
+                         'query': entry['query'],
+                         'fingerprint': fingerprint,
+                         'index': index,
+                         'source': source,
+                         'count': entry['count'],
+                         'covered': entry['covered'],
+                         'latency': entry['latency'].to_document()})
+        window_end = time.time()
+        for i in xrange(0, len(docs), self._max_entries):
+            self._send({'type': 'aggregate',
+                        'window_start': window_start,
+                        'window_end': window_end,
+                        'entries': docs[i:i + self._max_entries]})
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._flush_event.wait(self._interval)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('error flushing aggregated operations')
+
+    def stop(self):
+        self._stop.set()
+        self._flush_event.set()
+        self._thread.join()
+        self.flush()
+
+
+class Batcher(object):
+    """ Pack many encoded messages into a single datagram
+
+    Messages already encoded by ``codec`` are framed together and sent once
+    adding another message would take the datagram past ``max_size`` bytes,
+    or every ``interval`` seconds, whichever comes first. A message too large
+    to share a datagram is sent on its own.
+
+    """
+    def __init__(self, send, config, codec=JSONCodec):
+        self._send = send
+        self._codec = codec
+        self._lock = threading.Lock()
+        self._pending = []
+        self._size = 0
+        self._flush_event = threading.Event()
+        self._stop = threading.Event()
+        self.configure(config)
+        self._thread = threading.Thread(target=self._run,
+                                        name='mongodrums-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def configure(self, config):
+        self._max_size = config.max_size
+        self._interval = config.interval
+
+    def _take(self):
+        # called with the lock held
+        payloads, self._pending = self._pending, []
+        self._size = 0
+        return payloads
+
+    def add(self, payload):
+        size = len(payload) + self._codec.message_overhead
+        overhead = self._codec.frame_overhead
+        batches = []
+        with self._lock:
+            if self._pending and \
+               self._size + size + overhead > self._max_size:
+                batches.append(self._take())
+            self._pending.append(payload)
+            self._size += size
+            if self._size + overhead >= self._max_size:
+                batches.append(self._take())
+        for batch in batches:
+            self._send(self._codec.frame(batch))
+
+    def flush(self):
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._send(self._codec.frame(batch))
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._flush_event.wait(self._interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('error flushing batched messages')
+
+    def stop(self):
+        self._stop.set()
+        self._flush_event.set()
+        self._thread.join()
+        self.flush()
+
+
+class StreamSender(object):
+    """ Send frames to the collector over a persistent stream connection
+
+    Frames are length prefixed and queued in a buffer bounded to
+    ``buffer_size`` bytes that a writer thread drains, so sending never blocks
+    the application, a frame that doesn't fit is dropped and counted. A lost
+    connection is retried with exponential backoff between ``reconnect_min``
+    and ``reconnect_max`` seconds, with jitter, and frames stay buffered in
+    the meantime.
+
+    """
+    # most bytes handed to a single send call
+    _write_size = 64 * 1024
+
+    def __init__(self, family, address, config):
+        self._family = family
+        self._address = address
+        self._cond = threading.Condition(threading.Lock())
+        self._frames = deque()
+        self._buffered = 0
+        self._stopped = threading.Event()
+        self.stats = {'sent': 0, 'dropped': 0, 'connects': 0}
+        self.configure(config)
+        self._thread = threading.Thread(target=self._run,
+                                        name='mongodrums-stream')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def address(self):
+        return self._address
+
+    def configure(self, config):
+        self._buffer_size = config.buffer_size
+        self._timeout = config.timeout
+        self._reconnect_min = config.reconnect_min
+        self._reconnect_max = config.reconnect_max
+
+    def send(self, frame):
+        """ Queue ``frame``
+
+        :returns:   False if the buffer is full and ``frame`` was dropped
+
+        """
+        frame = LENGTH_PREFIX.pack(len(frame)) + frame
+        with self._cond:
+            if self._buffered + len(frame) > self._buffer_size:
+                self.stats['dropped'] += 1
+                return False
+            self._frames.append(frame)
+            self._buffered += len(frame)
+            self._cond.notify()
+        return True
+
+    def _connect(self):
+        sock = socket.socket(self._family, socket.SOCK_STREAM)
+        sock.settimeout(self._timeout)
+        try:
+            sock.connect(self._address)
+        except Exception:
+            sock.close()
+            raise
+        self.stats['connects'] += 1
+        return sock
+
+    def _next_chunk(self):
+        """ Wait for frames and get the first few, None once stopped and
+        drained
+
+        """
+        with self._cond:
+            while not self._frames and not self._stopped.is_set():
+                self._cond.wait()
+            chunk = []
+            size = 0
+            for frame in self._frames:
+                chunk.append(frame)
+                size += len(frame)
+                if size >= self.__class__._write_size:
+                    break
+            return chunk or None
+
+    def _consume(self, chunk, sent):
+        """ Drop the frames of ``chunk`` written in full by the first
+        ``sent`` bytes from the buffer
+
+        """
+        with self._cond:
+            for frame in chunk:
+                if sent < len(frame):
+                    break
+                sent -= len(frame)
+                self._frames.popleft()
+                self._buffered -= len(frame)
+                self.stats['sent'] += 1
+
+    def _run(self):
+        sock = None
+        attempt = 0
+        while True:
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            data = ''.join(chunk)
+            sent = 0
+            try:
+                if sock is not None and \
+                   select.select([sock], [], [], 0)[0]:
+                    # the collector never writes, a readable socket is one
+                    # it closed
+                    sock.close()
+                    sock = None
+                if sock is None:
+                    sock = self._connect()
+                while sent < len(data):
+                    sent += sock.send(buffer(data, sent))
+                attempt = 0
+            except Exception:
+                logging.debug('unable to send to %s' % (self._address,),
+                              exc_info=True)
+                if sock is not None:
+                    sock.close()
+                    sock = None
+                attempt += 1
+            # a partially written frame is sent again in full after
+            # reconnecting, the collector discards the partial copy along
+            # with the connection it came in on
+            self._consume(chunk, sent)
+            if attempt > 0:
+                if self._stopped.is_set():
+                    break
+                delay = min(self._reconnect_max,
+                            self._reconnect_min * 2 ** (attempt - 1))
+                self._stopped.wait(random.uniform(delay / 2, delay))
+        if sock is not None:
+            sock.close()
+
+    def stop(self, timeout=None):
+        """ Stop once the buffered frames are sent, or after ``timeout``
+        seconds
+
+        """
+        with self._cond:
+            self._stopped.set()
+            self._cond.notify()
+        self._thread.join(timeout)
+
 
 class Pusher(object):
     def __new__(cls, *args, **kwargs):
@@ -18,21 +373,205 @@ class Pusher(object):
 
     def __init__(self):
         if not self._initialized:
-            self._push_addr = None
-            self._push_port = None
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._address = None
+            self._sock = None
+            self._stream = None
+            self._spool = None
+            self._spool_path = None
+            self._drainer = None
+            self._aggregator = None
+            self._batcher = None
+            self._codec = JSONCodec
+            self._compression = None
+            self._fragment_size = None
+            self._msg_ids = itertools.count(random.randint(0, 0xffffffff))
             self._configure(get_config())
             register_update_callback(self._configure)
+            atexit.register(self.close)
+            self._initialized = True
 
     def _configure(self, config):
-        self._push_addr = config.pusher.addr
-        self._push_port = config.pusher.port
+        family, self._address = parse_address(config.pusher.addr,
+                                              config.pusher.port)
+        if config.pusher.transport == 'stream':
+            if self._stream is not None and \
+               self._stream.address != self._address:
+                self._stop_stream()
+            if self._stream is None:
+                self._stream = StreamSender(family, self._address,
+                                            config.pusher.stream)
+            else:
+                self._stream.configure(config.pusher.stream)
+        else:
+            self._stop_stream()
+            if self._sock is None or self._sock.family != family:
+                self._sock = socket.socket(family, socket.SOCK_DGRAM)
+                if family == socket.AF_UNIX:
+                    # sends to a unix socket block once the collector falls
+                    # behind, drop messages instead like UDP would
+                    self._sock.setblocking(0)
+        codec = get_codec(config.pusher.format)
+        if codec is not self._codec and self._batcher is not None:
+            # don't mix formats in a batch
+            batcher, self._batcher = self._batcher, None
+            batcher.stop()
+        self._codec = codec
+        self._compression = config.pusher.compression
+        self._fragment_size = config.pusher.fragment_size
+        aggregate_config = config.pusher.aggregate
+        if aggregate_config.enabled:
+            if self._aggregator is None:
+                self._aggregator = Aggregator(self._send, aggregate_config)
+            else:
+                self._aggregator.configure(aggregate_config)
+        elif self._aggregator is not None:
+            aggregator, self._aggregator = self._aggregator, None
+            aggregator.stop()
+        batch_config = config.pusher.batch
+        if batch_config.enabled:
+            if self._batcher is None:
+                self._batcher = Batcher(self._send_payload, batch_config,
+                                        self._codec)
+            else:
+                self._batcher.configure(batch_config)
+        elif self._batcher is not None:
+            batcher, self._batcher = self._batcher, None
+            batcher.stop()
+        spool_config = config.pusher.spool
+        if spool_config.enabled:
+            if self._spool is not None and \
+               self._spool_path != spool_config.path:
+                self._close_spool()
+            if self._spool is None:
+                self._open_spool(spool_config)
+            else:
+                self._drainer.configure(spool_config)
+        else:
+            self._close_spool()
+
+    def _open_spool(self, spool_config):
+        """ Open the spool at ``pusher.spool.path``, or by default the first
+        free one in the user's spool directory so a restarted process drains
+        what its predecessor spooled
+
+        """
+        try:
+            if spool_config.path is None:
+                spool = open_spool(get_spool_directory(), spool_config.size)
+            else:
+                spool = Spool(spool_config.path, spool_config.size)
+        except (SpoolLocked, OSError, IOError):
+            logging.exception('unable to open spool, running without one')
+            return
+        self._spool = spool
+        self._spool_path = spool_config.path
+        self._drainer = SpoolDrainer(spool, self._transmit, spool_config)
+
+    def _close_spool(self):
+        drainer, self._drainer = self._drainer, None
+        spool, self._spool = self._spool, None
+        if drainer is not None:
+            drainer.stop()
+        if spool is not None:
+            spool.close()
+
+    def _stop_stream(self, timeout=0):
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            stream.stop(timeout)
+
+    @property
+    def aggregator(self):
+        return self._aggregator
+
+    @property
+    def batcher(self):
+        return self._batcher
+
+    @property
+    def stream(self):
+        return self._stream
+
+    @property
+    def spool(self):
+        return self._spool
+
+    @property
+    def drainer(self):
+        return self._drainer
 
     def push(self, msg):
+        aggregator = self._aggregator
+        if aggregator is not None and aggregator.add(msg):
+            return
+        self._send(msg)
+
+    def _send(self, msg):
+        codec = self._codec
         try:
-            self._sock.sendto(dumps(msg), (self._push_addr, self._push_port))
+            payload = codec.encode(msg)
         except Exception:
-            pass
+            logging.exception('unable to encode message')
+            return
+        batcher = self._batcher
+        if batcher is not None:
+            batcher.add(payload)
+        else:
+            self._send_payload(codec.frame([payload]))
+
+    def _send_payload(self, payload):
+        compression = self._compression
+        if compression.enabled and len(payload) > compression.threshold:
+            compressed = compress(payload, compression.level)
+            if len(compressed) < len(payload):
+                payload = compressed
+        if not self._transmit(payload):
+            spool = self._spool
+            if spool is not None:
+                spool.put(payload)
+
+    def _transmit(self, payload):
+        """ Hand ``payload`` to the transport
+
+        :returns:   False if the transport could not take it, note that a
+                    collector being down goes unnoticed over UDP
+
+        """
+        stream = self._stream
+        if stream is not None:
+            return stream.send(payload)
+        datagrams = [payload]
+        if self._fragment_size and len(payload) > self._fragment_size:
+            msg_id = next(self._msg_ids) & 0xffffffff
+            try:
+                datagrams = fragment(payload, msg_id, self._fragment_size)
+            except ValueError:
+                logging.exception('unable to fragment message')
+                return True
+        sock, address = self._sock, self._address
+        if sock is None:
+            return False
+        for datagram in datagrams:
+            try:
+                sock.sendto(datagram, address)
+            except Exception:
+                logging.debug('unable to send %d bytes to %s' %
+                              (len(datagram), address), exc_info=True)
+                return False
+        return True
+
+    def close(self):
+        """ Flush anything still being aggregated, batched or buffered
+
+        """
+        aggregator, self._aggregator = self._aggregator, None
+        if aggregator is not None:
+            aggregator.stop()
+        batcher, self._batcher = self._batcher, None
+        if batcher is not None:
+            batcher.stop()
+        self._close_spool()
+        self._stop_stream(get_config().pusher.stream.timeout)
 
 def push(msg):
     Pusher().push(msg)
@@ -1,9 +1,16 @@
+import logging
+import time
+
 from abc import ABCMeta, abstractmethod
 
-from pymongo.errors import DuplicateKeyError
+import gevent
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-from .config import get_config
-from .util import get_default_database, sanitize, skeleton
+from .config import get_config, register_update_callback
+from .util import get_default_database, sanitize
+from .util.histogram import Histogram
+from .util.shape import Shape, get_fingerprint, get_message_shape
 
 
 class Sink(object):
@@ -16,34 +23,255 @@ class Sink(object):
         if not self.filter(data, address):
            self.send(data, address)
 
+    def handle_batch(self, batch):
+        """ Handle a list of ``(data, address)`` pairs, sinks that can do
+        better than one message at a time override this
+
+        """
+        for data, address in batch:
+            try:
+                self.handle(data, address)
+            except Exception:
+                logging.exception('sink %s failed to handle data <%s>' %
+                                  (self.__class__.__name__, str(data)))
+
     @abstractmethod
     def send(self, data, address):
         pass
 
+    @property
+    def stats(self):
+        """ Anything the sink has to say about itself, reported along with
+        the collector's stats
 
-class ProfileSink(Sink):
+        """
+        return {}
+
+    def close(self):
+        """ Called once the collector has stopped, sinks holding on to data
+        write it out here
+
+        """
+        pass
+
+
+# codes mongod reports a duplicate key error with
+_DUPLICATE_KEY_ERRORS = (11000, 11001)
+
+
+class Storage(object):
+    """ Where profile sinks write to
+
+    One client is shared per mongo URI. With ``sink_storage.write_behind``
+    enabled, inserts and updates are buffered per collection and written as
+    an unordered bulk operation once ``max_ops`` are held, every
+    ``interval`` seconds and when the sinks are closed. Upserts that lose a
+    race with another collector process are retried once. ``get_stats``
+    reports the depth of a collection's buffer, how many operations were
+    written (``flushed``) and couldn't be (``failed``) and how long flushes
+    took.
+
+    """
     def __new__(cls, *args, **kwargs):
+        if not hasattr(cls, '_instance'):
+            cls._instance = super(Storage, cls).__new__(cls, *args, **kwargs)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._clients = {}
+            # (mongo uri, collection name) -> [op, ...]
+            self._buffers = {}
+            self._stats = {}
+            self._flusher = None
+            self._configure(get_config())
+            register_update_callback(self._configure)
+            self._initialized = True
+
+    def _configure(self, config):
+        write_behind = config.sink_storage.write_behind
+        self._write_behind = write_behind.enabled
+        self._max_ops = write_behind.max_ops
+        self._interval = write_behind.interval
+
+    @classmethod
+    def _get_client_class(cls):
         if not hasattr(cls, '_MongoClient'):
             from gevent import monkey; monkey.patch_socket()
             from pymongo import MongoClient
             cls._MongoClient = MongoClient
-        return super(ProfileSink, cls).__new__(cls, *args, **kwargs)
+        return cls._MongoClient
+
+    def get_client(self, mongo_uri):
+        client = self._clients.get(mongo_uri)
+        if client is None:
+            client = self._clients[mongo_uri] = \
+                self.__class__._get_client_class()(mongo_uri)
+        return client
+
+    def get_database(self, mongo_uri):
+        return get_default_database(self.get_client(mongo_uri), mongo_uri)
+
+    def _get_counters(self, key):
+        counters = self._stats.get(key)
+        if counters is None:
+            counters = self._stats[key] = {'flushes': 0,
+                                           'flushed': 0,
+                                           'failed': 0,
+                                           'latency': Histogram()}
+        return counters
+
+    def get_stats(self, mongo_uri, collection):
+        key = (mongo_uri, collection)
+        counters = self._get_counters(key)
+        latency = counters['latency']
+        return {'depth': len(self._buffers.get(key, [])),
+                'flushes': counters['flushes'],
+                'flushed': counters['flushed'],
+                'failed': counters['failed'],
+                'flush_latency': {'p50': latency.percentile(50),
+                                  'p99': latency.percentile(99),
+                                  'max': latency.max}}
+
+    def insert(self, mongo_uri, collection, document):
+        self._write(mongo_uri, collection, ('insert', document))
+
+    def update(self, mongo_uri, collection, spec, document, upsert=False):
+        self._write(mongo_uri, collection,
+                    ('update', spec, document, upsert))
+
+    def _write(self, mongo_uri, collection, op):
+        if not self._write_behind:
+            self._execute(mongo_uri, collection, op)
+            return
+        key = (mongo_uri, collection)
+        buffer_ = self._buffers.setdefault(key, [])
+        buffer_.append(op)
+        if self._flusher is None:
+            self._flusher = gevent.spawn(self._run_flusher)
+        if len(buffer_) >= self._max_ops:
+            self._flush(key)
+
+    def _execute(self, mongo_uri, collection, op):
+        col = self.get_database(mongo_uri)[collection]
+        if op[0] == 'insert':
+            col.insert(op[1])
+            return
+        try:
+            col.update(op[1], op[2], upsert=op[3])
+        except DuplicateKeyError:
+            # another collector process inserted the document first
+            col.update(op[1], op[2], upsert=op[3])
+
+    def _execute_bulk(self, mongo_uri, collection, ops):
+        bulk = self.get_database(mongo_uri)[collection] \
+                   .initialize_unordered_bulk_op()
+        for op in ops:
+            if op[0] == 'insert':
+                bulk.insert(op[1])
+            elif op[3]:
+                bulk.find(op[1]).upsert().update(op[2])
+            else:
+                bulk.find(op[1]).update(op[2])
+        bulk.execute()
+
+    def _flush(self, key):
+        ops = self._buffers.pop(key, None)
+        if not ops:
+            return
+        counters = self._get_counters(key)
+        start = time.time()
+        failed = self._write_bulk(key, ops)
+        elapsed = (time.time() - start) * 1000
+        counters['flushes'] += 1
+        counters['flushed'] += len(ops) - failed
+        counters['failed'] += failed
+        counters['latency'].add(elapsed)
+        logging.debug('wrote %d of %d operations to %s in %.1fms' %
+                      (len(ops) - failed, len(ops), key[1], elapsed))
+
+    def _write_bulk(self, key, ops, retry=True):
+        """ :returns:   how many of ``ops`` couldn't be written
+
+        """
+        try:
+            self._execute_bulk(key[0], key[1], ops)
+        except BulkWriteError, e:
+            duplicates = []
+            errors = []
+            for error in e.details.get('writeErrors', []):
+                if retry and error.get('code') in _DUPLICATE_KEY_ERRORS:
+                    duplicates.append(ops[error['index']])
+                else:
+                    errors.append(error)
+            if errors:
+                logging.error('%d writes to %s failed: %r' %
+                              (len(errors), key[1], errors[0]))
+            if duplicates:
+                return len(errors) + \
+                       self._write_bulk(key, duplicates, retry=False)
+            return len(errors)
+        except Exception:
+            logging.exception('unable to write %d operations to %s' %
+                              (len(ops), key[1]))
+            return len(ops)
+        return 0
+
+    def _run_flusher(self):
+        while True:
+            gevent.sleep(self._interval)
+            self.flush()
+
+    def flush(self):
+        """ Write out every buffered operation
+
+        """
+        for key in self._buffers.keys():
+            self._flush(key)
+
+    def close(self):
+        flusher, self._flusher = self._flusher, None
+        if flusher is not None:
+            flusher.kill()
+        self.flush()
+
+
+class ProfileSink(Sink):
+    """ Base for sinks writing profiling stats through :class:`Storage` to
+    the ``mongo_uri`` in their ``_config_key`` config section
+
+    """
+    _types = ('explain', 'occurrence', 'aggregate')
+    _config_key = None
 
     def __init__(self):
         self._config = get_config()
-        self._db = None
         self._session_col = None
 
     def filter(self, data, address):
-        return data['collection'].startswith('$')
+        return data.get('type') not in self.__class__._types or \
+               data.get('collection', '').startswith('$')
+
+    @property
+    def mongo_uri(self):
+        return self._config[self.__class__._config_key].mongo_uri
 
     @property
     def db(self):
-        if self._db is None:
-            mongo_uri = self._config.index_profile_sink.mongo_uri
-            client = self.__class__._MongoClient(mongo_uri)
-            self._db = get_default_database(client, mongo_uri)
-        return self._db
+        return Storage().get_database(self.mongo_uri)
+
+    @abstractmethod
+    def _get_collection_name(self):
+        pass
+
+    @property
+    def stats(self):
+        return {'storage': Storage().get_stats(self.mongo_uri,
+                                               self._get_collection_name())}
+
+    def close(self):
+        Storage().close()
 
     @property
     def session_col(self):
@@ -55,9 +283,31 @@ class ProfileSink(Sink):
 
 
 class IndexProfileSink(ProfileSink):
+    """ Keep per query shape counts, covered flags and latencies for each
+    index used, query shapes are told apart by their fingerprint (see
+    :mod:`mongodrums.util.shape`)
+
+    Each ``(session, collection, index)`` document holds a ``queries``
+    subdocument per shape, keyed by fingerprint, so an event is recorded
+    with a single upsert. Latencies are kept as log scaled histograms (see
+    :mod:`mongodrums.util.histogram`) updated with ``$inc``, ``$min`` and
+    ``$max`` so documents stay the same size however many events they count.
+    Documents in the older layout, where ``queries`` is an array, need to be
+    migrated with ``scripts/migrate_index_profile.py``.
+
+    With ``index_profile_sink.aggregate`` enabled, events are summed in
+    memory per ``(session, collection, index, fingerprint)`` and written every
+    ``interval`` seconds, as soon as ``max_keys`` keys are held and when the
+    sink is closed, rather than costing a few round trips each.
+
+    """
+    _config_key = 'index_profile_sink'
+
     def __init__(self):
         super(IndexProfileSink, self).__init__()
         self._index_profile_col = None
+        self._entries = {}
+        self._flusher = None
 
     @property
     def index_profile_col(self):
@@ -67,53 +317,128 @@ class IndexProfileSink(ProfileSink):
             self._index_profile_col = IndexProfileCollection(self.db[col_name])
         return self._index_profile_col
 
+    def _get_collection_name(self):
+        from .collection import IndexProfileCollection
+        return IndexProfileCollection.get_collection_name()
+
+    def _record(self, session, collection, index, shape, count, covered,
+                latency=None):
+        q = {'session': session,
+             'collection': collection,
+             'index': index}
+        prefix = 'queries.%d.' % (shape.fingerprint)
+        update = {'$set': {prefix + 'query': shape.skeleton,
+                           prefix + 'fingerprint': shape.fingerprint},
+                  '$inc': {prefix + 'count': count}}
+        if covered is not None:
+            update['$set'][prefix + 'covered'] = covered
+        if latency is not None and latency.count > 0:
+            update['$inc'].update({prefix + 'latency.count': latency.count,
+                                   prefix + 'latency.sum': latency.sum})
+            for bucket, bucket_count in latency.buckets.iteritems():
+                update['$inc'][prefix + 'latency.buckets.%d' % (bucket)] = \
+                    bucket_count
+            update['$min'] = {prefix + 'latency.min': latency.min}
+            update['$max'] = {prefix + 'latency.max': latency.max}
+        Storage().update(self.mongo_uri,
+                         self.index_profile_col.collection_name, q, update,
+                         upsert=True)
+
+    def _add(self, session, collection, index, shape, count, covered,
+             latency=None):
+        config = self._config.index_profile_sink.aggregate
+        if not config.enabled:
+            self._record(session, collection, index, shape, count, covered,
+                         latency)
+            return
+        key = (session, collection, index, shape.fingerprint)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {'shape': shape,
+                                          'count': 0,
+                                          'covered': None,
+                                          'latency': Histogram()}
+        entry['count'] += count
+        if covered is not None:
+            entry['covered'] = covered
+        if latency is not None:
+            entry['latency'].merge(latency)
+        if self._flusher is None:
+            self._flusher = gevent.spawn(self._run_flusher, config.interval)
+        if len(self._entries) >= config.max_keys:
+            self.flush()
+
+    def _run_flusher(self, interval):
+        while True:
+            gevent.sleep(interval)
+            self.flush()
+
+    def flush(self):
+        """ Write out everything aggregated so far
+
+        """
+        entries, self._entries = self._entries, {}
+        for key, entry in entries.iteritems():
+            latency = entry['latency']
+            try:
+                self._record(*(key[:3] + (entry['shape'],)),
+                             count=entry['count'],
+                             covered=entry['covered'],
+                             latency=latency if latency.count > 0 else None)
+            except Exception:
+                logging.exception('unable to record %s' % (str(key)))
+
+    def close(self):
+        flusher, self._flusher = self._flusher, None
+        if flusher is not None:
+            flusher.kill()
+        self.flush()
+        super(IndexProfileSink, self).close()
+
     def send(self, data, address):
-        q = {'session': data['session'],
-             'collection': data['collection'],
-             'index': data['explain']['cursor']}
-        query_skeleton = skeleton(data['query'])
-        try:
-            doc = {'queries': []}
-            doc.update(q)
-            self.index_profile_col.insert(doc)
-        except DuplicateKeyError:
-            pass
-
-        q.update({'queries.query': {'$ne': query_skeleton}})
-        self.index_profile_col.update(
-            q,
-            {
-                '$push': {
-                    'queries': {
-                        'query': query_skeleton,
-                        'count': 0,
-                        'durations': []
-                    }
-                }
-            })
-
-        self.index_profile_col.update(
-            {'session': data['session'],
-             'collection': data['collection'],
-             'index': data['explain']['cursor'],
-             'queries.query': query_skeleton},
-            {'$inc': {'queries.$.count': 1},
-             '$set': {
-                 'queries.$.covered': data['explain']['indexOnly']
-             },
-             '$push': {
-                 'queries.$.durations': data['explain']['millis']
-            }})
+        if data['type'] == 'aggregate':
+            for entry in data['entries']:
+                # timing mode entries have no plan to account to an index
+                if entry['index'] is None or \
+                   entry['collection'].startswith('$'):
+                    continue
+                # entries carry the skeleton, and the fingerprint when sent
+                # by a recent pusher
+                fingerprint = entry.get('fingerprint')
+                if fingerprint is None:
+                    fingerprint = get_fingerprint(entry['query'])
+                self._add(data['session'], entry['collection'],
+                          entry['index'], Shape(entry['query'], fingerprint),
+                          entry['count'], entry['covered'],
+                          latency=Histogram.from_document(entry['latency']))
+        elif not data.get('aggregated'):
+            # occurrences reuse a cached plan, they carry no timing of their
+            # own
+            latency = None
+            if data['type'] == 'explain' and \
+               data['explain'].get('millis') is not None:
+                latency = Histogram()
+                latency.add(data['explain']['millis'])
+            self._add(data['session'], data['collection'],
+                      data['explain']['cursor'], get_message_shape(data), 1,
+                      data['explain']['indexOnly'], latency)
 
 
 class QueryProfileSink(ProfileSink):
+    """ Store a document per sampled operation, or per aggregated entry
+
+    ``timing`` messages and aggregated entries without an index, which come
+    from timing mode, are stored with no ``explain`` and the latency
+    histogram of the operation.
+
+    """
+    _types = ProfileSink._types + ('timing',)
+    _config_key = 'query_profile_sink'
+
     def __init__(self):
         super(QueryProfileSink, self).__init__()
         self._query_profile_col = None
 
-    def filter(self, data, address):
-        return data['collection'].startswith('$')
-
     @property
     def query_profile_col(self):
         if self._query_profile_col is None:
@@ -122,14 +447,54 @@ class QueryProfileSink(ProfileSink):
             self._query_profile_col = QueryProfileCollection(self.db[col_name])
         return self._query_profile_col
 
+    def _get_collection_name(self):
+        from .collection import QueryProfileCollection
+        return QueryProfileCollection.get_collection_name()
+
+    def _save(self, document):
+        Storage().insert(self.mongo_uri, self.query_profile_col.collection_name,
+                         document)
+
     def send(self, data, address):
+        if data['type'] == 'aggregate':
+            for entry in data['entries']:
+                if entry['collection'].startswith('$'):
+                    continue
+                explain = None
+                if entry['index'] is not None:
+                    explain = {'cursor': entry['index'],
+                               'indexOnly': entry['covered']}
+                self._save(
+                    {'function': entry['function'],
+                     'database': entry['database'],
+                     'collection': entry['collection'],
+                     'session': data['session'],
+                     'explain': explain,
+                     'latency': entry['latency'],
+                     'query': entry['query'],
+                     'fingerprint': entry.get('fingerprint') or
+                                    get_fingerprint(entry['query']),
+                     'source': entry['source'],
+                     'count': entry['count']})
+            return
+        shape = get_message_shape(data)
+        explain = None
+        if data['type'] != 'timing':
+            explain = sanitize(data['explain'])
         query_profile_doc = \
             {'function': data['function'],
              'database': data['database'],
              'collection': data['collection'],
              'session': data['session'],
-             'explain': sanitize(data['explain']),
-             'query': skeleton(data['query']),
-             'source': data['source']}
-        self.query_profile_col.save(query_profile_doc)
+             'explain': explain,
+             'query': shape.skeleton,
+             'fingerprint': shape.fingerprint,
+             'source': data['source'],
+             # already counted by an aggregate message
+             'count': 0 if data.get('aggregated') else 1}
+        if data.get('total_ms') is not None:
+            latency = Histogram()
+            latency.add(data['total_ms'])
+            query_profile_doc['latency'] = latency.to_document()
+        self._save(query_profile_doc)
 
@@ -0,0 +1,247 @@
+"""
+A fixed size, memory mapped ring buffer of frames the pusher could not send
+
+The file starts with a header holding the capacity of the ring and the
+absolute write (``head``) and read (``tail``) positions, followed by the ring
+itself. Each entry is a four byte length and the frame, entries may wrap
+around the end of the ring. Once the ring is full the oldest entries are
+overwritten. A spool reopened with the same capacity picks up where it left
+off, so frames survive an application restart.
+
+An open spool holds an exclusive lock on its file, :func:`open_spool` takes
+the first of a fixed series of files that isn't locked, so processes sharing
+a directory each get their own and a restarted process drains what an
+earlier one left behind. Spool files are never opened through a symlink and
+have to belong to the current user, as does the default directory from
+:func:`get_spool_directory`.
+
+"""
+import errno
+import fcntl
+import itertools
+import mmap
+import os
+import stat
+import struct
+import tempfile
+import threading
+
+
+_HEADER = struct.Struct('!4sB3xQQQQ')
+_MAGIC = 'MDSP'
+_VERSION = 1
+_LENGTH = struct.Struct('!I')
+
+
+class SpoolLocked(Exception):
+    pass
+
+
+class Spool(object):
+    """ Ring buffer of frames in a memory mapped file at ``path``
+
+    :param path:    the spool file, one per process
+    :param size:    capacity of the ring in bytes
+
+    :raises SpoolLocked:    if another spool has ``path`` open
+    :raises OSError:        if ``path`` is a symlink, isn't a regular file or
+                            belongs to another user
+
+    """
+    def __init__(self, path, size):
+        self._path = path
+        self._size = size
+        self._lock = threading.Lock()
+        self.stats = {'spooled': 0, 'overwritten': 0, 'rejected': 0}
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0600)
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid():
+                raise OSError(errno.EPERM, 'not a file of this user\'s', path)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                raise SpoolLocked('%s is in use' % (path))
+            length = _HEADER.size + size
+            if st.st_size != length:
+                os.ftruncate(fd, length)
+            self._mmap = mmap.mmap(fd, length)
+        except:
+            os.close(fd)
+            raise
+        # the lock lasts as long as the descriptor
+        self._fd = fd
+        magic, version, capacity, head, tail, count = \
+            _HEADER.unpack_from(self._mmap)
+        if magic == _MAGIC and version == _VERSION and capacity == size and \
+           0 <= head - tail <= size:
+            self._head, self._tail, self._count = head, tail, count
+        else:
+            self._head = self._tail = self._count = 0
+            self._write_header()
+
+    @property
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        return self._count
+
+    def _write_header(self):
+        _HEADER.pack_into(self._mmap, 0, _MAGIC, _VERSION, self._size,
+                          self._head, self._tail, self._count)
+
+    def _write(self, position, data):
+        offset = position % self._size
+        end = offset + len(data)
+        base = _HEADER.size
+        if end <= self._size:
+            self._mmap[base + offset:base + end] = data
+        else:
+            split = self._size - offset
+            self._mmap[base + offset:base + self._size] = data[:split]
+            self._mmap[base:base + len(data) - split] = data[split:]
+
+    def _read(self, position, length):
+        offset = position % self._size
+        end = offset + length
+        base = _HEADER.size
+        if end <= self._size:
+            return self._mmap[base + offset:base + end]
+        split = self._size - offset
+        return self._mmap[base + offset:base + self._size] + \
+               self._mmap[base:base + length - split]
+
+    def _entry_size(self, position):
+        return _LENGTH.size + _LENGTH.unpack(self._read(position,
+                                                        _LENGTH.size))[0]
+
+    def put(self, frame):
+        """ Append ``frame``, overwriting the oldest entries to make room
+
+        :returns:   False if ``frame`` can't fit in the ring at all
+
+        """
+        size = _LENGTH.size + len(frame)
+        if size > self._size:
+            self.stats['rejected'] += 1
+            return False
+        with self._lock:
+            while self._head + size - self._tail > self._size:
+                self._tail += self._entry_size(self._tail)
+                self._count -= 1
+                self.stats['overwritten'] += 1
+            self._write(self._head, _LENGTH.pack(len(frame)) + frame)
+            self._head += size
+            self._count += 1
+            self._write_header()
+            self.stats['spooled'] += 1
+        return True
+
+    def peek(self):
+        """ Get the oldest entry as ``(position, frame)``, None if the spool
+        is empty
+
+        """
+        with self._lock:
+            if self._count == 0:
+                return None
+            length = self._entry_size(self._tail) - _LENGTH.size
+            return (self._tail,
+                    self._read(self._tail + _LENGTH.size, length))
+
+    def discard(self, position):
+        """ Drop the oldest entry if it's still the one at ``position``, it
+        may have been overwritten since it was peeked at
+
+        """
+        with self._lock:
+            if self._count == 0 or self._tail != position:
+                return
+            self._tail += self._entry_size(self._tail)
+            self._count -= 1
+            self._write_header()
+
+    def close(self):
+        with self._lock:
+            self._mmap.flush()
+            self._mmap.close()
+            os.close(self._fd)
+
+
+def get_spool_directory():
+    """ Get the current user's spool directory in the temp directory,
+    created if need be
+
+    :raises OSError:    if it's not a directory only the user has access to
+
+    """
+    path = os.path.join(tempfile.gettempdir(),
+                        'mongodrums-%d' % (os.getuid()))
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+       st.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise OSError(errno.EPERM, 'not a private directory of this user\'s',
+                      path)
+    return path
+
+
+def open_spool(directory, size, name='mongodrums'):
+    """ Open the first spool in ``directory`` not in use by another process,
+    ``<name>.spool`` then ``<name>-1.spool``, ``<name>-2.spool`` and so on
+
+    """
+    for index in itertools.count():
+        filename = '%s.spool' % (name) if index == 0 else \
+                   '%s-%d.spool' % (name, index)
+        try:
+            return Spool(os.path.join(directory, filename), size)
+        except SpoolLocked:
+            pass
+
+
+class SpoolDrainer(object):
+    """ Replay spooled frames through ``send`` at most ``rate`` frames per
+    second, ``send`` returns False while the collector can't take them, in
+    which case replay is retried every ``retry_interval`` seconds
+
+    """
+    def __init__(self, spool, send, config):
+        self._spool = spool
+        self._send = send
+        self._stopped = threading.Event()
+        self.stats = {'replayed': 0}
+        self.configure(config)
+        self._thread = threading.Thread(target=self._run,
+                                        name='mongodrums-spool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def configure(self, config):
+        self._rate = config.rate
+        self._retry_interval = config.retry_interval
+
+    def _run(self):
+        while not self._stopped.is_set():
+            entry = self._spool.peek()
+            if entry is None:
+                self._stopped.wait(self._retry_interval)
+                continue
+            position, frame = entry
+            if self._send(frame):
+                self._spool.discard(position)
+                self.stats['replayed'] += 1
+                self._stopped.wait(1.0 / self._rate)
+            else:
+                self._stopped.wait(self._retry_interval)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
@@ -0,0 +1,92 @@
+import json
+
+from unittest import TestCase
+
+from bson import ObjectId
+
+from mongodrums.codec import (
+    MAGIC, BSONCodec, JSONCodec, Reassembler, compress, decode, fragment,
+    get_codec
+)
+
+
+class CodecTest(TestCase):
+    def setUp(self):
+        self._msg = {'type': 'explain',
+                     'database': 'db',
+                     'collection': 'foo',
+                     'query': {'_id': ObjectId(), 'name': {'$in': ['bob']}},
+                     'source': 'app.py:1'}
+
+    def test_json(self):
+        payload = JSONCodec.encode(self._msg)
+        # the query is sent as a string for older collectors
+        self.assertIsInstance(json.loads(payload)['query'], basestring)
+        self.assertIsInstance(self._msg['query'], dict)
+        msg, = decode(JSONCodec.frame([payload]))
+        self.assertEqual(json.loads(msg['query'])['name'], {'$in': ['bob']})
+
+    def test_bson(self):
+        data = BSONCodec.frame([BSONCodec.encode(self._msg)])
+        self.assertEqual(data[0], MAGIC)
+        msg, = decode(data)
+        self.assertEqual(msg, self._msg)
+
+    def test_batch(self):
+        for codec in (JSONCodec, BSONCodec):
+            msgs = [{'n': i} for i in xrange(3)]
+            data = codec.frame([codec.encode(m) for m in msgs])
+            self.assertEqual(decode(data), msgs)
+
+    def test_invalid(self):
+        for data in ['blah', '', MAGIC, MAGIC + '\x02',
+                     BSONCodec.frame(['blah'])]:
+            self.assertRaises(ValueError, decode, data)
+        self.assertRaises(ValueError, get_codec, 'blah')
+
+    def test_compress(self):
+        data = BSONCodec.frame([BSONCodec.encode(self._msg)] * 20)
+        compressed = compress(data)
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEqual(decode(compressed), [self._msg] * 20)
+        self.assertRaises(ValueError, decode, compress(compressed))
+
+
+class ReassemblerTest(TestCase):
+    def setUp(self):
+        self._now = 0
+        self._reassembler = Reassembler(2, 1024, 5, timer=lambda: self._now)
+
+    def test_reassemble(self):
+        data = 'x' * 100 + 'y' * 100
+        fragments = fragment(data, 1, 64)
+        self.assertEqual(len(fragments), 4)
+        self.assertTrue(all(len(f) <= 64 for f in fragments))
+        # fragments may arrive out of order and interleaved with others
+        other = fragment(data, 2, 64)
+        results = [self._reassembler.add(f, 'a')
+                   for f in reversed(fragments[1:])]
+        results.append(self._reassembler.add(other[0], 'a'))
+        results.append(self._reassembler.add(fragments[0], 'a'))
+        self.assertEqual(results, [None] * 4 + [data])
+        self.assertEqual(len(self._reassembler), 1)
+        self.assertEqual(self._reassembler.stats['reassembled'], 1)
+
+    def test_timeout(self):
+        fragments = fragment('x' * 200, 1, 64)
+        self._reassembler.add(fragments[0], 'a')
+        self._reassembler.add(fragments[1], 'a')
+        self._now = 5
+        self.assertIsNone(self._reassembler.add(fragments[2], 'a'))
+        self.assertIsNone(self._reassembler.add(fragments[3], 'a'))
+        self.assertEqual(self._reassembler.stats['expired'], 1)
+        self.assertEqual(self._reassembler.stats['dropped_fragments'], 2)
+
+    def test_bounds(self):
+        for msg_id in xrange(3):
+            self._reassembler.add(fragment('x' * 200, msg_id, 64)[0], 'a')
+        self.assertEqual(len(self._reassembler), 2)
+        self.assertEqual(self._reassembler.stats['evicted'], 1)
+        self._reassembler.add(fragment('x' * 4000, 3, 2048)[0], 'a')
+        self.assertEqual(len(self._reassembler), 0)
+        self.assertEqual(self._reassembler.stats['evicted'], 4)
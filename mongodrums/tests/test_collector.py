@@ -1,15 +1,26 @@
+import json
+import os
+import signal
 import socket
+import tempfile
 import time
 import ssl
+import urllib2
 
 import gevent
 import mock
 import pymongo
 
+from unittest import TestCase
+
 from . import BaseTest
+from mongodrums.codec import BSONCodec, fragment
 from mongodrums.collection import SessionCollection
-from mongodrums.collector import Collector, CollectorRunner
+from mongodrums.collector import (
+    Collector, CollectorRunner, CollectorSupervisor, SinkQueue
+)
 from mongodrums.config import get_config, update
+from mongodrums.pusher import push
 from mongodrums.sink import Sink
 
 
@@ -21,6 +32,22 @@ class _BufferSink(Sink):
         self.msgs.append((data, address))
 
 
+class _BatchSink(_BufferSink):
+    def __init__(self):
+        super(_BatchSink, self).__init__()
+        self.batches = []
+
+    def handle_batch(self, batch):
+        self.batches.append(len(batch))
+        super(_BatchSink, self).handle_batch(batch)
+
+
+class _SlowSink(_BufferSink):
+    def send(self, data, address):
+        gevent.sleep(.1)
+        super(_SlowSink, self).send(data, address)
+
+
 class CollectorTest(BaseTest):
     def setUp(self):
         super(CollectorTest, self).setUp()
@@ -81,3 +108,197 @@ class CollectorTest(BaseTest):
             time.sleep(.1)
         self.assertEqual([x[0] for x in sink.msgs], ['blah'] * 5)
 
+
+    def test_handle_batch(self):
+        update({'collector': {'session': 'collector_test'}})
+        sink = _BufferSink()
+        collector = Collector(('127.0.0.1', 0))
+        collector.add_sink(sink)
+        collector.handle('[{"n": 1}, {"n": 2}]', None)
+        collector.handle('{"n": 3}', None)
+        self.assertEqual([x[0] for x in sink.msgs],
+                         [{'n': i, 'session': 'collector_test'}
+                          for i in xrange(1, 4)])
+
+    def test_handle_bson(self):
+        update({'collector': {'session': 'collector_test'}})
+        sink = _BufferSink()
+        collector = Collector(('127.0.0.1', 0))
+        collector.add_sink(sink)
+        collector.handle(BSONCodec.frame([BSONCodec.encode({'n': i})
+                                          for i in xrange(2)]), None)
+        self.assertEqual([x[0] for x in sink.msgs],
+                         [{'n': i, 'session': 'collector_test'}
+                          for i in xrange(2)])
+
+    def test_handle_fragments(self):
+        update({'collector': {'session': 'collector_test'}})
+        sink = _BufferSink()
+        collector = Collector(('127.0.0.1', 0))
+        collector.add_sink(sink)
+        msg = {'type': 'explain', 'explain': {'clauses': ['x' * 100] * 100}}
+        data = BSONCodec.frame([BSONCodec.encode(msg)])
+        for datagram in fragment(data, 1, 1400):
+            collector.handle(datagram, ('127.0.0.1', 1234))
+        self.assertEqual([x[0] for x in sink.msgs],
+                         [dict(msg, session='collector_test')])
+        self.assertEqual(collector.stats['reassembled'], 1)
+
+    def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'collector.sock')
+        update({'collector': {'addr': 'unix://' + path},
+                'pusher': {'addr': 'unix://' + path}})
+        sink = _BufferSink()
+        self._start_server([sink])
+        time.sleep(1)
+        push({'blah': 1})
+        time.sleep(.1)
+        self._stop_server()
+        self.assertEqual([x[0]['blah'] for x in sink.msgs], [1])
+        self.assertFalse(os.path.exists(path))
+        os.rmdir(os.path.dirname(path))
+
+    def test_stream(self):
+        update({'collector': {'transport': 'stream'},
+                'pusher': {'transport': 'stream'}})
+        sink = _BufferSink()
+        self._start_server([sink])
+        time.sleep(1)
+        for i in xrange(100):
+            push({'n': i})
+        time.sleep(.5)
+        self._stop_server()
+        update({'pusher': {'transport': 'datagram'}})
+        self.assertEqual([x[0]['n'] for x in sink.msgs], range(100))
+
+    def test_workers(self):
+        update({'collector': {'session': 'collector_test'}})
+        config = get_config()
+        supervisor = CollectorSupervisor(workers=2)
+        supervisor.restart_delay = 0
+        supervisor.start()
+        time.sleep(1)
+        pids = [w.pid for w in supervisor.workers]
+        self.assertEqual(len(pids), 2)
+        os.kill(pids[0], signal.SIGKILL)
+        time.sleep(1.5)
+        self.assertEqual(supervisor.restarts, 1)
+        self.assertNotIn(pids[0], [w.pid for w in supervisor.workers])
+        supervisor.stop()
+        supervisor.join()
+        self.assertFalse(any(w.is_alive() for w in supervisor.workers))
+        col = SessionCollection(
+                self.db[SessionCollection.get_collection_name()])
+        self.assertEqual(len(col.find({'name': config.collector.session,
+                                       'end_time': {'$exists': True}})),
+                         1)
+
+    def test_recv_batch(self):
+        update({'collector': {'recv_batch': {'enabled': True, 'size': 4}}})
+        config = get_config()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        addr = (config.collector.addr, config.collector.port)
+        sink = _BatchSink()
+        self._start_server([sink])
+        time.sleep(1)
+        for i in xrange(10):
+            sock.sendto('{"n": %d}' % (i), addr)
+        time.sleep(.5)
+        self._stop_server()
+        self.assertEqual([x[0]['n'] for x in sink.msgs], range(10))
+        self.assertEqual(sum(sink.batches), 10)
+        self.assertTrue(max(sink.batches) <= 4)
+
+
+class CollectorSupervisorTest(TestCase):
+    def test_restart_delay(self):
+        supervisor = CollectorSupervisor(workers=1)
+        supervisor._started[0] = 0
+        # backs off while the worker keeps dying soon after starting
+        self.assertEqual([supervisor._get_restart_delay(0, 1)
+                          for _ in xrange(8)],
+                         [1, 2, 4, 8, 16, 32, 60, 60])
+        # and starts over once it stayed up for a while
+        self.assertEqual(supervisor._get_restart_delay(0, 60), 1)
+
+
+class SinkQueueTest(BaseTest):
+    def _get_settings(self, **kwargs):
+        settings = dict(get_config().collector.sink_queue)
+        settings.pop('overrides')
+        settings.update(kwargs)
+        return settings
+
+    def test_isolation(self):
+        slow = SinkQueue(_SlowSink(), self._get_settings())
+        fast = SinkQueue(_BufferSink(), self._get_settings())
+        start = time.time()
+        for i in xrange(10):
+            for sink in (slow, fast):
+                sink.handle({'n': i}, None)
+        self.assertTrue(time.time() - start < .1)
+        gevent.sleep(.1)
+        self.assertEqual([x[0]['n'] for x in fast.sink.msgs], range(10))
+        self.assertTrue(len(slow.sink.msgs) < 10)
+        slow.close()
+        self.assertEqual([x[0]['n'] for x in slow.sink.msgs], range(10))
+        self.assertEqual(slow.stats['processed'], 10)
+        self.assertEqual(slow.stats['depth'], 0)
+        self.assertTrue(slow.stats['latency']['max'] >= 100)
+
+    def test_overflow(self):
+        for overflow, expected in (('drop_newest', [0, 1, 2]),
+                                   ('drop_oldest', [0, 8, 9])):
+            queue = SinkQueue(_SlowSink(),
+                              self._get_settings(size=2, overflow=overflow))
+            for i in xrange(10):
+                queue.handle({'n': i}, None)
+                if i == 0:
+                    # let the worker pick up the first message
+                    gevent.sleep(0)
+            self.assertEqual(queue.stats['dropped'], 7)
+            queue.close()
+            self.assertEqual([x[0]['n'] for x in queue.sink.msgs], expected)
+
+    def test_invalid_overflow(self):
+        self.assertRaises(ValueError, SinkQueue, _BufferSink(),
+                          self._get_settings(overflow='spill'))
+
+    def test_add_sink(self):
+        update({'collector': {'sink_queue': {
+            'enabled': True,
+            'overrides': {'_SlowSink': {'size': 5}}
+        }}})
+        collector = Collector(('127.0.0.1', 0))
+        collector.add_sink(_SlowSink())
+        self.assertIsInstance(collector._sinks[0], SinkQueue)
+        self.assertEqual(collector._sinks[0]._queue.maxsize, 5)
+        self.assertIn('_SlowSink', collector.stats['sinks'])
+
+
+class CollectorStatsTest(BaseTest):
+    def test_stats(self):
+        update({'collector': {'stats': {'enabled': True, 'port': 63335}}})
+        config = get_config()
+        sink = _BufferSink()
+        runner = CollectorRunner([sink], manage_session=False)
+        runner.start()
+        time.sleep(1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        addr = (config.collector.addr, config.collector.port)
+        for i in xrange(5):
+            sock.sendto('{"n": %d}' % (i), addr)
+        sock.sendto('garbage', addr)
+        time.sleep(.5)
+        stats = json.loads(
+            urllib2.urlopen('http://127.0.0.1:63335/').read())
+        runner.stop()
+        runner.join()
+        self.assertEqual(stats['frames'], 6)
+        self.assertEqual(stats['messages'], 5)
+        self.assertEqual(stats['undecodable'], 1)
+        self.assertEqual(stats['bytes'], sum(len('{"n": %d}' % (i))
+                                             for i in xrange(5)) + 7)
+        self.assertEqual(stats['pid'], os.getpid())
+        self.assertTrue(stats['memory']['max_rss'] > 0)
+        self.assertIsNotNone(stats['dispatch_latency']['max'])
@@ -0,0 +1,104 @@
+import imp
+import os
+
+from StringIO import StringIO
+from unittest import TestCase
+
+from mongodrums.util.histogram import (
+    NUM_BUCKETS, Histogram, get_bucket, get_bucket_bounds
+)
+
+
+class HistogramTest(TestCase):
+    def _make_histogram(self, *values):
+        histogram = Histogram()
+        for value in values:
+            histogram.add(value)
+        return histogram
+
+    def test_buckets(self):
+        self.assertEqual([get_bucket(v) for v in (0, .5, 1, 1.5, 2, 3, 100)],
+                         [0, 0, 1, 2, 3, 4, 14])
+        self.assertEqual(get_bucket(10 ** 12), NUM_BUCKETS - 1)
+        self.assertEqual(get_bucket_bounds(0), (0, 1))
+        self.assertEqual(get_bucket_bounds(3), (2, 2 ** 1.5))
+        self.assertEqual(get_bucket_bounds(NUM_BUCKETS - 1)[1], None)
+        for value in (.5, 1, 3, 100, 12345):
+            lower, upper = get_bucket_bounds(get_bucket(value))
+            self.assertTrue(lower <= value < upper)
+
+    def test_add(self):
+        histogram = self._make_histogram(2, 3, 100)
+        histogram.add(3, count=2)
+        self.assertEqual(histogram.buckets, {3: 1, 4: 3, 14: 1})
+        self.assertEqual((histogram.count, histogram.sum, histogram.min,
+                          histogram.max),
+                         (5, 111, 2, 100))
+
+    def test_merge(self):
+        histogram = self._make_histogram(2, 3)
+        histogram.merge(self._make_histogram(3, 100))
+        self.assertEqual(histogram.buckets, {3: 1, 4: 2, 14: 1})
+        self.assertEqual((histogram.count, histogram.sum, histogram.min,
+                          histogram.max),
+                         (4, 108, 2, 100))
+        # merging into or from an empty histogram
+        empty = Histogram()
+        empty.merge(histogram)
+        self.assertEqual(empty.to_document(), histogram.to_document())
+        histogram.merge(Histogram())
+        self.assertEqual((histogram.count, histogram.min, histogram.max),
+                         (4, 2, 100))
+
+    def test_percentile(self):
+        self.assertIsNone(Histogram().percentile(50))
+        histogram = self._make_histogram(.5, 2, 3, 100)
+        # the upper bound of the bucket the rank falls in
+        self.assertEqual(histogram.percentile(25), 1)
+        self.assertEqual(histogram.percentile(50), 2 ** 1.5)
+        self.assertEqual(histogram.percentile(75), 4)
+        # clamped to the largest value seen
+        self.assertEqual(histogram.percentile(99), 100)
+        self.assertEqual(self._make_histogram(10 ** 12).percentile(50),
+                         10 ** 12)
+
+    def test_document(self):
+        histogram = self._make_histogram(.5, 2, 3, 100)
+        doc = histogram.to_document()
+        # bucket keys are strings so they can be stored in mongo
+        self.assertEqual(doc, {'buckets': {'0': 1, '3': 1, '4': 1, '14': 1},
+                               'count': 4, 'sum': 105.5, 'min': .5,
+                               'max': 100})
+        copy = Histogram.from_document(doc)
+        self.assertEqual(copy.buckets, histogram.buckets)
+        self.assertEqual(copy.percentile(50), histogram.percentile(50))
+        self.assertEqual(Histogram.from_document({}).count, 0)
+
+
+class ReportLatencyTest(TestCase):
+    def setUp(self):
+        self._report = imp.load_source(
+            'report', os.path.join(os.path.dirname(__file__), '..', '..',
+                                   'scripts', 'report.py'))
+
+    def test_get_latency(self):
+        histogram = Histogram()
+        histogram.add(3)
+        # durations kept before there were histograms are folded in
+        latency = self._report._get_latency(
+            {'latency': histogram.to_document(), 'durations': [2, 100]})
+        self.assertEqual((latency.count, latency.min, latency.max),
+                         (3, 2, 100))
+
+    def test_markdown_percentiles(self):
+        index = {'used_count': 4, 'query_count': 1,
+                 'queries': {'"{a}"': {'app.py:10': 4}},
+                 'latencies': {'"{a}"': {'p50': 2 ** 1.5, 'p95': 100,
+                                         'p99': 100, 'count': 4}},
+                 'removal_score': 0, 'index_size_ratio': 'N/A',
+                 'collection_size_ratio': 'N/A', 'total_size': 'N/A'}
+        out = StringIO()
+        report = self._report.Report(None, {'foo': {'a_1': index}}, out)
+        report.dump_mark_down()
+        self.assertIn('* latency p50/p95/p99 2.8/100.0/100.0 ms over 4 '
+                      'samples', out.getvalue())
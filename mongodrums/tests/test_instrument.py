@@ -1,5 +1,5 @@
 import inspect
-import json
+import threading
 
 import pymongo
 
@@ -8,10 +8,12 @@ from mock import patch
 from . import BaseTest
 from mongodrums.instrument import (
     _CursorMethodWrapper, _CursorNextWrapper, UpdateWrapper, FindWrapper,
-    start, stop, instrument, instrumented
+    ExplainCache, ExplainExecutor, FirstNSampler, TokenBucketSampler, Wrapper,
+    _collection_wrappers, get_sampler, start, stop, instrument, instrumented
 )
 
-from mongodrums.config import update
+from mongodrums.config import get_config, update
+from mongodrums.util.shape import get_shape
 
 
 class InstrumentTest(BaseTest):
@@ -22,6 +24,14 @@ class InstrumentTest(BaseTest):
                             {'_id': 3, 'name': 'zed'},
                             {'_id': 4, 'name': 'yohan'}])
         self.db.foo.ensure_index('name')
+        ExplainCache().clear()
+
+    def tearDown(self):
+        ExplainExecutor().stop()
+        super(InstrumentTest, self).tearDown()
+
+    def _wait_for_explains(self):
+        ExplainExecutor().join()
 
     def test_instrument_update(self):
         update = pymongo.collection.Collection.update
@@ -53,10 +63,12 @@ class InstrumentTest(BaseTest):
             # chain call
             curs = self.db.foo.find({'name': 'bob'}).limit(1)
             self.assertEqual(push_mock.call_count, 0)
-            self.assertTrue(hasattr(curs.next, 'func'))
-            self.assertIsInstance(curs.next.func, _CursorNextWrapper)
+            self.assertTrue(hasattr(curs.next.im_func, '_mongodrums_wrapper'))
+            self.assertIsInstance(curs.next.im_func._mongodrums_wrapper,
+                                  _CursorNextWrapper)
             # use iter instead of direct call to next
             doc = [d for d in curs][0]
+            self._wait_for_explains()
             self.assertEqual(push_mock.call_count, 1)
             self.assertEqual(doc, {'_id': 1, 'name': 'bob'})
             self.assertIn('allPlans', push_mock.call_args[0][0]['explain'])
@@ -73,10 +85,12 @@ class InstrumentTest(BaseTest):
             curs = self.db.foo.find(q)
             self.assertIn('_mongodrums', curs.__dict__)
             curs.next()
+            self._wait_for_explains()
             self.assertNotIn('_mongodrums', curs.__dict__)
-            self.assertDictEqual(
-                json.loads(push_mock.call_args[0][0]['query']),
-                q)
+            msg = push_mock.call_args[0][0]
+            self.assertDictEqual(msg['query'], q)
+            self.assertEqual(msg['shape'], '"{name}"')
+            self.assertEqual(msg['fingerprint'], get_shape(q).fingerprint)
 
     def test_or_query(self):
         update({'instrument': {'sample_frequency': 1}})
@@ -85,6 +99,7 @@ class InstrumentTest(BaseTest):
             docs = [d for d in self.db.foo.find({'$or': [{'name': 'bob'},
                                                          {'name': 'alice'}]},
                                                 {'name': 1})]
+            self._wait_for_explains()
             self.assertEqual(len(docs), 2)
             self.assertItemsEqual(docs, [{'_id': 1, 'name': 'bob'},
                                          {'_id': 2, 'name': 'alice'}])
@@ -95,23 +110,28 @@ class InstrumentTest(BaseTest):
         with patch('mongodrums.instrument.push') as push_mock, \
              FindWrapper.instrument():
             num_records = self.db.foo.find().count()
+            self._wait_for_explains()
             self.assertEqual(num_records, 4)
-            # find + $cmd
-            self.assertEqual(push_mock.call_count, 2)
+            self.assertEqual(push_mock.call_count, 1)
+            # the count command itself isn't explained
+            self.assertEqual(push_mock.call_args[0][0]['collection'], 'foo')
 
     def test_distinct(self):
         update({'instrument': {'sample_frequency': 1}})
         with patch('mongodrums.instrument.push') as push_mock, \
              FindWrapper.instrument():
             names = self.db.foo.find().distinct('name')
+            self._wait_for_explains()
             self.assertItemsEqual(names, ['alice', 'bob', 'zed', 'yohan'])
-            self.assertEqual(push_mock.call_count, 2)
+            self.assertEqual(push_mock.call_count, 1)
+            self.assertEqual(push_mock.call_args[0][0]['collection'], 'foo')
 
     def test_find_push(self):
         update({'instrument': {'sample_frequency': 1}})
         with patch('mongodrums.instrument.push') as push_mock, \
              FindWrapper.instrument():
             doc = self.db.foo.find_one({'name': 'bob'})
+            self._wait_for_explains()
             self.assertEqual(doc, {'_id': 1, 'name': 'bob'})
             self.assertEqual(push_mock.call_count, 1)
             self.assertIn('allPlans', push_mock.call_args[0][0]['explain'])
@@ -134,6 +154,7 @@ class InstrumentTest(BaseTest):
             doc = self.db.foo.find_one({'name': 'bob'})
             frame_info = inspect.getframeinfo(inspect.currentframe())
             source = '%s:%d' % (frame_info[0], frame_info[1] - 1)
+            self._wait_for_explains()
             self.assertEqual(push_mock.call_args[0][0]['source'], source)
 
     def test_instrumented(self):
@@ -151,5 +172,310 @@ class InstrumentTest(BaseTest):
             with instrument():
                 self.db.foo.find({'name': 'zed'})
                 self.db.foo.update({'name': 'zed'}, {'$set': {'age': 40}})
+                self._wait_for_explains()
         for doc in docs:
             self.assertIn('error', doc['explain'])
+
+    def test_explain_off_application_thread(self):
+        update({'instrument': {'sample_frequency': 1}})
+        threads = []
+        with patch('mongodrums.instrument.push') as push_mock, \
+             FindWrapper.instrument():
+            push_mock.side_effect = \
+                lambda msg: threads.append(threading.current_thread())
+            self.db.foo.find_one({'name': 'bob'})
+            self._wait_for_explains()
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.current_thread())
+
+    def test_unsampled_cursor(self):
+        update({'instrument': {'sample_frequency': 0}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             FindWrapper.instrument():
+            curs = self.db.foo.find()
+            self.assertNotIn('_mongodrums', curs.__dict__)
+            self.assertIsNone(curs._mongodrums)
+            self.assertEqual(len([d for d in curs]), 4)
+            self._wait_for_explains()
+            self.assertEqual(push_mock.call_count, 0)
+        self.assertFalse(hasattr(pymongo.cursor.Cursor.next.im_func,
+                                 '_mongodrums_wrapper'))
+
+    def test_explain_cache(self):
+        update({'instrument': {'sample_frequency': 1}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             FindWrapper.instrument():
+            self.db.foo.find_one({'name': 'bob'})
+            self._wait_for_explains()
+            self.db.foo.find_one({'name': 'zed'})
+            self._wait_for_explains()
+            self.assertEqual(push_mock.call_count, 2)
+            explain, occurrence = [c[0][0] for c in push_mock.call_args_list]
+        self.assertEqual(explain['type'], 'explain')
+        self.assertEqual(occurrence['type'], 'occurrence')
+        self.assertEqual(occurrence['explain'],
+                         {'cursor': explain['explain']['cursor'],
+                          'indexOnly': explain['explain']['indexOnly']})
+        self.assertEqual(ExplainCache().stats['hits'], 1)
+
+    def test_explain_cache_disabled(self):
+        update({'instrument': {'sample_frequency': 1,
+                               'explain_cache': {'size': 0}}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             FindWrapper.instrument():
+            self.db.foo.find_one({'name': 'bob'})
+            self._wait_for_explains()
+            self.db.foo.find_one({'name': 'zed'})
+            self._wait_for_explains()
+        self.assertEqual([c[0][0]['type'] for c in push_mock.call_args_list],
+                         ['explain', 'explain'])
+
+    def test_explain_executor_drop_newest(self):
+        update({'instrument': {'explain_executor': {'workers': 0,
+                                                    'queue_size': 2}}})
+        executor = ExplainExecutor()
+        executor.stop()
+        calls = []
+        try:
+            results = [executor.submit(calls.append, i) for i in xrange(5)]
+            self.assertEqual(results, [True, True, False, False, False])
+            self.assertEqual(executor.stats['dropped'], 3)
+            self.assertEqual(executor.stats['queued'], 2)
+            self.assertEqual([executor._queue.get_nowait()[1][0]
+                              for _ in xrange(2)], [0, 1])
+        finally:
+            executor.stop()
+
+    def test_explain_executor_drop_oldest(self):
+        update({'instrument': {'explain_executor': {'workers': 0,
+                                                    'queue_size': 2,
+                                                    'drop_policy': 'oldest'}}})
+        executor = ExplainExecutor()
+        executor.stop()
+        calls = []
+        try:
+            for i in xrange(5):
+                executor.submit(calls.append, i)
+            self.assertEqual(executor.stats['dropped'], 3)
+            self.assertEqual([executor._queue.get_nowait()[1][0]
+                              for _ in xrange(2)], [3, 4])
+        finally:
+            executor.stop()
+
+    def test_first_n_sampler(self):
+        update({'instrument': {'sample_frequency': 0,
+                               'sampler': {'type': 'first_n', 'first_n': 2,
+                                           'min_frequency': 0}}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             FindWrapper.instrument():
+            self.assertIsInstance(get_sampler(), FirstNSampler)
+            for name in ['bob', 'alice', 'zed', 'yohan']:
+                self.db.foo.find_one({'name': name})
+            self.db.foo.find_one({'_id': 1})
+            self._wait_for_explains()
+            self.assertEqual(
+                [c[0][0]['query'] for c in push_mock.call_args_list],
+                [{'name': 'bob'}, {'name': 'alice'}, {'_id': 1}])
+            rates = get_sampler().effective_rates()
+        self.assertEqual(rates[(self.db.foo.full_name, '"{name}"')], .5)
+        self.assertEqual(rates[(self.db.foo.full_name, '"{_id}"')], 1)
+
+    def test_token_bucket_sampler(self):
+        update({'instrument': {'sampler': {'type': 'token_bucket',
+                                           'rate': 0,
+                                           'burst': 3}}})
+        sampler = get_sampler()
+        self.assertIsInstance(sampler, TokenBucketSampler)
+        self.assertEqual([sampler.sample(self.db.foo, {'name': 'bob'})
+                          for _ in xrange(5)],
+                         [True, True, True, False, False])
+
+    def test_sampled_shape_reused(self):
+        update({'instrument': {'sampler': {'type': 'token_bucket',
+                                           'rate': 0,
+                                           'burst': 1}}})
+        spec = {'name': 'bob'}
+        sampled, shape = get_sampler().sample_shape(self.db.foo, spec)
+        self.assertTrue(sampled)
+        self.assertEqual(shape, get_shape(spec))
+        # the message takes the sampler's shape rather than walking the
+        # query again
+        with patch('mongodrums.instrument.get_shape') as get_shape_mock, \
+             patch('mongodrums.instrument.submit_explain') as submit_mock:
+            Wrapper._sample('find', 'db', 'foo', spec, 'app.py:1',
+                            lambda spec: spec, shape)
+        self.assertFalse(get_shape_mock.called)
+        msg = submit_mock.call_args[0][2]
+        self.assertEqual(msg['fingerprint'], shape.fingerprint)
+
+    def test_sampler_override(self):
+        update({'instrument': {
+            'sample_frequency': 0,
+            'sampler': {
+                'type': 'random',
+                'overrides': {self.db.bar.full_name: {'sample_frequency': 1}}
+            }
+        }})
+        sampler = get_sampler()
+        self.assertFalse(sampler.sample(self.db.foo, {}))
+        self.assertTrue(sampler.sample(self.db.bar, {}))
+        self.assertEqual(sampler.effective_rates(),
+                         {self.db.foo.full_name: 0, self.db.bar.full_name: 1})
+
+    def test_timing_mode(self):
+        update({'instrument': {'timing': {'sample_frequency': 1}}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument(modes=['timing']):
+            docs = [d for d in self.db.foo.find().batch_size(2)]
+            self._wait_for_explains()
+        self.assertEqual(len(docs), 4)
+        self.assertEqual(push_mock.call_count, 1)
+        msg = push_mock.call_args[0][0]
+        self.assertEqual(msg['type'], 'timing')
+        self.assertEqual(msg['terminator'], 'next')
+        self.assertEqual(msg['docs'], 4)
+        self.assertEqual(msg['getmores'], 1)
+        self.assertGreaterEqual(msg['total_ms'], msg['first_batch_ms'])
+        self.assertEqual(msg['fingerprint'], get_shape({}).fingerprint)
+
+    def test_timing_mode_closed_cursor(self):
+        update({'instrument': {'timing': {'sample_frequency': 1}}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument(modes=['timing']):
+            curs = self.db.foo.find().batch_size(2)
+            curs.next()
+            curs.close()
+        self.assertEqual(push_mock.call_count, 1)
+        msg = push_mock.call_args[0][0]
+        self.assertEqual((msg['type'], msg['terminator'], msg['docs']),
+                         ('timing', 'close', 1))
+
+    def test_start_modes_restored(self):
+        update({'instrument': {'modes': ['explain']}})
+        with instrument(modes=['timing']):
+            self.assertEqual(get_config().instrument.modes, ['timing'])
+        self.assertEqual(get_config().instrument.modes, ['explain'])
+
+    def test_timing_mode_find_one_and_update(self):
+        update({'instrument': {'timing': {'sample_frequency': 1}}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument(modes=['timing']):
+            self.db.foo.find_one({'name': 'bob'})
+            self.db.foo.update({'name': 'bob'}, {'$set': {'age': 30}})
+        find, update_ = [c[0][0] for c in push_mock.call_args_list]
+        self.assertEqual((find['type'], find['function'], find['docs']),
+                         ('timing', 'find_one', 1))
+        self.assertEqual((update_['type'], update_['function'],
+                          update_['docs']),
+                         ('timing', 'update', 1))
+
+    def test_explain_and_timing_modes(self):
+        update({'instrument': {'sample_frequency': 1,
+                               'timing': {'sample_frequency': 1}}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument(modes=['explain', 'timing']):
+            self.db.foo.find_one({'name': 'bob'})
+            self._wait_for_explains()
+        self.assertItemsEqual(
+            [c[0][0]['type'] for c in push_mock.call_args_list],
+            ['explain', 'timing'])
+
+    def test_instrument_collection_methods(self):
+        methods = dict([(w._method_name,
+                         pymongo.collection.Collection.__dict__[w._method_name])
+                        for w in _collection_wrappers])
+        with instrument():
+            for wrapper in _collection_wrappers:
+                self.assertIsInstance(
+                    getattr(pymongo.collection.Collection,
+                            wrapper._method_name),
+                    wrapper)
+        for name, meth in methods.iteritems():
+            self.assertIs(pymongo.collection.Collection.__dict__[name], meth)
+
+    def test_collection_method_timing(self):
+        update({'instrument': {'timing': {'sample_frequency': 1}}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument(modes=['timing']):
+            self.db.foo.insert({'_id': 5, 'name': 'kim'})
+            self.assertEqual(self.db.foo.count(), 5)
+            self.assertEqual(len(self.db.foo.distinct('name')), 5)
+            self.db.foo.find_and_modify({'_id': 5}, {'$set': {'age': 3}})
+            self.db.foo.remove({'_id': 5})
+        msgs = [c[0][0] for c in push_mock.call_args_list]
+        self.assertEqual([(m['type'], m['function'], m['docs'])
+                          for m in msgs],
+                         [('timing', 'insert', 1),
+                          ('timing', 'count', 5),
+                          ('timing', 'distinct', 5),
+                          ('timing', 'find_and_modify', 1),
+                          ('timing', 'remove', 1)])
+
+    def test_remove_explain(self):
+        update({'instrument': {'sample_frequency': 1}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument():
+            self.db.foo.remove({'name': 'zed'})
+            self._wait_for_explains()
+        self.assertEqual(push_mock.call_count, 1)
+        msg = push_mock.call_args[0][0]
+        self.assertEqual((msg['type'], msg['function']), ('explain', 'remove'))
+        self.assertEqual(msg['query'], {'name': 'zed'})
+        self.assertIn('cursor', msg['explain'])
+        self.assertEqual(self.db.foo.find({'name': 'zed'}).count(), 0)
+
+    def test_aggregate_explain(self):
+        update({'instrument': {'sample_frequency': 1}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument():
+            self.db.foo.aggregate([{'$match': {'name': 'bob'}}])
+            self._wait_for_explains()
+        # the explain's own command isn't instrumented
+        self.assertEqual(push_mock.call_count, 1)
+        msg = push_mock.call_args[0][0]
+        self.assertEqual((msg['type'], msg['function']),
+                         ('explain', 'aggregate'))
+        self.assertIn('cursor', msg['explain'])
+        self.assertIn('indexOnly', msg['explain'])
+
+    def test_sample_copies_spec(self):
+        spec = {'name': {'$in': ['bob']}}
+        with patch('mongodrums.instrument.submit_explain') as submit_mock:
+            Wrapper._sample('find', 'db', 'foo', spec, 'app.py:1',
+                            lambda spec: spec)
+        # the application reuses its query while the explain is queued
+        spec['name']['$in'].append('alice')
+        _, curs, msg, _ = submit_mock.call_args[0]
+        self.assertEqual(curs, {'name': {'$in': ['bob']}})
+        self.assertEqual(msg['query'], {'name': {'$in': ['bob']}})
+
+    def test_commands_not_instrumented(self):
+        update({'instrument': {'sample_frequency': 1,
+                               'timing': {'sample_frequency': 1}}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument(modes=['explain', 'timing']):
+            self.db['$cmd'].find_one({'ping': 1})
+            self.db.command('ping')
+            self._wait_for_explains()
+        self.assertEqual(push_mock.call_count, 0)
+
+    def test_aggregate_explain_and_timing(self):
+        update({'instrument': {'sample_frequency': 1,
+                               'timing': {'sample_frequency': 1}}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument(modes=['explain', 'timing']):
+            self.db.foo.aggregate([{'$match': {'name': 'bob'}}])
+            self._wait_for_explains()
+        self.assertItemsEqual(
+            [(c[0][0]['type'], c[0][0]['function'])
+             for c in push_mock.call_args_list],
+            [('explain', 'aggregate'), ('timing', 'aggregate')])
+
+    def test_find_one_attribution(self):
+        update({'instrument': {'sample_frequency': 1}})
+        with patch('mongodrums.instrument.push') as push_mock, \
+             instrument():
+            self.db.foo.find_one({'name': 'bob'})
+            self._wait_for_explains()
+        self.assertEqual(push_mock.call_count, 1)
+        self.assertEqual(push_mock.call_args[0][0]['function'], 'find_one')
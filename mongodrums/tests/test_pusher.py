@@ -1,13 +1,22 @@
+import json
+import os
 import select
+import shutil
 import socket
+import tempfile
 import threading
+import time
 
 from bson import ObjectId
 from bson.json_util import dumps
 
 from . import BaseTest
-from mongodrums.config import get_config, configure
-from mongodrums.pusher import push
+from mongodrums.config import get_config, configure, update
+from mongodrums.codec import LENGTH_PREFIX
+from mongodrums.pusher import (
+    Aggregator, Batcher, Pusher, StreamSender, push
+)
+from mongodrums.util.shape import get_fingerprint
 
 
 class _TestCollector(threading.Thread):
@@ -46,3 +55,194 @@ class PusherTest(BaseTest):
 
     def test_push_reconfigure(self):
         pass
+
+
+class AggregatorTest(BaseTest):
+    def setUp(self):
+        super(AggregatorTest, self).setUp()
+        self._sent = []
+        update({'pusher': {'aggregate': {'interval': 60}}})
+        self._aggregator = Aggregator(self._sent.append,
+                                      get_config().pusher.aggregate)
+
+    def tearDown(self):
+        self._aggregator.stop()
+        super(AggregatorTest, self).tearDown()
+
+    def _msg(self, type_, name, millis=None):
+        msg = {'type': type_,
+               'function': 'find',
+               'database': 'db',
+               'collection': 'foo',
+               'query': dumps({'name': name}),
+               'source': 'app.py:1',
+               'explain': {'cursor': 'BtreeCursor name_1',
+                           'indexOnly': False}}
+        if millis is not None:
+            msg['explain']['millis'] = millis
+        return msg
+
+    def test_aggregate(self):
+        first = self._msg('explain', 'bob', 3)
+        self.assertFalse(self._aggregator.add(first))
+        self.assertTrue(first['aggregated'])
+        self.assertTrue(self._aggregator.add(self._msg('explain', 'al', 40)))
+        self.assertTrue(self._aggregator.add(self._msg('occurrence', 'zed')))
+        self._aggregator.flush()
+        self.assertEqual(len(self._sent), 1)
+        self.assertEqual(self._sent[0]['type'], 'aggregate')
+        entry, = self._sent[0]['entries']
+        self.assertEqual(entry['query'], '"{name}"')
+        self.assertEqual(entry['fingerprint'],
+                         get_fingerprint(entry['query']))
+        self.assertEqual(entry['index'], 'BtreeCursor name_1')
+        self.assertEqual(entry['count'], 3)
+        self.assertEqual(entry['latency']['count'], 2)
+        self.assertEqual((entry['latency']['min'], entry['latency']['max']),
+                         (3, 40))
+        # the first explain of a new window is sent again
+        self.assertFalse(self._aggregator.add(self._msg('explain', 'bob', 1)))
+
+    def test_flush_on_max_keys(self):
+        update({'pusher': {'aggregate': {'interval': 60, 'max_keys': 2}}})
+        self._aggregator.configure(get_config().pusher.aggregate)
+        for name in ['a', 'b']:
+            msg = self._msg('occurrence', 'bob')
+            msg['source'] = name
+            self._aggregator.add(msg)
+        self._aggregator._thread.join(.5)
+        self.assertEqual(len(self._sent), 1)
+        self.assertEqual(len(self._sent[0]['entries']), 2)
+
+
+class BatcherTest(BaseTest):
+    def setUp(self):
+        super(BatcherTest, self).setUp()
+        self._sent = []
+        update({'pusher': {'batch': {'max_size': 64, 'interval': 60}}})
+        self._batcher = Batcher(self._sent.append, get_config().pusher.batch)
+
+    def tearDown(self):
+        self._batcher.stop()
+        super(BatcherTest, self).tearDown()
+
+    def test_batch(self):
+        payloads = [dumps({'n': i}) for i in xrange(8)]
+        for payload in payloads:
+            self._batcher.add(payload)
+        self._batcher.flush()
+        self.assertTrue(len(self._sent) > 1)
+        self.assertTrue(all(len(d) <= 64 for d in self._sent))
+        batched = []
+        for datagram in self._sent:
+            if datagram.startswith('['):
+                batched.extend(json.loads(datagram))
+            else:
+                batched.append(json.loads(datagram))
+        self.assertEqual(batched, [{'n': i} for i in xrange(8)])
+
+    def test_oversized(self):
+        payload = dumps({'blah': 'x' * 100})
+        self._batcher.add(dumps({'n': 1}))
+        self._batcher.add(payload)
+        self.assertEqual(self._sent, [dumps({'n': 1}), payload])
+
+    def test_flush_on_interval(self):
+        update({'pusher': {'batch': {'max_size': 64, 'interval': .05}}})
+        self._batcher.stop()
+        self._batcher = Batcher(self._sent.append, get_config().pusher.batch)
+        self._batcher.add(dumps({'n': 1}))
+        self._batcher._thread.join(.5)
+        self.assertEqual(self._sent, [dumps({'n': 1})])
+
+
+class StreamSenderTest(BaseTest):
+    def setUp(self):
+        super(StreamSenderTest, self).setUp()
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.bind(('127.0.0.1', 0))
+        update({'pusher': {'stream': {'buffer_size': 64,
+                                      'reconnect_min': .01,
+                                      'reconnect_max': .05}}})
+        self._sender = StreamSender(socket.AF_INET,
+                                    self._listener.getsockname(),
+                                    get_config().pusher.stream)
+
+    def tearDown(self):
+        self._sender.stop(1)
+        self._listener.close()
+        super(StreamSenderTest, self).tearDown()
+
+    def _read_frames(self, conn, count):
+        reader = conn.makefile('rb')
+        frames = []
+        for _ in xrange(count):
+            length, = LENGTH_PREFIX.unpack(reader.read(LENGTH_PREFIX.size))
+            frames.append(reader.read(length))
+        return frames
+
+    def test_send(self):
+        # frames are buffered until the collector is listening
+        self.assertTrue(self._sender.send('blah'))
+        time.sleep(.1)
+        self._listener.listen(1)
+        self.assertTrue(self._sender.send('blah blah'))
+        conn, _ = self._listener.accept()
+        self.assertEqual(self._read_frames(conn, 2), ['blah', 'blah blah'])
+        # and survive a reconnect
+        conn.close()
+        time.sleep(.1)
+        self._sender.send('more blah')
+        conn, _ = self._listener.accept()
+        self.assertEqual(self._read_frames(conn, 1), ['more blah'])
+        conn.close()
+
+    def test_buffer_full(self):
+        self.assertTrue(self._sender.send('x' * 40))
+        self.assertFalse(self._sender.send('x' * 40))
+        self.assertEqual(self._sender.stats['dropped'], 1)
+
+
+class SpoolTest(BaseTest):
+    def setUp(self):
+        super(SpoolTest, self).setUp()
+        self._dir = tempfile.mkdtemp()
+        self._addr = os.path.join(self._dir, 'collector.sock')
+        update({'pusher': {'addr': 'unix://' + self._addr,
+                           'spool': {'enabled': True,
+                                     'path': os.path.join(self._dir,
+                                                          'pusher.spool'),
+                                     'retry_interval': .05}}})
+
+    def tearDown(self):
+        update({'pusher': {'spool': {'enabled': False}}})
+        super(SpoolTest, self).tearDown()
+        shutil.rmtree(self._dir)
+
+    def test_replay(self):
+        # nothing is listening yet
+        for i in xrange(3):
+            push({'n': i})
+        self.assertEqual(len(Pusher().spool), 3)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self._addr)
+        sock.settimeout(2)
+        try:
+            self.assertEqual([json.loads(sock.recv(4096)) for _ in xrange(3)],
+                             [{'n': i} for i in xrange(3)])
+        finally:
+            sock.close()
+        for _ in xrange(20):
+            if len(Pusher().spool) == 0:
+                break
+            time.sleep(.05)
+        self.assertEqual(Pusher().drainer.stats['replayed'], 3)
+
+    def test_unusable_spool(self):
+        path = os.path.join(self._dir, 'elsewhere.spool')
+        os.symlink(os.path.join(self._dir, 'target'), path)
+        update({'pusher': {'spool': {'path': path}}})
+        # runs without a spool rather than writing through the link
+        self.assertIsNone(Pusher().spool)
+        self.assertFalse(os.path.exists(os.path.join(self._dir, 'target')))
+        push({'n': 1})
@@ -0,0 +1,121 @@
+import re
+
+from unittest import TestCase
+
+from bson import ObjectId
+from bson.errors import InvalidDocument
+from bson.json_util import dumps
+from bson.son import SON
+
+from mongodrums.util import skeleton
+from mongodrums.util.shape import (
+    Shape, get_fingerprint, get_message_shape, get_shape, make_shape
+)
+
+
+class ShapeTest(TestCase):
+    _queries = [
+        {'_id': ObjectId()},
+        {'name': 'bob', 'age': {'$gt': 20, '$lt': 30}},
+        {'$or': [{'a': 1}, {'b': {'$gt': 1}}]},
+        {'tags': {'$elemMatch': {'x': 1, 'y': [{'z': 1}]}}},
+        SON([('z', 1), ('a', {'b': None})]),
+        {u'\xe9t\xe9': {'$ne': True}},
+        {},
+        [],
+        1,
+    ]
+
+    def test_skeleton(self):
+        for query in self.__class__._queries:
+            shape = make_shape(query)
+            self.assertEqual(shape.skeleton, skeleton(query))
+            self.assertEqual(get_shape(query), shape)
+            self.assertEqual(get_shape(dumps(query)), shape)
+
+    def test_fingerprint(self):
+        shape = get_shape({'name': 'bob', 'age': {'$gt': 20}})
+        self.assertEqual(shape.skeleton, '"{age:{$gt},name}"')
+        self.assertEqual(shape.fingerprint, 6031396708559632107)
+        self.assertEqual(shape.fingerprint, get_fingerprint(shape.skeleton))
+        self.assertTrue(-2 ** 63 <= shape.fingerprint < 2 ** 63)
+        self.assertEqual(get_shape({'age': {'$gt': 1}, 'name': 'al'}), shape)
+        self.assertNotEqual(get_shape({'name': 'bob'}).fingerprint,
+                            shape.fingerprint)
+
+    def test_invalid(self):
+        self.assertRaises(InvalidDocument, get_shape, {'a': object()})
+        self.assertRaises(InvalidDocument, get_shape, {'a': [(1, 2)]})
+
+    def _assert_same_shape(self, *queries):
+        shapes = [get_shape(q) for q in queries]
+        self.assertEqual(len(set(shapes)), 1, shapes)
+        return shapes[0].skeleton
+
+    def _assert_different_shapes(self, *queries):
+        shapes = [get_shape(q) for q in queries]
+        self.assertEqual(len(set(shapes)), len(shapes), shapes)
+
+    def test_commutative_operators(self):
+        for op in ('$or', '$and', '$nor'):
+            skeleton = self._assert_same_shape(
+                {op: [{'a': 1}, {'b': {'$gt': 2}}]},
+                {op: [{'b': {'$gt': 3}}, {'a': 4}]})
+            self.assertEqual(skeleton, '"{%s:[{a},{b:{$gt}}]}"' % (op))
+        # other arrays keep their order
+        self._assert_different_shapes({'a': [{'b': 1}, {'c': 1}]},
+                                      {'a': [{'c': 1}, {'b': 1}]})
+
+    def test_array_length_buckets(self):
+        for op in ('$in', '$nin', '$all'):
+            self._assert_same_shape({'a': {op: range(2)}},
+                                    {'a': {op: range(10)}})
+            self._assert_same_shape({'a': {op: range(101)}},
+                                    {'a': {op: range(500)}})
+            self._assert_different_shapes(*[{'a': {op: range(n)}}
+                                            for n in (0, 1, 2, 11, 101)])
+        self.assertEqual(get_shape({'a': {'$in': range(20)}}).skeleton,
+                         '"{a:{$in:[#11-100]}}"')
+        self.assertEqual(
+            get_shape({'a': {'$all': [{'$elemMatch': {'b': 1}}]}}).skeleton,
+            '"{a:{$all:[#1,{$elemMatch:{b}}]}}"')
+
+    def test_regex(self):
+        skeleton = self._assert_same_shape(
+            {'a': re.compile('^foo')}, {'a': re.compile('\\Abar')},
+            {'a': re.compile('^foo', re.MULTILINE)})
+        self.assertEqual(skeleton, '"{a:/prefix/}"')
+        skeleton = self._assert_same_shape(
+            {'a': re.compile('foo')}, {'a': re.compile('^foo', re.I)})
+        self.assertEqual(skeleton, '"{a:/scan/}"')
+        self._assert_same_shape({'a': {'$regex': '^foo'}},
+                                {'a': {'$regex': '^bar', '$options': ''}},
+                                {'a': re.compile('^foo')})
+        self.assertEqual(
+            get_shape({'a': {'$regex': '^foo', '$options': 'i'}}).skeleton,
+            '"{a:/scan/}"')
+        # alongside other operators $regex keeps its place
+        self.assertEqual(
+            get_shape({'a': {'$regex': 'foo', '$ne': 'bar'}}).skeleton,
+            '"{a:{$ne,$regex:/scan/}}"')
+
+    def test_regex_json(self):
+        for query in ({'a': {'$regex': '^foo'}},
+                      {'a': {'$regex': 'foo', '$options': 'i'}},
+                      {'a': re.compile('^foo')},
+                      {'a': re.compile('foo', re.I)}):
+            self.assertEqual(get_shape(dumps(query)), get_shape(query))
+
+    def test_exists(self):
+        self._assert_same_shape({'a': {'$exists': True}},
+                                {'a': {'$exists': 1}})
+        self._assert_different_shapes({'a': {'$exists': True}},
+                                      {'a': {'$exists': False}})
+
+    def test_message_shape(self):
+        query = {'name': 'bob'}
+        msg = {'query': dumps(query)}
+        self.assertEqual(get_message_shape(msg), get_shape(query))
+        # a shape shipped with the message is taken as is
+        msg.update({'shape': '"{other}"', 'fingerprint': 1})
+        self.assertEqual(get_message_shape(msg), Shape('"{other}"', 1))
@@ -1,13 +1,18 @@
+import imp
+import os
 import pymongo
 import random
 
+from argparse import Namespace
+
 import mongodrums.instrument
 
 from . import BaseTest
 from mongodrums.collection import IndexProfileCollection, QueryProfileCollection
 from mongodrums.config import get_config, update
-from mongodrums.instrument import instrument
-from mongodrums.sink import IndexProfileSink, QueryProfileSink
+from mongodrums.instrument import ExplainCache, ExplainExecutor, instrument
+from mongodrums.sink import IndexProfileSink, QueryProfileSink, Storage
+from mongodrums.util.shape import get_fingerprint, get_shape
 
 
 class ProfileSinkTest(BaseTest):
@@ -33,10 +38,12 @@ class ProfileSinkTest(BaseTest):
         })
         self._index_profile_sink = IndexProfileSink()
         self._query_profile_sink = QueryProfileSink()
+        ExplainCache().clear()
 
     def tearDown(self):
         super(ProfileSinkTest, self).tearDown()
         mongodrums.instrument.push = self._real_push
+        Storage().close()
         self.client.drop_database(self.__class__.SINK_TEST_DB)
 
     def _push(self, msg):
@@ -69,10 +76,15 @@ class ProfileSinkTest(BaseTest):
         with instrument():
             count = self.db.foo.find({'sold': {'$gt': 100}}).count()
             self.assertEqual(count, 899)
-            self.assertEqual(len(self._msgs), 2)
+            ExplainExecutor().join()
+            self.assertEqual(len(self._msgs), 1)
             count = self.db.foo.find().count()
             self.assertEqual(count, 1000)
-            self.assertEqual(len(self._msgs), 4)
+            ExplainExecutor().join()
+            self.assertEqual(len(self._msgs), 2)
+        # the count commands on $cmd aren't explained
+        self.assertEqual([msg['collection'] for msg in self._msgs],
+                         ['foo', 'foo'])
         for msg in self._msgs:
             self._index_profile_sink.handle(msg, ('127.0.0.1', 65535))
             self._query_profile_sink.handle(msg, ('127.0.0.1', 65535))
@@ -88,6 +100,7 @@ class ProfileSinkTest(BaseTest):
                                        '$inc': {'in_stock': -1}},
                                       multi=True)
             self.assertEqual(ret['n'], 100)
+            ExplainExecutor().join()
             self.assertEqual(len(self._msgs), 1)
         for msg in self._msgs:
             self._index_profile_sink.handle(msg, ('127.0.0.1', 65535))
@@ -97,3 +110,170 @@ class ProfileSinkTest(BaseTest):
         self.assertEqual(self.sink_db[query_profile_col].find().count(), 1)
         self.assertEqual(self.sink_db[index_profile_col].find().count(), 1)
 
+    def test_aggregate_logging(self):
+        entry = {'database': self.db.name,
+                 'collection': 'foo',
+                 'function': 'find',
+                 'query': '"{store}"',
+                 'index': 'BtreeCursor store_1_widget_1_sold_-1',
+                 'source': 'app.py:10',
+                 'count': 7,
+                 'covered': False,
+                 'latency': {'buckets': {'3': 7}, 'count': 7, 'sum': 14,
+                             'min': 2, 'max': 2}}
+        msg = {'type': 'aggregate', 'session': 'test', 'entries': [entry]}
+        self._index_profile_sink.handle(msg, ('127.0.0.1', 65535))
+        self._index_profile_sink.handle(msg, ('127.0.0.1', 65535))
+        self._query_profile_sink.handle(msg, ('127.0.0.1', 65535))
+        query_profile_col = QueryProfileCollection.get_collection_name()
+        index_profile_col = IndexProfileCollection.get_collection_name()
+        doc = self.sink_db[index_profile_col].find_one()
+        self.assertEqual(doc['queries'].keys(),
+                         [str(get_fingerprint('"{store}"'))])
+        query, = doc['queries'].values()
+        self.assertEqual(query['query'], '"{store}"')
+        self.assertEqual(query['count'], 14)
+        self.assertEqual(query['latency']['count'], 14)
+        self.assertEqual(query['latency']['buckets']['3'], 14)
+        self.assertEqual(
+            self.sink_db[query_profile_col].find_one()['count'], 7)
+
+    def test_timing_logging(self):
+        shape = get_shape({'store': 'x'})
+        entry = {'database': self.db.name,
+                 'collection': 'foo',
+                 'function': 'find',
+                 'query': shape.skeleton,
+                 'fingerprint': shape.fingerprint,
+                 'index': None,
+                 'source': 'app.py:10',
+                 'count': 3,
+                 'covered': None,
+                 'latency': {'buckets': {'3': 3}, 'count': 3, 'sum': 6,
+                             'min': 2, 'max': 2}}
+        timing = {'type': 'timing',
+                  'session': 'test',
+                  'database': self.db.name,
+                  'collection': 'foo',
+                  'function': 'find',
+                  'query': {'store': 'store_0'},
+                  'source': 'app.py:10',
+                  'total_ms': 2}
+        for msg in ({'type': 'aggregate', 'session': 'test',
+                     'entries': [entry]}, timing):
+            self._index_profile_sink.handle(msg, ('127.0.0.1', 65535))
+            self._query_profile_sink.handle(msg, ('127.0.0.1', 65535))
+        query_profile_col = QueryProfileCollection.get_collection_name()
+        index_profile_col = IndexProfileCollection.get_collection_name()
+        self.assertEqual(self.sink_db[index_profile_col].find().count(), 0)
+        docs = list(self.sink_db[query_profile_col].find().sort('count', -1))
+        self.assertEqual([(d['fingerprint'], d['explain'], d['count'],
+                           d['latency']['count']) for d in docs],
+                         [(shape.fingerprint, None, 3, 3),
+                          (shape.fingerprint, None, 1, 1)])
+
+    def test_sink_aggregation(self):
+        update({'index_profile_sink': {'aggregate': {'enabled': True,
+                                                     'interval': 60}}})
+        sink = IndexProfileSink()
+        msg = {'type': 'explain',
+               'session': 'test',
+               'database': self.db.name,
+               'collection': 'foo',
+               'query': {'store': 'store_0'},
+               'explain': {'cursor': 'BtreeCursor store_1_widget_1_sold_-1',
+                           'indexOnly': False,
+                           'millis': 2}}
+        for _ in xrange(5):
+            sink.handle(dict(msg), ('127.0.0.1', 65535))
+        index_profile_col = IndexProfileCollection.get_collection_name()
+        self.assertEqual(self.sink_db[index_profile_col].find().count(), 0)
+        sink.close()
+        doc = self.sink_db[index_profile_col].find_one()
+        query = doc['queries'][str(get_shape({'store': 'x'}).fingerprint)]
+        self.assertEqual(query['count'], 5)
+        self.assertEqual(query['latency']['count'], 5)
+        self.assertEqual(query['latency']['sum'], 10)
+        self.assertNotIn('durations', query)
+
+    def test_shared_client(self):
+        self.assertIs(Storage().get_client(self._index_profile_sink.mongo_uri),
+                      Storage().get_client(self._query_profile_sink.mongo_uri))
+        update({'query_profile_sink': {
+            'mongo_uri': 'mongodb://127.0.0.1:27017/mongodrums_query_test'
+        }})
+        self.assertEqual(self._query_profile_sink.db.name,
+                         'mongodrums_query_test')
+        self.assertEqual(self._index_profile_sink.db.name,
+                         self.__class__.SINK_TEST_DB)
+
+    def test_write_behind(self):
+        update({'sink_storage': {'write_behind': {'enabled': True,
+                                                  'max_ops': 3,
+                                                  'interval': 60}}})
+        msg = {'type': 'explain',
+               'session': 'test',
+               'database': self.db.name,
+               'function': 'find',
+               'collection': 'foo',
+               'query': {'store': 'store_0'},
+               'source': 'app.py:10',
+               'explain': {'cursor': 'BtreeCursor store_1_widget_1_sold_-1',
+                           'indexOnly': False,
+                           'millis': 2}}
+        for _ in xrange(4):
+            self._index_profile_sink.handle(dict(msg), ('127.0.0.1', 65535))
+            self._query_profile_sink.handle(dict(msg), ('127.0.0.1', 65535))
+        query_profile_col = QueryProfileCollection.get_collection_name()
+        index_profile_col = IndexProfileCollection.get_collection_name()
+        self.assertEqual(self.sink_db[query_profile_col].find().count(), 3)
+        stats = self._query_profile_sink.stats['storage']
+        self.assertEqual(stats['depth'], 1)
+        self.assertEqual(stats['flushes'], 1)
+        self.assertIsNotNone(stats['flush_latency']['max'])
+        self._index_profile_sink.close()
+        self._query_profile_sink.close()
+        self.assertEqual(self.sink_db[query_profile_col].find().count(), 4)
+        doc = self.sink_db[index_profile_col].find_one()
+        query, = doc['queries'].values()
+        self.assertEqual(query['count'], 4)
+        self.assertEqual(self._index_profile_sink.stats['storage']['depth'],
+                         0)
+
+    def test_write_behind_failed(self):
+        update({'sink_storage': {'write_behind': {'enabled': True,
+                                                  'max_ops': 3,
+                                                  'interval': 60}}})
+        uri = self._query_profile_sink.mongo_uri
+        col = QueryProfileCollection.get_collection_name()
+        storage = Storage()
+        for doc in ({'_id': 1}, {'_id': 1}, {'_id': 2}):
+            storage.insert(uri, col, doc)
+        stats = storage.get_stats(uri, col)
+        self.assertEqual((stats['flushed'], stats['failed']), (2, 1))
+        self.assertEqual(self.sink_db[col].find().count(), 2)
+
+    def test_migrate_legacy_queries(self):
+        migrate = imp.load_source(
+            'migrate_index_profile',
+            os.path.join(os.path.dirname(__file__), '..', '..', 'scripts',
+                         'migrate_index_profile.py'))
+        shape = get_shape({'a': 1})
+        queries, legacy = migrate.migrate_queries(
+            [{'query': shape.skeleton, 'count': 1},
+             {'query': shape.skeleton, 'fingerprint': shape.fingerprint,
+              'count': 2}])
+        self.assertEqual(legacy, 1)
+        self.assertEqual(queries[str(shape.fingerprint)]['count'], 3)
+
+    def test_runner_config(self):
+        run_collector = imp.load_source(
+            'run_collector', os.path.join(os.path.dirname(__file__), '..',
+                                          '..', 'scripts', 'run_collector.py'))
+        uri = 'mongodb://127.0.0.1:27017/mongodrums_runner_test'
+        args = Namespace(session='runner_test', uri=uri, addr='127.0.0.1',
+                         port=63333, transport='datagram', workers=1,
+                         stats_port=None)
+        update(run_collector.get_config_update(args))
+        self.assertEqual(IndexProfileSink().mongo_uri, uri)
+        self.assertEqual(QueryProfileSink().mongo_uri, uri)
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from mongodrums.spool import (
+    Spool, SpoolLocked, get_spool_directory, open_spool
+)
+
+
+class SpoolTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'test.spool')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _drain(self, spool):
+        frames = []
+        entry = spool.peek()
+        while entry is not None:
+            spool.discard(entry[0])
+            frames.append(entry[1])
+            entry = spool.peek()
+        return frames
+
+    def test_put(self):
+        spool = Spool(self._path, 64)
+        self.assertIsNone(spool.peek())
+        for frame in ['a', 'bb', 'ccc']:
+            self.assertTrue(spool.put(frame))
+        self.assertEqual(len(spool), 3)
+        self.assertEqual(self._drain(spool), ['a', 'bb', 'ccc'])
+        self.assertEqual(len(spool), 0)
+        spool.close()
+
+    def test_overwrite(self):
+        spool = Spool(self._path, 64)
+        # 14 byte entries, the ring holds 4 of them and they wrap around
+        frames = ['%010d' % (i) for i in xrange(10)]
+        for frame in frames:
+            spool.put(frame)
+        self.assertEqual(spool.stats['overwritten'], 6)
+        self.assertEqual(self._drain(spool), frames[-4:])
+        self.assertFalse(spool.put('x' * 64))
+        spool.close()
+
+    def test_discard_overwritten(self):
+        spool = Spool(self._path, 32)
+        spool.put('x' * 10)
+        position, frame = spool.peek()
+        spool.put('y' * 10)
+        spool.put('z' * 10)
+        # the peeked entry was overwritten, discarding it is a no-op
+        spool.discard(position)
+        self.assertEqual(self._drain(spool), ['y' * 10, 'z' * 10])
+        spool.close()
+
+    def test_reopen(self):
+        spool = Spool(self._path, 64)
+        for frame in ['a', 'bb', 'ccc']:
+            spool.put(frame)
+        spool.discard(spool.peek()[0])
+        spool.close()
+        spool = Spool(self._path, 64)
+        self.assertEqual(self._drain(spool), ['bb', 'ccc'])
+        spool.close()
+        # a different size starts afresh
+        spool = Spool(self._path, 128)
+        self.assertEqual(len(spool), 0)
+        spool.close()
+
+    def test_locked(self):
+        spool = Spool(self._path, 64)
+        self.assertRaises(SpoolLocked, Spool, self._path, 64)
+        spool.close()
+        Spool(self._path, 64).close()
+
+    def test_open_spool(self):
+        first = open_spool(self._dir, 64)
+        second = open_spool(self._dir, 64)
+        self.assertEqual(
+            [os.path.basename(s.path) for s in (first, second)],
+            ['mongodrums.spool', 'mongodrums-1.spool'])
+        first.put('a')
+        first.close()
+        # a restarted process picks up the frames left in the first free spool
+        spool = open_spool(self._dir, 64)
+        self.assertEqual(spool.path, first.path)
+        self.assertEqual(self._drain(spool), ['a'])
+        spool.close()
+        second.close()
+
+    def test_symlink(self):
+        target = os.path.join(self._dir, 'target')
+        os.symlink(target, self._path)
+        self.assertRaises(OSError, Spool, self._path, 64)
+        self.assertFalse(os.path.exists(target))
+
+    def test_spool_directory(self):
+        path = get_spool_directory()
+        self.assertEqual(get_spool_directory(), path)
+        self.assertEqual(os.stat(path).st_mode & 0777, 0700)
+        self.assertEqual(os.stat(path).st_uid, os.getuid())
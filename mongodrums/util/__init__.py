@@ -1,5 +1,6 @@
-import inspect
 import re
+import socket
+import sys
 import urlparse
 
 from datetime import datetime
@@ -116,6 +117,17 @@ def desanitize(value):
     return _p_desanitize(value)
 
 
+def parse_address(addr, port=None):
+    """ Resolve a configured address into ``(family, address)``,
+    ``unix:///path`` is a unix domain socket bound to ``/path`` and anything
+    else a host to use along with ``port``
+
+    """
+    if addr.startswith('unix://'):
+        return socket.AF_UNIX, addr[len('unix://'):]
+    return socket.AF_INET, (addr, port)
+
+
 def get_default_database(client, mongo_uri):
     return client[urlparse.urlparse(mongo_uri).path.strip('/')]
 
@@ -128,19 +140,55 @@ def get_pkg(globals_):
     return None
 
 
+# filter package tuple -> {code object: True if the code lives in one of them}
+_filtered_code = {}
+# (code object, line number) -> formatted source
+_sources = {}
+
+
+def _get_filtered_code(filter_packages):
+    key = tuple(filter_packages)
+    try:
+        return _filtered_code[key]
+    except KeyError:
+        return _filtered_code.setdefault(key, {})
+
+
 def get_source(filter_packages=None, up=2):
-    # cut the first two frames off the stack since the first is this frame
-    # and the second *should be* the wrapper's frame
-    stack = inspect.stack()
-    frame = stack[up]
-    if filter_packages is not None:
-        frame = \
-            filter(lambda f: get_pkg(f[0].f_globals) \
-                             not in filter_packages,
-                   stack[up:])[0]
+    """ Get the ``file:line`` an operation was called from
+
+    :param filter_packages:     skip frames whose module is in one of these
+                                packages
+    :param up:                  how many frames to skip before looking at
+                                packages, the default skips this frame and
+                                the wrapper's frame
+
+    Frames are walked directly rather than through :func:`inspect.stack`, so
+    no source lines are read. Whether a code object belongs to a filtered
+    package and the formatted location are memoized.
+
+    """
+    frame = sys._getframe(up)
     try:
-        return '%s:%d' % (frame[1], frame[2])
+        if filter_packages is not None:
+            filtered = _get_filtered_code(filter_packages)
+            while frame is not None:
+                code = frame.f_code
+                try:
+                    skip = filtered[code]
+                except KeyError:
+                    skip = get_pkg(frame.f_globals) in filter_packages
+                    filtered[code] = skip
+                if not skip:
+                    break
+                frame = frame.f_back
+            if frame is None:
+                raise IndexError('no frame outside of %r' % (filter_packages))
+        key = (frame.f_code, frame.f_lineno)
+        try:
+            return _sources[key]
+        except KeyError:
+            return _sources.setdefault(key, '%s:%d' % (key[0].co_filename,
+                                                       key[1]))
     finally:
         del frame
-        del stack
-
@@ -0,0 +1,78 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ A thread safe, size bounded LRU cache with optional per entry TTL
+
+    :param size:    the maximum number of entries to hold, the least recently
+                    used entry is evicted once this is exceeded
+    :param ttl:     seconds an entry stays valid after being put, ``None``
+                    means entries never expire
+
+    """
+    def __init__(self, size, ttl=None, timer=time.time):
+        self._size = size
+        self._ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    def resize(self, size, ttl=None):
+        with self._lock:
+            self._size = size
+            self._ttl = ttl
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def items(self):
+        with self._lock:
+            return [(k, v[0]) for k, v in self._data.iteritems()]
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= self._timer():
+                self.misses += 1
+                return default
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self._size <= 0:
+            return
+        expires = self._timer() + self._ttl if self._ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
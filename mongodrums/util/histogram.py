@@ -0,0 +1,104 @@
+import math
+
+
+# buckets per power of two, bucket 0 holds everything under 1ms and the last
+# bucket everything from 2 ** ((NUM_BUCKETS - 2) / RESOLUTION) ms up
+RESOLUTION = 2
+NUM_BUCKETS = 48
+
+
+def get_bucket(value):
+    """ Get the index of the log scaled bucket ``value`` (in ms) falls in
+
+    """
+    if value < 1:
+        return 0
+    return min(int(math.log(value, 2) * RESOLUTION) + 1, NUM_BUCKETS - 1)
+
+
+def get_bucket_bounds(bucket):
+    """ Get the ``(lower, upper)`` bounds in ms of a bucket, the upper bound
+    of the last bucket is ``None``
+
+    """
+    if bucket == 0:
+        return (0, 1)
+    lower = 2 ** (float(bucket - 1) / RESOLUTION)
+    if bucket >= NUM_BUCKETS - 1:
+        return (lower, None)
+    return (lower, 2 ** (float(bucket) / RESOLUTION))
+
+
+class Histogram(object):
+    """ Fixed size, log scaled latency histogram
+
+    Keeps a count per bucket plus the total count, sum, min and max so it can
+    be merged and stored with ``$inc``/``$min``/``$max`` updates.
+
+    """
+    __slots__ = ('buckets', 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, count=1):
+        bucket = get_bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += count
+        self.sum += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for bucket, count in other.buckets.iteritems():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None:
+            self.min = other.min if self.min is None \
+                                 else min(self.min, other.min)
+        if other.max is not None:
+            self.max = other.max if self.max is None \
+                                 else max(self.max, other.max)
+
+    def percentile(self, percent):
+        """ Estimate a percentile from the buckets, the result is the upper
+        bound of the bucket the percentile falls in, clamped to ``max``
+
+        """
+        if self.count == 0:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                upper = get_bucket_bounds(bucket)[1]
+                if upper is None or (self.max is not None and
+                                     upper > self.max):
+                    return self.max
+                return upper
+        return self.max
+
+    def to_document(self):
+        return {'buckets': dict([(str(b), c)
+                                 for b, c in self.buckets.iteritems()]),
+                'count': self.count,
+                'sum': self.sum,
+                'min': self.min,
+                'max': self.max}
+
+    @classmethod
+    def from_document(cls, doc):
+        histogram = cls()
+        histogram.buckets = dict([(int(b), c) for b, c in
+                                  doc.get('buckets', {}).iteritems()])
+        histogram.count = doc.get('count', 0)
+        histogram.sum = doc.get('sum', 0)
+        histogram.min = doc.get('min')
+        histogram.max = doc.get('max')
+        return histogram
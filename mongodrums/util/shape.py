@@ -0,0 +1,235 @@
+"""
+Query shapes: the canonical skeleton of a query along with a stable 64 bit
+fingerprint of it
+
+The skeleton is produced in a single walk over the query appending to a
+flat list, rather than by building and joining a string per embedded
+document. It's the same as :func:`mongodrums.util.skeleton` gives, save
+for operators that are normalized so equivalent queries share a shape and
+queries likely to get different plans don't:
+
+* the branches of ``$or``, ``$and`` and ``$nor`` are sorted,
+  ``{$or:[{a},{b}]}``
+* the length of ``$in``, ``$nin`` and ``$all`` arrays is kept as one of the
+  buckets ``0``, ``1``, ``2-10``, ``11-100`` and ``>100``,
+  ``{a:{$in:[#2-10]}}``
+* a regex is either an index friendly ``/prefix/`` (anchored and case
+  sensitive) or a ``/scan/``, ``{a:/prefix/}``, ``$options`` are folded in.
+  ``{$regex, $options}`` documents are regexes too, as json_util parses them
+  into one, so ``{a:{$regex:'^x'}}`` shares the shape of ``{a:/^x/}``
+* ``$exists`` keeps its value, ``{a:{$exists:false}}``
+
+The fingerprint is the first eight bytes of the skeleton's md5 digest read
+as a signed 64 bit integer, so it fits a BSON ``long`` and is the same in
+every process. Shapes of JSON text are memoized in a bounded LRU cache keyed
+by the text, parsing it costs many times the walk. Documents are walked every
+time: any key taken from one includes its values so it would rarely hit, and
+encoding one costs more than the walk (see ``benchmarks/bench_shape.py``).
+
+"""
+import hashlib
+import json
+import re
+import struct
+
+from collections import namedtuple
+
+from bson.errors import InvalidDocument
+from bson.json_util import loads
+from bson.son import SON
+
+from . import BSON_TYPES
+from .cache import LRUCache
+
+
+CACHE_SIZE = 10000
+
+_FINGERPRINT = struct.Struct('<q')
+_RE_TYPE = type(re.compile(''))
+
+# operators whose arguments can be given in any order
+_COMMUTATIVE_OPERATORS = frozenset(['$or', '$and', '$nor'])
+# operators whose argument's length is kept, in buckets, as it can sway the
+# plan
+_SIZED_OPERATORS = frozenset(['$in', '$nin', '$all'])
+
+_cache = LRUCache(CACHE_SIZE)
+
+
+Shape = namedtuple('Shape', ['skeleton', 'fingerprint'])
+
+
+def _get_size_bucket(size):
+    if size <= 1:
+        return unicode(size)
+    elif size <= 10:
+        return u'2-10'
+    elif size <= 100:
+        return u'11-100'
+    return u'>100'
+
+
+def _is_prefix(pattern, flags):
+    # only a case sensitive, anchored regex can be answered with an index
+    # range rather than a scan
+    return (pattern.startswith('^') or pattern.startswith('\\A')) and \
+           not flags & re.IGNORECASE
+
+
+def _regex_skeleton(pattern, flags):
+    return u'/prefix/' if _is_prefix(pattern, flags) else u'/scan/'
+
+
+def _regex_operator_skeleton(value):
+    # the skeleton of a document that holds nothing but $regex and $options,
+    # None for anything else
+    if '$regex' not in value or \
+       len(value) > (2 if '$options' in value else 1):
+        return None
+    pattern = value['$regex']
+    flags = re.IGNORECASE if 'i' in (value.get('$options') or '') else 0
+    if type(pattern) is _RE_TYPE:
+        return _regex_skeleton(pattern.pattern, pattern.flags | flags)
+    elif isinstance(pattern, basestring):
+        return _regex_skeleton(pattern, flags)
+    return None
+
+
+def _walk(value, out):
+    t = type(value)
+    if t is list:
+        _walk_list(value, out)
+    elif t is dict or t is SON:
+        _walk_dict(value, out)
+    elif t not in BSON_TYPES:
+        raise InvalidDocument('unknown BSON type %r' % t)
+
+
+def _walk_list(value, out, sized=False):
+    out.append(u'[')
+    first = True
+    if sized:
+        out.append(u'#' + _get_size_bucket(len(value)))
+        first = False
+    for element in value:
+        t = type(element)
+        if t is list or t is dict or t is SON:
+            if not first:
+                out.append(u',')
+            first = False
+            _walk(element, out)
+        elif t not in BSON_TYPES:
+            raise InvalidDocument('unknown BSON type %r' % t)
+    out.append(u']')
+
+
+def _walk_branches(value, out):
+    # branches of a commutative operator are sorted, so they're walked
+    # into their own lists first
+    branches = []
+    for element in value:
+        t = type(element)
+        if t is list or t is dict or t is SON:
+            branch = []
+            _walk(element, branch)
+            branches.append(u''.join(branch))
+        elif t not in BSON_TYPES:
+            raise InvalidDocument('unknown BSON type %r' % t)
+    branches.sort()
+    out.append(u'[')
+    out.append(u','.join(branches))
+    out.append(u']')
+
+
+def _walk_dict(value, out):
+    out.append(u'{')
+    first = True
+    for key in sorted(value):
+        # folded into the $regex verdict
+        if key == '$options' and '$regex' in value:
+            continue
+        if not first:
+            out.append(u',')
+        first = False
+        out.append(key)
+        sub = value[key]
+        t = type(sub)
+        if t is list:
+            out.append(u':')
+            if key in _COMMUTATIVE_OPERATORS:
+                _walk_branches(sub, out)
+            else:
+                _walk_list(sub, out, key in _SIZED_OPERATORS)
+        elif t is dict or t is SON:
+            out.append(u':')
+            regex = _regex_operator_skeleton(sub)
+            if regex is None:
+                _walk_dict(sub, out)
+            else:
+                out.append(regex)
+        elif t is _RE_TYPE:
+            out.append(u':')
+            out.append(_regex_skeleton(sub.pattern, sub.flags))
+        elif key == '$regex' and isinstance(sub, basestring):
+            options = value.get('$options') or ''
+            out.append(u':')
+            out.append(_regex_skeleton(sub, re.IGNORECASE
+                                            if 'i' in options else 0))
+        elif key == '$exists':
+            out.append(u':true' if sub else u':false')
+        elif t not in BSON_TYPES:
+            raise InvalidDocument('unknown BSON type %r' % t)
+    out.append(u'}')
+
+
+def get_fingerprint(query_skeleton):
+    """ Get the fingerprint of a skeleton as given by
+    :func:`mongodrums.util.skeleton`
+
+    """
+    if isinstance(query_skeleton, unicode):
+        query_skeleton = query_skeleton.encode('utf-8')
+    return _FINGERPRINT.unpack_from(hashlib.md5(query_skeleton).digest())[0]
+
+
+def make_shape(query):
+    """ Work out the :class:`Shape` of ``query``, a document or its JSON
+    text, without memoizing it
+
+    :raises InvalidDocument:    if ``query`` holds a type unknown to BSON
+
+    """
+    if isinstance(query, basestring):
+        query = loads(query)
+    out = []
+    _walk(query, out)
+    # the skeleton is a string so the stock encoder gives the same text as
+    # json_util's, in a fraction of the time, a bare value has no skeleton
+    query_skeleton = json.dumps(u''.join(out)) if out else 'null'
+    return Shape(query_skeleton, get_fingerprint(query_skeleton))
+
+
+def get_shape(query):
+    """ Get the :class:`Shape` of ``query``, a document or its JSON text
+
+    :raises InvalidDocument:    if ``query`` holds a type unknown to BSON
+
+    """
+    if not isinstance(query, basestring):
+        return make_shape(query)
+    shape = _cache.get(query)
+    if shape is None:
+        shape = make_shape(query)
+        _cache.put(query, shape)
+    return shape
+
+
+def get_message_shape(msg):
+    """ Get the :class:`Shape` of a pushed message's query, the one the
+    instrumentation shipped in ``shape`` and ``fingerprint`` if it did
+
+    """
+    fingerprint = msg.get('fingerprint')
+    if fingerprint is not None and msg.get('shape') is not None:
+        return Shape(msg['shape'], fingerprint)
+    return get_shape(msg['query'])
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Move index profile documents from the layout where ``queries`` is an array
+to the one where it holds a subdocument per query shape keyed by the shape's
+fingerprint, and add the fingerprint to query profile documents written
+before there was one.
+
+Entries carrying the same fingerprint are merged, and durations kept by
+versions that predate latency histograms are folded into the histogram. Stop
+the collector before migrating, it can't update documents in the older
+layout.
+
+Entries and documents written before there were fingerprints only hold the
+skeleton of their query, without the values that normalization needs (the
+length of ``$in`` arrays, regex patterns, ``$exists`` flags...), so they are
+keyed by the fingerprint of that skeleton. Unless the query used none of the
+normalized operators that won't match the fingerprint the collector writes for
+the same shape now, and the entry stays apart from newer ones rather than
+being merged with them. Such entries are counted and reported as legacy.
+
+"""
+import argparse
+import logging
+import sys
+
+from pymongo import MongoClient
+
+from mongodrums.collection import (
+    IndexProfileCollection, QueryProfileCollection
+)
+from mongodrums.util import get_default_database
+from mongodrums.util.histogram import Histogram
+from mongodrums.util.shape import get_fingerprint
+
+
+_DEFAULT_URI = 'mongodb://localhost:27017/mongodrums'
+
+
+def migrate_queries(queries):
+    """ Turn an array of query entries into subdocuments keyed by fingerprint
+
+    :returns:   the subdocuments and how many entries had no fingerprint, so
+                were keyed by their legacy skeleton
+
+    """
+    migrated = {}
+    legacy = 0
+    for query in queries:
+        fingerprint = query.get('fingerprint')
+        if fingerprint is None:
+            fingerprint = get_fingerprint(query['query'])
+            legacy += 1
+        latency = Histogram.from_document(query.get('latency', {}))
+        for duration in query.get('durations', []):
+            latency.add(duration)
+        entry = migrated.get(str(fingerprint))
+        if entry is None:
+            entry = migrated[str(fingerprint)] = {'query': query['query'],
+                                                  'fingerprint': fingerprint,
+                                                  'count': 0}
+        entry['count'] += query.get('count', 0)
+        if query.get('covered') is not None:
+            entry['covered'] = query['covered']
+        if latency.count > 0:
+            if 'latency' in entry:
+                latency.merge(Histogram.from_document(entry['latency']))
+            entry['latency'] = latency.to_document()
+    return migrated, legacy
+
+
+def migrate_index_profile(collection, session=None, dry_run=False):
+    """ :returns:   the number of documents migrated and of legacy query
+                    entries in them
+
+    """
+    spec = {} if session is None else {'session': session}
+    migrated = 0
+    legacy = 0
+    for doc in collection.find(spec):
+        if not isinstance(doc['queries'], list):
+            continue
+        logging.debug('migrating %d queries on index %s in collection %s' %
+                      (len(doc['queries']), doc['index'], doc['collection']))
+        queries, doc_legacy = migrate_queries(doc['queries'])
+        if not dry_run:
+            # only if no one has updated the document since it was read
+            collection.update({'_id': doc['_id'], 'queries': doc['queries']},
+                              {'$set': {'queries': queries}})
+        migrated += 1
+        legacy += doc_legacy
+    return migrated, legacy
+
+
+def migrate_query_profile(collection, session=None, dry_run=False):
+    """ :returns:   the number of documents given a fingerprint, all of
+                    which are legacy
+
+    """
+    spec = {'fingerprint': {'$exists': False}}
+    if session is not None:
+        spec['session'] = session
+    migrated = 0
+    for doc in collection.find(spec, {'query': True}):
+        if not dry_run:
+            collection.update(
+                {'_id': doc['_id']},
+                {'$set': {'fingerprint': get_fingerprint(doc['query'])}})
+        migrated += 1
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='migrate index profile '
+                                                 'documents to queries keyed '
+                                                 'by shape fingerprint')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log debug output [default: %(default)s]')
+    parser.add_argument('-s', '--session', metavar='SESSION',
+                        help='the instrumentation session to migrate '
+                             '[default: <all sessions>]')
+    parser.add_argument('-u', '--uri', metavar='URI', default=_DEFAULT_URI,
+                        help='the database holding the profiling stats '
+                             '[default: %(default)s]')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='count what needs migrating without changing '
+                             'anything [default: %(default)s]')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    client = MongoClient(args.uri)
+    database = get_default_database(client, args.uri)
+    index_profile_col = \
+        database[IndexProfileCollection.get_collection_name()]
+    query_profile_col = \
+        database[QueryProfileCollection.get_collection_name()]
+    migrated, legacy = migrate_index_profile(index_profile_col, args.session,
+                                             args.dry_run)
+    logging.info('%d index profile documents migrated' % (migrated))
+    if legacy:
+        logging.warning('%d index profile query entries had no fingerprint '
+                        'and were keyed by their legacy skeleton, they won\'t '
+                        'be merged with entries for the same shape recorded '
+                        'from now on' % (legacy))
+    legacy = migrate_query_profile(query_profile_col, args.session,
+                                   args.dry_run)
+    logging.info('%d query profile documents given a fingerprint' % (legacy))
+    if legacy:
+        logging.warning('%d query profile documents were given the '
+                        'fingerprint of their legacy skeleton, it may not '
+                        'match the one of newer documents for the same shape'
+                        % (legacy))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
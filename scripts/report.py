@@ -15,11 +15,29 @@ from mongodrums.collection import (
     SessionCollection, IndexProfileCollection, QueryProfileCollection
 )
 from mongodrums.util import get_default_database
+from mongodrums.util.histogram import Histogram
 
 
 _DEFAULT_URI = 'mongodb://localhost:27017/mongodrums'
 _INDEXES_TO_SKIP = [re.compile(r'BasicCursor.*'),
                     re.compile(r'(BtreeCursor )?_id_( .+)?')]
+_PERCENTILES = (50, 95, 99)
+
+
+def _get_queries(doc):
+    # documents written before queries were keyed by shape fingerprint hold
+    # an array, see migrate_index_profile.py
+    if isinstance(doc['queries'], list):
+        return doc['queries']
+    return doc['queries'].values()
+
+
+def _get_latency(query):
+    latency = Histogram.from_document(query.get('latency', {}))
+    # documents written before latencies were kept as histograms
+    for duration in query.get('durations', []):
+        latency.add(duration)
+    return latency
 
 
 def _get_size(bytes_, unit):
@@ -49,6 +67,8 @@ class Report(object):
             QueryProfileCollection(
                 self._database[QueryProfileCollection.get_collection_name()])
         query = {} if self._session is None else {'session': self._session}
+        # (collection, index name) -> {query: latency histogram}
+        latencies = {}
         for doc in index_col.find_iter(query):
             if any([r.match(doc['index']) for r in _INDEXES_TO_SKIP]):
                 continue
@@ -59,9 +79,10 @@ class Report(object):
                 stats = self._current_indexes[doc['collection']].get('__stats',
                                                                      None)
                 index = self._current_indexes[doc['collection']][index_name]
-                index['query_count'] = len(doc['queries'])
-                index['used_count'] = sum([q['count'] for q in doc['queries']])
-                index['queries'] = dict([(q['query'], {}) for q in doc['queries']])
+                doc_queries = _get_queries(doc)
+                index['query_count'] = len(doc_queries)
+                index['used_count'] = sum([q['count'] for q in doc_queries])
+                index['queries'] = dict([(q['query'], {}) for q in doc_queries])
                 if stats is not None:
                     index['total_size'] = stats['indexSizes'][index_name]
                     try:
@@ -78,12 +99,21 @@ class Report(object):
                     index['removal_score'] = index['index_size_ratio'] * \
                                              index['collection_size_ratio']
 
-                for q in doc['queries']:
+                index_latencies = \
+                    latencies.setdefault((doc['collection'], index_name), {})
+                for q in doc_queries:
+                    latency = index_latencies.setdefault(q['query'],
+                                                         Histogram())
+                    latency.merge(_get_latency(q))
+                for q in doc_queries:
                     logging.debug('gathering query informatin for index %s, ' \
                                   'query %s' % (doc['index'], q['query']))
-                    query = {'query': q['query'],
-                             'collection': doc['collection'],
+                    query = {'collection': doc['collection'],
                              'explain.cursor': doc['index']}
+                    if q.get('fingerprint') is not None:
+                        query['fingerprint'] = q['fingerprint']
+                    else:
+                        query['query'] = q['query']
                     if self._session is not None:
                         query.update({'session': self._session})
                     for query_doc in query_col.find_iter(query):
@@ -91,12 +121,20 @@ class Report(object):
                             self._current_indexes[doc['collection']][index_name]['queries']
                         if query_doc['source'] not in queries[q['query']]:
                             queries[q['query']][query_doc['source']] = 0
-                        queries[q['query']][query_doc['source']] += 1
+                        queries[q['query']][query_doc['source']] += \
+                            query_doc.get('count', 1)
 
             except KeyError:
                 logging.warning('skipping index %s on collection %s:\n%s' %
                                 (index_name, doc['collection'],
                                  traceback.format_exc()))
+        for (collection, index_name), queries in latencies.iteritems():
+            index = self._current_indexes[collection][index_name]
+            index['latencies'] = \
+                dict([(q, dict([('p%d' % (p), h.percentile(p))
+                                for p in _PERCENTILES],
+                               count=h.count))
+                      for q, h in queries.iteritems() if h.count > 0])
 
     def _print(self, str_):
         self._output_stream.write(str_ + '\n')
@@ -137,6 +175,14 @@ class Report(object):
                                  ['y', 'ies'][index['query_count'] > 0]))
                     for q in index['queries']:
                         self._print('    * %s' % (q))
+                        latency = index.get('latencies', {}).get(q)
+                        if latency is not None:
+                            self._print(
+                                '        * latency p50/p95/p99 '
+                                '%.1f/%.1f/%.1f ms over %d samples' %
+                                tuple([latency['p%d' % (p)]
+                                       for p in _PERCENTILES] +
+                                      [latency['count']]))
                         for line in index['queries'][q]:
                             self._print('        * %s hit %d times' %
                                         (line, index['queries'][q][line]))
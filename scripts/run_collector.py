@@ -10,7 +10,7 @@ import uuid
 
 from argparse import ArgumentParser
 
-from mongodrums.collector import CollectorRunner
+from mongodrums.collector import get_runner
 from mongodrums.config import get_config, update
 from mongodrums.sink import QueryProfileSink, IndexProfileSink
 from mongodrums.util.daemon import Daemonize
@@ -19,6 +19,32 @@ from mongodrums.util.daemon import Daemonize
 should_exit = False
 
 
+def get_config_update(args):
+    """ Get the config update for the collector and its sinks from the
+    command line arguments
+
+    """
+    return {'collector': {
+                'session': args.session,
+                'mongo_uri': args.uri,
+                'addr': args.addr,
+                'port': args.port,
+                'transport': args.transport,
+                'workers': args.workers,
+                'stats': {
+                    'enabled': args.stats_port is not None,
+                    'port': args.stats_port or
+                            get_config().collector.stats.port
+                }
+            },
+            'index_profile_sink': {
+                'mongo_uri': args.uri
+            },
+            'query_profile_sink': {
+                'mongo_uri': args.uri
+            }}
+
+
 class Collector(Daemonize):
     def __init__(self, args):
         super(Collector, self).__init__(args.pid_file)
@@ -26,19 +52,8 @@ class Collector(Daemonize):
 
     def run(self):
         logging.info('running collector...')
-        update({'collector': {
-                    'session': self.args.session,
-                    'mongo_uri': self.args.uri,
-                    'addr': self.args.addr,
-                    'port': self.args.port
-                },
-                'index_profile_sink': {
-                    'mongo_uri': self.args.uri
-                 },
-                'query_profile_uri': {
-                    'mongo_uri': self.args.uri
-                }})
-        collector = CollectorRunner([IndexProfileSink(), QueryProfileSink()])
+        update(get_config_update(self.args))
+        collector = get_runner([IndexProfileSink(), QueryProfileSink()])
         collector.start()
         while not should_exit:
             time.sleep(.1)
@@ -91,7 +106,23 @@ def main():
         help='the port to listen on [default: %(default)s]')
     parser.add_argument(
         '--addr', default=config.collector.addr, metavar='ADDR',
-        help='the address to listen on [default: %(default)s]')
+        help='the address to listen on, unix:///path for a unix domain '
+             'socket [default: %(default)s]')
+    parser.add_argument(
+        '--transport', default=config.collector.transport,
+        choices=['datagram', 'stream'],
+        help='receive messages as datagrams or over stream connections '
+             '[default: %(default)s]')
+    parser.add_argument(
+        '-w', '--workers', default=config.collector.workers, type=int,
+        metavar='N',
+        help='collector processes sharing the port, more than one needs '
+             'SO_REUSEPORT [default: %(default)s]')
+
+    parser.add_argument(
+        '--stats-port', type=int, metavar='PORT',
+        help='serve collector stats as JSON over HTTP on this port, worker n '
+             'uses PORT + n [default: disabled]')
 
     args = parser.parse_args()
 
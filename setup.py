@@ -38,7 +38,8 @@ setup(name='mongodrums',
       scripts=[get_path('scripts/run_dex.py'),
                get_path('scripts/run_collector.py'),
                get_path('scripts/update_indexes.py'),
-               get_path('scripts/report.py')],
+               get_path('scripts/report.py'),
+               get_path('scripts/migrate_index_profile.py')],
       packages=find_packages(exclude=["*.tests", "*.tests.*", "tests.*",
                                       "tests"]))
 